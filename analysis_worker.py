@@ -0,0 +1,35 @@
+"""
+Runs the analysis workers, which analyse games as they finish.
+
+Run this directly from your range-vs-range clone folder, e.g.
+"python analysis_worker.py 4" for four worker processes.
+
+Make sure to switch to your virtualenv first, e.g. "workon rvr".
+"""
+import logging
+from rvr.mail.notifications import NOTIFICATION_SETTINGS
+from rvr.app import APP
+from rvr import local_settings
+from rvr.views import main, ajax, range_editor  # @UnusedImport pylint:disable=W0611,C0301
+from rvr.analysis.jobs import run_workers, run_worker, WORKER_COUNT
+import sys
+
+logging.basicConfig(format="%(asctime)s %(processName)s: %(message)s",
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logging.root.setLevel(logging.INFO)
+
+APP.SERVER_NAME = local_settings.SERVER_NAME_
+
+def _worker():
+    """
+    Body of each worker process. Analysis sends email, which needs an app
+    context.
+    """
+    with APP.app_context():
+        NOTIFICATION_SETTINGS.suppress_email = local_settings.SUPPRESS_EMAIL
+        NOTIFICATION_SETTINGS.async_email = False
+        run_worker()
+
+if __name__ == '__main__':
+    run_workers(int(sys.argv[1]) if len(sys.argv) > 1 else WORKER_COUNT,
+                target=_worker)
@@ -5,38 +5,178 @@ The paradigm here is that DTOs contain all the information the previous
 verion's objects did, and the database objects contain a relational version
 of the same.
 """
+import copy
+import datetime
+import hashlib
+import json
 import logging
+import cPickle as pickle
+import random
+import zlib
+import numpy
 from rvr.infrastructure.util import concatenate
 from rvr.db.tables import GameHistoryActionResult, GameHistoryRangeAction,  \
     GameHistoryUserRange, AnalysisFoldEquity, GameHistoryBoard,  \
     AnalysisFoldEquityItem, GameHistoryShowdown,  \
     GameHistoryShowdownEquity, \
     PaymentToPlayer, RunningGameParticipantResult, UserComboGameEV,\
-    UserComboOrderEV, RunningGameParticipant
-from rvr.poker.handrange import HandRange
+    UserComboOrderEV, RunningGameParticipant, ShowdownComboEV,  \
+    AnalysisCheckpoint, AnalysisProfile, AnalysisInputHash, GameHistoryBase
+from rvr.poker.handrange import HandRange, ALL_COMBOS, deal_indices,  \
+    options_to_indices, options_to_lookup, _card_index, combo_index,  \
+    COMBO_MASKS
 from rvr.poker.cards import Card, RIVER, PREFLOP
 import unittest
-from rvr.poker.action import game_continues
-from rvr.poker.showdown import showdown_equity, \
-    _impossible_deal, run_it_once
+from rvr.poker.action import game_continues, _range_matrix,  \
+    _compatible_pairs_without
+from rvr.poker.showdown import showdown_equity, run_it_once, all_combos_ev
 from rvr.mail.notifications import notify_finished
 from rvr.compiled.eval7 import py_hand_vs_range_monte_carlo,\
-    py_hand_vs_range_exact
-import random
-from sqlalchemy.sql.expression import or_
+    py_hand_vs_range_exact, py_all_hands_both_showdowns, py_wh_seed
+from rvr.analysis.profiling import AnalysisProfiler, profiled
+from rvr.analysis.statistics import add_game_results, remove_game_results
+from sqlalchemy.sql.expression import or_, bindparam
 
 # pylint:disable=R0902,R0913,R0914,R0903
 
+BULK_BATCH = 1000  # rows per executemany
+
+# Versions of the parts of the analysis engine. When a change would alter the
+# results of a part, increase its version, and reanalysis will recalculate the
+# games that use that part (see _engine_parts).
+ENGINE_VERSIONS = {
+    'core': 1,  # payments, results and combo EVs (every game)
+    'showdown': 1,  # equity at showdowns, and showdown combo EVs
+    'multiway': 1,  # games with more than two players
+}
+# The random numbers used in analysing a game are seeded from this and the
+# gameid, so that analysis is repeatable. Changing it means every game is
+# reanalysed.
+ANALYSIS_SEED = 1
+# History that analysis depends on, and columns of it that don't matter (or
+# that analysis writes)
+HASHED_HISTORY = [(GameHistoryBase, ['time']),
+                  (GameHistoryBoard, []),
+                  (GameHistoryUserRange, []),
+                  (GameHistoryActionResult, []),
+                  (GameHistoryRangeAction, []),
+                  (GameHistoryShowdown, []),
+                  (GameHistoryShowdownEquity, ['equity'])]
+
 def _combo_to_mnemonic(combo):
     """ combo is frozenset of two Card """
     cards = sorted(list(combo), reverse=True)
     return "".join([c.to_mnemonic() for c in cards])
 
-def _range_size_vs_combo(description, combo, board):
-    return len([o for o in HandRange(description).generate_options()
-                if len(o.union(combo)) == 4])
+def _bulk_insert(session, table, rows):
+    """
+    Insert rows (dicts of column values) into table's underlying table, in
+    batches, without creating ORM objects.
+
+    Doesn't commit.
+    """
+    insert = table.__table__.insert()
+    for i in range(0, len(rows), BULK_BATCH):
+        session.execute(insert, rows[i:i + BULK_BATCH])
+
+class OptionsMemo(object):
+    """
+    Options of range descriptions on boards, and things derived from them,
+    memoised for the duration of one analysis (or merge).
+
+    What's returned is shared between callers, so must not be modified.
+    """
+    def __init__(self):
+        self.memo = {}
+        self.generated = 0  # count of things generated
+        self.avoided = 0  # count of times we returned one again instead
+
+    def _get(self, kind, description, board, generate):
+        """
+        Memoised generate(), keyed on kind, description and board
+        """
+        key = (kind, str(description), tuple(board or ()))
+        if key in self.memo:
+            self.avoided += 1
+        else:
+            self.memo[key] = generate()
+            self.generated += 1
+        return self.memo[key]
+
+    def options(self, description, board):
+        """
+        HandRange(description).generate_options(board)
+        """
+        return self._get('options', description, board,
+                         lambda: HandRange(description).generate_options(board))
+
+    def lookup(self, description, board):
+        """
+        options_to_lookup() of the options
+        """
+        return self._get('lookup', description, board,
+            lambda: options_to_lookup(self.options(description, board)))
+
+    def indices(self, description, board):
+        """
+        options_to_indices() of the options
+        """
+        return self._get('indices', description, board,
+            lambda: options_to_indices(self.options(description, board)))
+
+    def matrix(self, description, board):
+        """
+        _range_matrix() of the range
+        """
+        return self._get('matrix', description, board,
+            lambda: _range_matrix(self.range(description), board))
+
+    def size_vs_combo(self, description, combo, board):
+        """
+        Number of options (on board) that don't share a card with combo
+        """
+        matrix = self.matrix(description, board)
+        total, rows = self._get('sums', description, board,
+            lambda: (matrix.sum() / 2.0, matrix.sum(axis=1)))
+        first, second = [_card_index(card) for card in combo]
+        return int(total - rows[first] - rows[second] + matrix[first, second])
+
+    def range(self, description):
+        """
+        A stand-in for HandRange(description), for code that only calls
+        generate_options(), that generates options from the memo
+        """
+        return _MemoisedRange(self, description)
+
+    def log_stats(self, what):
+        """
+        Log how much regeneration we avoided
+        """
+        logging.debug("%s, options memo generated %d, avoided %d "
+                      "regenerations", what, self.generated, self.avoided)
+
+class _MemoisedRange(object):
+    """
+    HandRange stand-in from OptionsMemo.range()
+    """
+    def __init__(self, memo, description):
+        self.memo = memo
+        self.description = str(description)
+
+    def __repr__(self):
+        return "HandRange(description=%r)" % self.description
 
-def _calculate_weights(combo, range_action, others_ranges, board):
+    def generate_options(self, board=None):
+        """
+        option is a list of hand
+        """
+        return self.memo.options(self.description, board)
+
+def _range_size_vs_combo(memo, description, combo, _board):
+    # Note: the board is ignored, so options containing board cards count
+    return memo.size_vs_combo(description, combo, None)
+
+def _calculate_weights(memo, combo, range_action, others_ranges, board):
     """
     likelihoods of Villain range action resulting in fold, passive, aggressive
     for Hero combo given other players ranges and board
@@ -44,38 +184,75 @@ def _calculate_weights(combo, range_action, others_ranges, board):
     f = p = a = 0  # count of times we hit the fold, the call, the raise
     if len(others_ranges) == 1:
         # heads-up
-        f = _range_size_vs_combo(range_action.fold_range, combo, board)
-        p = _range_size_vs_combo(range_action.passive_range, combo, board)
-        a = _range_size_vs_combo(range_action.aggressive_range, combo, board)
+        f = _range_size_vs_combo(memo, range_action.fold_range, combo, board)
+        p = _range_size_vs_combo(memo, range_action.passive_range, combo,
+                                 board)
+        a = _range_size_vs_combo(memo, range_action.aggressive_range, combo,
+                                 board)
     else:
-        villain_f = HandRange(range_action.fold_range)  \
-            .generate_options(board)
-        villain_p = HandRange(range_action.passive_range)  \
-            .generate_options(board)
-        villain_a = HandRange(range_action.aggressive_range)  \
-            .generate_options(board)
-        others_options = {k: HandRange(v).generate_options(board)
-                          for k, v in others_ranges.iteritems()}
-        for _ in xrange(1000 * len(others_ranges)):
-            dealt = {None: combo}  # None for Hero
-            for player, options in others_options.iteritems():
-                dealt[player] = random.choice(options)
-            if _impossible_deal(dealt.values()):
-                continue
-            if dealt[range_action.userid] in villain_f:
-                f += 1
-            elif dealt[range_action.userid] in villain_p:
-                p += 1
-            elif dealt[range_action.userid] in villain_a:
-                a += 1
-            else:
-                assert False
+        villain_f = memo.lookup(range_action.fold_range, board)
+        villain_p = memo.lookup(range_action.passive_range, board)
+        villain_a = memo.lookup(range_action.aggressive_range, board)
+        players = others_ranges.keys()
+        dealt = deal_indices(
+            [memo.indices(others_ranges[player], board) for player in players],
+            1000 * len(others_ranges),
+            excluded=combo)
+        villain = dealt[:, players.index(range_action.userid)]
+        f = int(villain_f[villain].sum())
+        p = int(villain_p[villain].sum())
+        a = int(villain_a[villain].sum())
+        assert f + p + a == len(villain)
     total = f + p + a
     if total > 0:
         return 1.0 * f / total, 1.0 * p / total, 1.0 * a / total
     else:
         return None
 
+def _calculate_all_weights(memo, combos, range_action, others_ranges, board):
+    """
+    _calculate_weights for all of Hero's combos at once, as a map of combo to
+    weights (or None)
+
+    Heads-up, and with one other player besides Villain, this counts exactly the
+    deals compatible with each combo (see WhatCouldBe.exact_weights). Otherwise
+    it samples, per combo.
+    """
+    others = [range_raw for userid, range_raw in others_ranges.iteritems()
+              if userid != range_action.userid]
+    if len(others) > 1:
+        return {combo: _calculate_weights(memo, combo, range_action,
+                                          others_ranges, board)
+                for combo in combos}
+    indices = numpy.array([[_card_index(card) for card in combo]
+                           for combo in combos], dtype=int).reshape(-1, 2)
+    firsts, seconds = indices[:, 0], indices[:, 1]
+    if others:
+        other = memo.matrix(others[0], board)
+    counts = []
+    for description in [range_action.fold_range,
+                        range_action.passive_range,
+                        range_action.aggressive_range]:
+        villain = memo.matrix(description, board)
+        if others:
+            compatible = _compatible_pairs_without(villain, other)
+        else:
+            # Villain's options, less those containing either of Hero's cards
+            rows = villain.sum(axis=1)
+            compatible = villain.sum() / 2.0 - rows[:, None] - rows[None, :]  \
+                + villain
+        counts.append(compatible[firsts, seconds])
+    f, p, a = counts
+    total = f + p + a
+    weights = {}
+    for i, combo in enumerate(combos):
+        if total[i] > 0:
+            weights[combo] = (f[i] / total[i], p[i] / total[i],
+                              a[i] / total[i])
+        else:
+            weights[combo] = None
+    return weights
+
 def _populate_actor_ev(session, games, range_action):
     """
     add new EVs into each game from the other games, to fill in all the gaps
@@ -90,90 +267,126 @@ def _populate_actor_ev(session, games, range_action):
     logging.debug('populating actor EV for %d combos', len(combo_order_evs))
     results_keys = set((r.userid, r.gameid, r.order, r.combo)
                        for r in combo_order_evs)
+    rows = []
     for combo_ev in combo_order_evs:
         # put it in every game it's not already in
         for game in games:
             key = (combo_ev.userid, game.gameid, combo_ev.order, combo_ev.combo)
             if key not in results_keys:
-                ucoev = UserComboOrderEV()
-                ucoev.gameid = game.gameid
-                ucoev.userid = combo_ev.userid
-                ucoev.order = combo_ev.order
-                ucoev.combo = combo_ev.combo
-                ucoev.ev = combo_ev.ev
-                session.add(ucoev)
+                rows.append({'gameid': game.gameid,
+                             'userid': combo_ev.userid,
+                             'order': combo_ev.order,
+                             'combo': combo_ev.combo,
+                             'ev': combo_ev.ev})
+    _bulk_insert(session, UserComboOrderEV, rows)
     # Same again for whole-game EV. Admittedly a bit ugly.
     combo_game_evs = session.query(UserComboGameEV)  \
         .filter(or_(UserComboGameEV.gameid == g.gameid for g in games))  \
         .filter(UserComboGameEV.userid == range_action.userid).all()
     results_keys = set((r.userid, r.gameid, r.combo)
                        for r in combo_game_evs)
+    rows = []
     for combo_ev in combo_game_evs:
         # put it in every game it's not already in
         for game in games:
             key = (combo_ev.userid, game.gameid, combo_ev.combo)
             if key not in results_keys:
-                ucgev = UserComboGameEV()
-                ucgev.gameid = game.gameid
-                ucgev.userid = combo_ev.userid
-                ucgev.combo = combo_ev.combo
-                ucgev.ev = combo_ev.ev
-                session.add(ucgev)
-
-def _get_combo_ev(session, userid, gameid, combo, order):
+                rows.append({'gameid': game.gameid,
+                             'userid': combo_ev.userid,
+                             'combo': combo_ev.combo,
+                             'ev': combo_ev.ev})
+    _bulk_insert(session, UserComboGameEV, rows)
+
+def _load_combo_evs(session, gameids, userids, max_order):
     """
-    load a combo EV from the database, or None
+    load combo EVs for these users in these games, before max_order, into a
+    map of (userid, gameid, order, combo) to ev
 
-    if order is None, load the game's combo EV
+    the game's combo EV has order None
     """
-    table = UserComboGameEV if order is None else UserComboOrderEV
-    q = session.query(table)
-    if table == UserComboOrderEV:
-        q = q.filter(table.order == order)
-    q = q.filter(table.combo == combo)
-    q = q.filter(table.userid == userid)
-    q = q.filter(table.gameid == gameid)
-    results = q.all()
-    if results:
-        result, = results
-        return result
-    else:
-        return None
+    evs = {}
+    for row in session.query(UserComboGameEV.userid, UserComboGameEV.gameid,
+                             UserComboGameEV.combo, UserComboGameEV.ev)  \
+            .filter(UserComboGameEV.gameid.in_(gameids))  \
+            .filter(UserComboGameEV.userid.in_(userids)):
+        evs[(row.userid, row.gameid, None, row.combo)] = row.ev
+    for row in session.query(UserComboOrderEV.userid, UserComboOrderEV.gameid,
+                             UserComboOrderEV.order, UserComboOrderEV.combo,
+                             UserComboOrderEV.ev)  \
+            .filter(UserComboOrderEV.gameid.in_(gameids))  \
+            .filter(UserComboOrderEV.userid.in_(userids))  \
+            .filter(UserComboOrderEV.order < max_order):
+        evs[(row.userid, row.gameid, row.order, row.combo)] = row.ev
+    return evs
+
+def _update_combo_evs(session, evs):
+    """
+    write back a map of (userid, gameid, order, combo) to ev, as loaded by
+    _load_combo_evs, in batches
 
-def _average_ev(coe_f, coe_p, coe_a, w_f, w_p, w_a):
+    Doesn't commit.
+    """
+    game_table = UserComboGameEV.__table__
+    game_update = game_table.update()  \
+        .where(game_table.c.userid == bindparam('b_userid'))  \
+        .where(game_table.c.gameid == bindparam('b_gameid'))  \
+        .where(game_table.c.combo == bindparam('b_combo'))  \
+        .values(ev=bindparam('b_ev'))
+    order_table = UserComboOrderEV.__table__
+    order_update = order_table.update()  \
+        .where(order_table.c.userid == bindparam('b_userid'))  \
+        .where(order_table.c.gameid == bindparam('b_gameid'))  \
+        .where(order_table.c.order == bindparam('b_order'))  \
+        .where(order_table.c.combo == bindparam('b_combo'))  \
+        .values(ev=bindparam('b_ev'))
+    game_rows = []
+    order_rows = []
+    for (userid, gameid, order, combo), ev in evs.iteritems():
+        row = {'b_userid': userid, 'b_gameid': gameid, 'b_combo': combo,
+               'b_ev': ev}
+        if order is None:
+            game_rows.append(row)
+        else:
+            row['b_order'] = order
+            order_rows.append(row)
+    for statement, rows in [(game_update, game_rows),
+                            (order_update, order_rows)]:
+        for i in range(0, len(rows), BULK_BATCH):
+            session.execute(statement, rows[i:i + BULK_BATCH])
+
+def _average_ev(ev_f, ev_p, ev_a, w_f, w_p, w_a):
     """ return the weighted average of three combo EVs """
-    if coe_f is None and coe_p is None and coe_a is None:
+    if ev_f is None and ev_p is None and ev_a is None:
         return None
     result = 0.0
-    if coe_f:
-        result += coe_f.ev * w_f
-    if coe_p:
-        result += coe_p.ev * w_p
-    if coe_a:
-        result += coe_a.ev * w_a
+    if ev_f is not None:
+        result += ev_f * w_f
+    if ev_p is not None:
+        result += ev_p * w_p
+    if ev_a is not None:
+        result += ev_a * w_a
     return result
 
-def _merge_non_actor_combo(session, games, hero, combo, max_order,
+def _merge_non_actor_combo(evs, updates, hero, combo, max_order,
                            w_f, w_p, w_a, gameid_f, gameid_p, gameid_a):
     """
     average ev for combo, for all recorded combo evs in games, up to order,
     with weights w_f, w_p, w_a respective games
+
+    evs is as loaded by _load_combo_evs, and changed evs are put in updates
     """
     for order in [None] + range(max_order):
-        logging.debug("merging combo %s at order %r for userid %d",
-                      combo, order, hero)
-        coe_f = _get_combo_ev(session, hero, gameid_f, combo, order)
-        coe_p = _get_combo_ev(session, hero, gameid_p, combo, order)
-        coe_a = _get_combo_ev(session, hero, gameid_a, combo, order)
-        ev = _average_ev(coe_f, coe_p, coe_a, w_f, w_p, w_a)
-        if coe_f:
-            coe_f.ev = ev
-        if coe_p:
-            coe_p.ev = ev
-        if coe_a:
-            coe_a.ev = ev
-
-def _merge_non_actor_ev(session, board, ranges, games, range_action,
+        key_f = (hero, gameid_f, order, combo)
+        key_p = (hero, gameid_p, order, combo)
+        key_a = (hero, gameid_a, order, combo)
+        ev = _average_ev(evs.get(key_f), evs.get(key_p), evs.get(key_a),
+                         w_f, w_p, w_a)
+        for key in (key_f, key_p, key_a):
+            if key in evs and evs[key] != ev:
+                evs[key] = ev
+                updates[key] = ev
+
+def _merge_non_actor_ev(session, memo, board, ranges, games, range_action,
                         action_results):
     """
     average out EV for all combo EVs before this range action, based on the
@@ -192,36 +405,42 @@ def _merge_non_actor_ev(session, board, ranges, games, range_action,
     # all betting lines.
     non_actors = [rgp.userid for rgp in games[0].rgps
                   if rgp.userid != range_action.userid]
+    evs = _load_combo_evs(session, [game.gameid for game in games],
+                          non_actors, range_action.order)
+    updates = {}
     for hero in non_actors:
         # for each Hero combo
         #   establish weights of Villain's actions
         #   for each combo EV before this point
         #     update the combo EV with the weighted average from all games
-        options = HandRange(ranges[hero]).generate_options(board)
+        options = memo.options(ranges[hero], board)
         logging.debug('populating non-actor (userid %d) EV for %d combos',
                       hero, len(options))
+        others_ranges = {k: v for k, v in ranges.iteritems() if k != hero}
+        weights = _calculate_all_weights(memo, options, range_action,
+                                         others_ranges, board)
         for combo in options:
-            others_ranges = {k: v for k, v in ranges.iteritems()
-                             if k != hero}
-            result = _calculate_weights(combo, range_action, others_ranges,
-                                        board)
+            result = weights[combo]
             if result is None:
                 continue  # Hero never has this combo
             f, p, a = result  # weights summing to 1.0
             gf = gp = ga = None
-            for ar in action_results:
+            for game, ar in zip(games, action_results):
                 if ar.is_fold:
                     assert gf is None
-                    gf = ar.gameid
+                    gf = game.gameid
                 if ar.is_passive:
                     assert gp is None
-                    gp = ar.gameid
+                    gp = game.gameid
                 if ar.is_aggressive:
                     assert ga is None
-                    ga = ar.gameid
+                    ga = game.gameid
             combo_raw = _combo_to_mnemonic(combo)
-            _merge_non_actor_combo(session, games, hero, combo_raw,
+            _merge_non_actor_combo(evs, updates, hero, combo_raw,
                                    range_action.order, f, p, a, gf, gp, ga)
+    logging.debug('merged %d of %d non-actor combo EVs', len(updates),
+                  len(evs))
+    _update_combo_evs(session, updates)
 
 def merge_games(session, games):
     """
@@ -242,7 +461,7 @@ def merge_games(session, games):
                   [game.gameid for game in games])
     # hmm, this almost feels like it would generalise to more than three
     # branches, like if we allowed multiple betting sizes for a single action
-    histories = [[session.query(table).filter(table.gameid == game.gameid).all()
+    histories = [[session.query(table).filter(game.history_filter(table)).all()
                   for table in [GameHistoryActionResult,
                                 GameHistoryRangeAction,
                                 GameHistoryUserRange,
@@ -287,9 +506,152 @@ def merge_games(session, games):
     # each of their combos, and then, for every combo prior to this point in the
     # game tree, for each game, set the combo EV to be a weighted average of all
     # betting lines.
-    _merge_non_actor_ev(session, board, ranges, games, prev_range_action, items)
+    memo = OptionsMemo()
+    _merge_non_actor_ev(session, memo, board, ranges, games, prev_range_action,
+                        items)
+    memo.log_stats("merging games %r" % [game.gameid for game in games])
     session.commit()
 
+def analysis_seed(gameid):
+    """
+    Seed for the random numbers used in analysing this game
+    """
+    return (ANALYSIS_SEED * 1000003 + gameid) % 2 ** 32
+
+def _seed_random(seed):
+    """
+    Seed all the random number generators that analysis uses
+    """
+    random.seed(seed)
+    numpy.random.seed(seed)
+    py_wh_seed(seed)
+
+def _reseed_random():
+    """
+    Seed the random number generators unpredictably again, because they're
+    also used to deal cards
+    """
+    random.seed()
+    numpy.random.seed()
+    py_wh_seed(random.getrandbits(44))
+
+def _engine_parts(game, has_showdown):
+    """
+    The parts of the analysis engine (keys of ENGINE_VERSIONS) that analysing
+    this game uses
+    """
+    parts = ['core']
+    if has_showdown:
+        parts.append('showdown')
+    if len(game.rgps) > 2:
+        parts.append('multiway')
+    return parts
+
+def _history_values(row, excluded):
+    """
+    Column values of a history row, for hashing. Not the gameid, because a
+    spawned game's history rows can belong to an ancestor.
+    """
+    return {column.key: getattr(row, column.key)
+            for column in row.__table__.columns
+            if column.key != 'gameid' and column.key not in excluded}
+
+def analysis_input_hash(session, game):
+    """
+    SHA-1 (hex) of everything that analysing this game depends on: the
+    situation, the history, the versions of the parts of the engine it uses,
+    and the random seed.
+    """
+    history = []
+    has_showdown = False
+    for table, excluded in HASHED_HISTORY:
+        rows = session.query(table).filter(game.history_filter(table)).all()
+        if table is GameHistoryShowdown and rows:
+            has_showdown = True
+        history.extend(json.dumps([table.__tablename__,
+                                   _history_values(row, excluded)],
+                                  sort_keys=True)
+                       for row in rows)
+    history.sort()
+    situation = game.situation
+    inputs = {
+        'engine': {part: ENGINE_VERSIONS[part]
+                   for part in _engine_parts(game, has_showdown)},
+        'seed': analysis_seed(game.gameid),
+        'situation': [situation.board_raw, situation.current_round,
+                      situation.pot_pre],
+        'players': [[rgp.userid, player.range_raw, player.stack,
+                     player.contributed, player.left_to_act]
+                    for rgp, player in zip(game.rgps, situation.players)],
+        'history': history}
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+def analysis_is_current(session, game):
+    """
+    Has the game been analysed, from the same inputs as analysing it now would
+    use? If so, reanalysing it would give the same results.
+    """
+    if not game.analysis_performed:
+        return False
+    stored = session.query(AnalysisInputHash)  \
+        .filter(AnalysisInputHash.gameid == game.gameid).first()
+    return stored is not None and  \
+        stored.input_hash == analysis_input_hash(session, game)
+
+def delete_analysis(session, gameid):
+    """
+    Delete all analysis of this game, so that it can be analysed again.
+
+    Doesn't touch RunningGame.analysis_performed, and doesn't commit.
+    """
+    delete_results(session, gameid)
+    session.query(AnalysisCheckpoint)  \
+        .filter(AnalysisCheckpoint.gameid == gameid).delete()
+    session.query(AnalysisProfile)  \
+        .filter(AnalysisProfile.gameid == gameid).delete()
+    session.query(AnalysisFoldEquityItem)  \
+        .filter(AnalysisFoldEquityItem.gameid == gameid).delete()
+    session.query(AnalysisFoldEquity)  \
+        .filter(AnalysisFoldEquity.gameid == gameid).delete()
+    session.query(ShowdownComboEV)  \
+        .filter(ShowdownComboEV.gameid == gameid).delete()
+    session.query(GameHistoryShowdownEquity)  \
+        .filter(GameHistoryShowdownEquity.gameid == gameid)  \
+        .update({GameHistoryShowdownEquity.equity: None})
+    session.query(PaymentToPlayer)  \
+        .filter(PaymentToPlayer.gameid == gameid).delete()
+
+def delete_results(session, gameid):
+    """
+    Delete what finalising the analysis of this game creates (combo EVs and
+    participants' results), but not what was committed with its checkpoint.
+
+    Doesn't commit.
+    """
+    session.query(UserComboGameEV)  \
+        .filter(UserComboGameEV.gameid == gameid).delete()
+    session.query(UserComboOrderEV)  \
+        .filter(UserComboOrderEV.gameid == gameid).delete()
+    remove_game_results(session, gameid)
+    session.query(RunningGameParticipantResult)  \
+        .filter(RunningGameParticipantResult.gameid == gameid).delete()
+    session.query(AnalysisInputHash)  \
+        .filter(AnalysisInputHash.gameid == gameid).delete()
+
+def reset_analysis(session, gameid):
+    """
+    Clear anything committed by a previous failed attempt to analyse this game.
+    If there's a checkpoint, analysis continues from there, so only the results
+    of finalising are deleted.
+
+    Doesn't commit.
+    """
+    if session.query(AnalysisCheckpoint)  \
+            .filter(AnalysisCheckpoint.gameid == gameid).count():
+        delete_results(session, gameid)
+    else:
+        delete_analysis(session, gameid)
+
 class FoldEquityAccumulator(object):
     """
     Holds the data needed to calculate and create an AnalysisFoldEquity.
@@ -344,38 +706,60 @@ class FoldEquityAccumulator(object):
         afe.pot_if_called = self.pot_if_called
         return afe
 
-    def _create_afei(self, combo, is_agg=False, is_pas=False, is_fol=False):
+    def _fold_ratios(self, indices):
         """
-        Create an AnalaysisFoldEquityItem for a particular combo in Hero's range
+        Product of everyone's fold ratios (i.e. how often we take it down) for
+        each of these combos in Hero's range, as an array
         """
-        afei = AnalysisFoldEquityItem()
-        afei.gameid = self.gameid
-        afei.order = self.order
-        lower_card, higher_card = sorted(combo)
-        afei.higher_card = higher_card.to_mnemonic()
-        afei.lower_card = lower_card.to_mnemonic()
-        afei.is_aggressive = is_agg
-        afei.is_passive = is_pas
-        afei.is_fold = is_fol
-        afei.fold_ratio = 1.0
+        fold_ratios = numpy.ones(len(indices))
+        hero = COMBO_MASKS[indices][:, numpy.newaxis]
         for _, fold_range, nonfold_range in self.folds:
-            fold_size = len(fold_range.generate_options(
-                self.board + list(combo)))
-            nonfold_size = len(nonfold_range.generate_options(
-                self.board + list(combo)))
-            folder_fold_ratio = 1.0 * fold_size / (fold_size + nonfold_size)
-            afei.fold_ratio *= folder_fold_ratio
-            # product of everyone's fold ratios = how often we take it down
-        nonfold_ratio = 1.0 - afei.fold_ratio
-        afei.immediate_result = afei.fold_ratio * self.pot_before_bet -  \
-            nonfold_ratio * self.bet_cost
-        if nonfold_ratio and self.street != RIVER:
-            afei.semibluff_ev = -afei.immediate_result / nonfold_ratio
-            afei.semibluff_equity = afei.semibluff_ev / self.pot_if_called
-        else:
-            afei.semibluff_ev = None
-            afei.semibluff_equity = None
-        return afei
+            fold_sizes, nonfold_sizes = [
+                ((hero & COMBO_MASKS[options_to_indices(
+                    hand_range.generate_options(self.board))]
+                  [numpy.newaxis, :]) == 0).sum(axis=1)
+                for hand_range in [fold_range, nonfold_range]]
+            totals = fold_sizes + nonfold_sizes
+            if not totals.all():
+                raise ZeroDivisionError("Folder has no options against %r" %
+                                        ALL_COMBOS[indices[totals == 0][0]])
+            fold_ratios *= 1.0 * fold_sizes / totals
+        return fold_ratios
+
+    def _create_afeis(self, combos, is_agg=False, is_pas=False, is_fol=False):
+        """
+        Row values of an AnalaysisFoldEquityItem for each combo in a part of
+        Hero's range
+        """
+        if not combos:
+            return []
+        indices = options_to_indices(combos)
+        fold_ratios = self._fold_ratios(indices)
+        nonfold_ratios = 1.0 - fold_ratios
+        immediate_results = fold_ratios * self.pot_before_bet -  \
+            nonfold_ratios * self.bet_cost
+        semibluff = (nonfold_ratios != 0.0) & (self.street != RIVER)
+        semibluff_evs = numpy.zeros(len(combos))
+        semibluff_evs[semibluff] =  \
+            -immediate_results[semibluff] / nonfold_ratios[semibluff]
+        semibluff_equities = semibluff_evs / self.pot_if_called
+        rows = []
+        for i, combo in enumerate(combos):
+            lower_card, higher_card = sorted(combo)
+            rows.append({'gameid': self.gameid,
+                         'order': self.order,
+                         'higher_card': higher_card.to_mnemonic(),
+                         'lower_card': lower_card.to_mnemonic(),
+                         'is_aggressive': is_agg,
+                         'is_passive': is_pas,
+                         'is_fold': is_fol,
+                         'fold_ratio': float(fold_ratios[i]),
+                         'immediate_result': float(immediate_results[i]),
+                         'semibluff_ev': float(semibluff_evs[i])
+                                         if semibluff[i] else None,
+                         'semibluff_equity': float(semibluff_equities[i])
+                                             if semibluff[i] else None})
+        return rows
 
     def finalise(self, session):
         """
@@ -389,25 +773,23 @@ class FoldEquityAccumulator(object):
         assert len(self.potential_folders) == 0
         afe = self._create_afe()
         session.add(afe)
-        for combo in HandRange(self.range_action.aggressive_range)  \
-                .generate_options(self.board):
-            afei = self._create_afei(combo, is_agg=True)
-            session.add(afei)
-        for combo in HandRange(self.range_action.passive_range)  \
-                .generate_options(self.board):
-            afei = self._create_afei(combo, is_pas=True)
-            session.add(afei)
-        for combo in HandRange(self.range_action.fold_range)  \
-                .generate_options(self.board):
-            afei = self._create_afei(combo, is_fol=True)
-            session.add(afei)
-        logging.debug("gameid %d, FEA %d, finalised",
-                      self.gameid, self.order)
+        session.flush()  # items refer to it
+        rows = concatenate([
+            self._create_afeis(HandRange(self.range_action.aggressive_range)
+                               .generate_options(self.board), is_agg=True),
+            self._create_afeis(HandRange(self.range_action.passive_range)
+                               .generate_options(self.board), is_pas=True),
+            self._create_afeis(HandRange(self.range_action.fold_range)
+                               .generate_options(self.board), is_fol=True)])
+        _bulk_insert(session, AnalysisFoldEquityItem, rows)
+        logging.debug("gameid %d, FEA %d, finalised, %d items",
+                      self.gameid, self.order, len(rows))
         return afe
 
-class ComboOrderAccumulator(object):
+class ComboEVStore(object):
     """
-    Calculates combo EV for a point in the hand, as it's replayed.
+    Calculates combo EVs for one player, for points in the hand, as it's
+    replayed.
 
     The convention is that this number represents the EV before the event
     recorded at the given order. This really only makes a difference for vpip,
@@ -421,6 +803,17 @@ class ComboOrderAccumulator(object):
 
     Ideally we would delete these when a non-terminal betting line is not played
     out.
+
+    Each point in the hand (an order, or None for the whole game) is a row of
+    EV and factor arrays, indexed by combo index, and covers the combos in the
+    player's range at that point. Events apply to many combos at once, in every
+    row they're in. Showdowns also record an EV for just the showdown, which
+    isn't affected by later events.
+
+    The arrays have spare rows, and grow geometrically as orders are added.
+    Only the rows in use are pickled.
+
+    Events are only kept for the debug combo, if there is one.
     """
     EVENT_VPIP = 'vpip'
     EVENT_FOLD = 'fold'
@@ -430,147 +823,246 @@ class ComboOrderAccumulator(object):
     EVENT_SHOWDOWN_REDUCE = 'showdown-reduce'
 
     # TODO: 0: delete combos when non-terminal betting lines are not played out
-    def __init__(self, userid, combo, order):
+    def __init__(self, userid, indices, debug_index=None):
         self.userid = userid
-        self.combo = combo
-        self.order = order
-        self.ev = 0.0
-        self.factor = 1.0
-        self.events = []
-        self.track = True
-
-    def _log_failure(self):
-        """
-        An unexpected state occured, log events that led to it.
-        """
-        logging.error("Combo EV calculation error for userid=%r, combo=%r, "  \
-                      "order=%r, ev(so far)=%0.4f, factor(so far)=%0.4f, "  \
-                      "events follow...", self.userid, self.combo, self.order,
-                      self.ev, self.factor)
-        for event in self.events:
-            logging.error("%r", event)
-
-    def log_details(self):
-        """
-        Log events so far for this combo.
-        """
-        logging.info("Combo EV calculations for userid=%r, combo=%r, "  \
-                      "order=%r, ev=%0.4f, factor=%0.4f, "  \
-                      "events follow...", self.userid, self.combo, self.order,
-                      self.ev, self.factor)
-        for event in self.events:
-            logging.info("%r", event)
-
-    def vpip(self, order, contribution):
-        """
-        Combo voluntarily puts money in pot, to bet or call
-        """
-        self.events.append((self.EVENT_VPIP, order, self.ev, contribution))
-        try:
-            assert contribution > 0
-        except AssertionError:
-            self._log_failure()
-            raise
+        self.orders = []  # order of each row
+        self._ev = numpy.zeros((0, 1326))
+        self._factor = numpy.zeros((0, 1326))
+        self._present = numpy.zeros((0, 1326), dtype=bool)
+        self.showdowns = []  # (order, indices, evs) for just a showdown
+        self.debug_index = debug_index
+        self.events = {}  # map of row to events for the debug combo
+        self.add_order(None, indices)  # for the whole game
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in ['ev', 'factor', 'present']:
+            state[name] = state.pop('_' + name)[:len(self.orders)]
+        return state
+
+    def __setstate__(self, state):
+        for name in ['ev', 'factor', 'present']:
+            state['_' + name] = state.pop(name)
+        self.__dict__.update(state)
+
+    def get_ev(self):
+        """ EV of each row in use """
+        return self._ev[:len(self.orders)]
+    ev = property(get_ev)
+
+    def get_factor(self):
+        """ Factor of each row in use """
+        return self._factor[:len(self.orders)]
+    factor = property(get_factor)
+
+    def get_present(self):
+        """ Combos present in each row in use """
+        return self._present[:len(self.orders)]
+    present = property(get_present)
+
+    def _grow(self):
+        """
+        Make room for (at least) twice as many rows
+        """
+        rows = len(self.orders)
+        capacity = max(2 * rows, 8)
+        for name in ['_ev', '_factor', '_present']:
+            old = getattr(self, name)
+            new = numpy.zeros((capacity, 1326), dtype=old.dtype)
+            new[:rows] = old[:rows]
+            setattr(self, name, new)
+
+    def add_order(self, order, indices):
+        """
+        Start accumulating EV from this order, for these combos
+        """
+        row = len(self.orders)
+        if row == len(self._ev):
+            self._grow()
+        self._ev[row] = 0.0
+        self._factor[row] = 1.0
+        present = self._present[row]
+        present[:] = False
+        present[indices] = True
+        self.orders.append(order)
+        if self.debug_index is not None and present[self.debug_index]:
+            self.events[row] = []
+
+    def set_debug(self, debug_index):
+        """
+        Keep events for this combo from now on
+        """
+        self.debug_index = debug_index
+        if debug_index is not None:
+            for row in numpy.flatnonzero(self.present[:, debug_index]):
+                self.events.setdefault(row, [])
+
+    def _record(self, event, order, indices, *values):
+        """
+        Keep an event, if it applies to the debug combo
+        """
+        if self.debug_index is None:
+            return
+        where = numpy.flatnonzero(indices == self.debug_index)
+        if not len(where):
+            return
+        values = tuple(value[where[0]] if isinstance(value, numpy.ndarray)
+                       else value for value in values)
+        for row, events in self.events.iteritems():
+            events.append((event, order, self.ev[row, self.debug_index]) +
+                          values)
+
+    def _log_failure(self, index):
+        """
+        An unexpected state occured, log the state of this combo, and the events
+        that led to it (if we have them).
+        """
+        for row in numpy.flatnonzero(self.present[:, index]):
+            logging.error("Combo EV calculation error for userid=%r, "
+                          "combo=%r, order=%r, ev(so far)=%0.4f, "
+                          "factor(so far)=%0.4f, events follow...",
+                          self.userid, ALL_COMBOS[index], self.orders[row],
+                          self.ev[row, index], self.factor[row, index])
+            if index == self.debug_index:
+                for event in self.events.get(row, []):
+                    logging.error("%r", event)
+
+    def _check(self, indices, valid, need_factor=True):
+        """
+        Make sure the values for each combo are valid, and (if need_factor)
+        that the combo has factor remaining everywhere it's accumulating.
+
+        Logs the failures and raises AssertionError if not.
+        """
+        invalid = ~(numpy.ones(indices.shape, dtype=bool) & valid)
+        if need_factor:
+            invalid = invalid | (self.present[:, indices] &
+                                 ~(self.factor[:, indices] > 0.0)).any(axis=0)
+        if invalid.any():
+            for index in indices[invalid]:
+                self._log_failure(index)
+            raise AssertionError("Combo EV calculation error for userid=%r" %
+                                 (self.userid,))
+
+    def log_details(self, index):
+        """
+        Log events so far for this combo (which should be the debug combo).
+        """
+        for row in numpy.flatnonzero(self.present[:, index]):
+            logging.info("Combo EV calculations for userid=%r, combo=%r, "  \
+                         "order=%r, ev=%0.4f, factor=%0.4f, "  \
+                         "events follow...", self.userid, ALL_COMBOS[index],
+                         self.orders[row], self.ev[row, index],
+                         self.factor[row, index])
+            for event in self.events.get(row, []):
+                logging.info("%r", event)
+
+    def vpip(self, order, indices, contribution):
+        """
+        Combos voluntarily put money in pot, to bet or call
+        """
+        self._record(self.EVENT_VPIP, order, indices, contribution)
+        self._check(indices, contribution > 0, need_factor=False)
         # Factor may already be zero, e.g. in the case where from this combo's
         # perspective the hand has already finished - but this combo is still in
         # Hero's range for the rest of the game.
-        self.ev -= contribution * self.factor
+        self.ev[:, indices] -= contribution * self.factor[:, indices]
 
-    def fold(self, order):
+    def fold(self, order, indices):
         """
-        Combo folds. No more bets!
+        Combos fold. No more bets!
         """
-        self.events.append((self.EVENT_FOLD, order, self.ev))
+        self._record(self.EVENT_FOLD, order, indices)
         # Factor may already be zero, e.g. in the case where from this combo's
         # perspective the hand has already finished - but this combo is still in
         # Hero's range for the rest of the game.
-        self.factor = 0.0
+        self.factor[:, indices] = 0.0
 
-    def fold_equity(self, order, pot, weight):
+    def fold_equity(self, order, indices, pot, weights):
         """
-        Combo got folds and so wins pot (some of the time, at least)
+        Combos got folds and so win pot (some of the time, at least), with a
+        weight for each combo
         """
-        self.events.append(
-            (self.EVENT_FOLD_EQUITY, order, self.ev, pot, weight))
-        try:
-            assert self.factor > 0.0
-            assert pot > 0
-            assert weight >= 0.0
-            assert weight <= 1.0
-        except AssertionError:
-            self._log_failure()
-            raise
-        self.ev += pot * weight * self.factor
-        self.factor *= (1.0 - weight)
-
-    def showdown_call(self, order, contribution, weight):
-        """
-        Combo calls for a showdown that doesn't happen, with weight
-        """
-        self.events.append(
-            (self.EVENT_SHOWDOWN_CALL, order, self.ev, contribution, weight))
-        try:
-            assert self.factor > 0.0
-            assert contribution >= 0
-            assert weight >= 0.0
-            assert weight <= 1.0
-        except AssertionError:
-            self._log_failure()
-            raise
-        self.ev -= contribution * weight * self.factor
+        self._record(self.EVENT_FOLD_EQUITY, order, indices, pot, weights)
+        self._check(indices, (pot > 0) & (weights >= 0.0) & (weights <= 1.0))
+        self.ev[:, indices] += pot * weights * self.factor[:, indices]
+        self.factor[:, indices] *= (1.0 - weights)
+
+    def showdown_call(self, order, indices, contribution, weights):
+        """
+        Combos call for a showdown that doesn't happen, with weights
+        """
+        self._record(self.EVENT_SHOWDOWN_CALL, order, indices, contribution,
+                     weights)
+        self._check(indices,
+                    (contribution >= 0) & (weights >= 0.0) & (weights <= 1.0))
+        self.ev[:, indices] -= contribution * weights * self.factor[:, indices]
 
-    def showdown_ev(self, order, eq, pot, weight):
+    def showdown_ev(self, order, indices, eqs, pot, weights):
         """
-        Combo goes to showdown (some of the time, at least).
+        Combos go to showdown (some of the time, at least), with an equity and
+        weight for each combo.
 
         It can happen that there are two showdowns but only one (combined)
         reduce.
+
+        Also records an EV for just the showdown.
         """
-        self.events.append(
-            (self.EVENT_SHOWDOWN_EV, order, self.ev, eq, pot, weight))
-        try:
-            assert self.factor > 0.0
-            assert eq >= 0.0
-            assert eq <= 1.0
-            assert pot >= 0.0
-            assert weight >= 0.0
-            assert weight <= 1.0
-        except AssertionError:
-            self._log_failure()
-            raise
-        self.ev += eq * pot * weight * self.factor
-
-    def showdown_reduce(self, order, weight):
+        self._record(self.EVENT_SHOWDOWN_EV, order, indices, eqs, pot, weights)
+        self._check(indices, (eqs >= 0.0) & (eqs <= 1.0) & (pot >= 0.0) &
+                    (weights >= 0.0) & (weights <= 1.0))
+        self.ev[:, indices] += eqs * pot * weights * self.factor[:, indices]
+        self.showdowns.append((order, indices, eqs * pot))
+
+    def showdown_reduce(self, order, indices, weights):
         """
         After one or two showdowns, apply a single weight reduction for all of
         them.
         """
-        self.events.append((self.EVENT_SHOWDOWN_REDUCE, order, self.ev, weight))
-        try:
-            assert self.factor > 0.0
-            assert weight >= 0.0
-            assert weight <= 1.0
-        except AssertionError:
-            self._log_failure()
-            raise
-        self.factor *= (1.0 - weight)
+        self._record(self.EVENT_SHOWDOWN_REDUCE, order, indices, weights)
+        self._check(indices, (weights >= 0.0) & (weights <= 1.0))
+        self.factor[:, indices] *= (1.0 - weights)
+
+    def results(self):
+        """
+        (order, combo index, ev, factor) for everything accumulated
+        """
+        rows, indices = numpy.nonzero(self.present)
+        for row, index in zip(rows, indices):
+            yield (self.orders[row], index, self.ev[row, index],
+                   self.factor[row, index])
+        for order, indices, evs in self.showdowns:
+            for index, ev in zip(indices, evs):
+                yield order, index, ev, 0.0
 
 class AnalysisReplayer(object):
     """
     Plays through a hand, performs analysis, and creates analysis items in
     database.
+
+    Analysis can proceed as the game is played (advance), with the replayer's
+    state saved in an AnalysisCheckpoint after each step, and be completed when
+    the game finishes (analyse, then finalise).
     """
     #pylint:disable=W0201
+    # state saved in a checkpoint, in addition to fea and prev_range_action
+    CHECKPOINTED = ['pot', 'starting_pot', 'street', 'board', 'ranges',
+                    'stacks', 'contrib', 'remaining_userids', 'left_to_act',
+                    'combo_evs', 'fold_continues', 'passive_continues']
     def __init__(self, session, game, debug_combo=""):
         logging.debug("gameid %d, AnalysisReplayer, initialising",
                       game.gameid)
-        if not game.game_finished:
-            raise ValueError("Can't analyse game until finished.")
         if game.analysis_performed:
             raise ValueError("Game is already analysed.")
         self.session = session
         self.game = game
         self.debug_combo = frozenset(Card.many_from_text(debug_combo))
+        self.debug_index = combo_index(self.debug_combo)  \
+            if self.debug_combo else None
+        self.checkpoint_order = None  # order of the checkpoint we loaded
+        self.memo = OptionsMemo()  # not checkpointed
+        self.profiler = AnalysisProfiler()  # not checkpointed
+        self.seed = analysis_seed(game.gameid)
         self.pot = self.game.situation.pot_pre +  \
             sum([p.contributed for p in self.game.situation.players])
         self.starting_pot = self.pot
@@ -591,128 +1083,79 @@ class AnalysisReplayer(object):
         self.left_to_act = [self.game.rgps[i].userid
                             for i in range(len(self.game.situation.players))
                             if self.game.situation.players[i].left_to_act]
-        # map of userid to (map of combo to (set of ComboOrderAccumulator))
-        self.combo_orders = {
-            self.game.rgps[i].userid: {
-                combo: set([ComboOrderAccumulator(self.game.rgps[i].userid,
-                                                  combo,
-                                                  None)])  # for the whole game
-                for combo in HandRange(self.ranges[self.game.rgps[i].userid])  \
-                    .generate_options(self.board)
-            }
-            for i in range(len(self.game.situation.players))
+        # map of userid to ComboEVStore
+        self.combo_evs = {
+            rgp.userid: ComboEVStore(rgp.userid,
+                                     self.memo.indices(self.ranges[rgp.userid],
+                                                       self.board),
+                                     self.debug_index)
+            for rgp in self.game.rgps
         }
 
-    def _new_combo_ev(self, userid, combo, order):
+    def _add(self, row):
         """
-        Add a single new ComboOrderAccumulator
+        Add a row to the session, counting it
         """
-        combo_map = self.combo_orders[userid]
-        cev = ComboOrderAccumulator(userid, combo, order)
-        combo_map[combo].add(cev)
-        return cev
+        self.session.add(row)
+        self.profiler.count(rows=1)
 
-    def _new_combo_evs(self, userid, range_, order):
+    def _new_combo_evs(self, userid, range_raw, order):
         """
-        Add new ComboOrderAccumulator items for new game node
+        Start accumulating combo EVs for new game node
         """
-        combo_map = self.combo_orders[userid]
-        combos = range_.generate_options(self.board)
-        for combo in combos:
-            combo_map[combo].add(ComboOrderAccumulator(userid, combo, order))
+        indices = self.memo.indices(range_raw, self.board)
+        self.profiler.count(combos=len(indices))
+        self.combo_evs[userid].add_order(order, indices)
 
-    def _combo_vpips(self, order, userid, range_, contribution):
+    def _combo_vpips(self, order, userid, range_raw, contribution):
         """
         Apply vpip to Hero's combos
         """
-        combo_map = self.combo_orders[userid]
-        combos = range_.generate_options(self.board)
-        for combo in combos:
-            for ev in combo_map[combo]:
-                if ev.track:
-                    ev.vpip(order, contribution)
-
-    def _combo_fold_equity(self, order, userid, combo, pot, weight):
-        """
-        Apply a fold equity payment for a combo
-        """
-        for ev in self.combo_orders[userid][combo]:
-            if ev.track:
-                ev.fold_equity(order, pot, weight)
+        indices = self.memo.indices(range_raw, self.board)
+        self.profiler.count(combos=len(indices))
+        self.combo_evs[userid].vpip(order, indices, contribution)
 
     def _all_combos_fold(self, order, userid, fold_range):
         """
         Reduce weight to zero for all combos, they're done
         """
-        combos = HandRange(fold_range).generate_options(self.board)
-        for combo in combos:
-            for ev in self.combo_orders[userid][combo]:
-                if ev.track:
-                    ev.fold(order)
-
-    def _fold_ratio(self, bettor_combo, all_combos, folding_combos):
-        """
-        How often does folder fold when bettor holds combo?
-        """
-        count_all = 0
-        count_folds = 0
-        for combo in all_combos:
-            if len(combo.union(bettor_combo)) == 4:
-                count_all += 1
-                if combo in folding_combos:
-                    count_folds += 1
-        if count_all:
-            return 1.0 * count_folds / count_all
-        else:
-            return None
-
-    def _all_combos_fold_equity(self, order, range_action, folder, nonfolder):
-        """
-        Unique fold equity payment for each combo of bettor's range.
-
-        Note that folding has no effect on folder's combo EV.
-        """
-        bettor = HandRange(self.ranges[nonfolder])
-        folder = HandRange(self.ranges[folder])
-        folding = HandRange(range_action.fold_range)
-        bettor_combos = bettor.generate_options(self.board)
-        folder_combos = folder.generate_options(self.board)
-        folding_combos = folding.generate_options(self.board)
-        for combo in bettor_combos:
-            fold_ratio = self._fold_ratio(combo, folder_combos, folding_combos)
-            if fold_ratio is not None:
-                self._combo_fold_equity(order, nonfolder, combo, self.pot,
-                                        fold_ratio)
+        indices = self.memo.indices(fold_range, self.board)
+        self.profiler.count(combos=len(indices))
+        self.combo_evs[userid].fold(order, indices)
 
-    def _combo_showdown_ev(self, order, userid, combo, eq, pot, weight):
+    def _fold_ratios(self, bettor_indices, all_indices, folding_indices):
         """
-        Apply a showdown payment for a combo, but no weight reduction.
+        How often does folder fold when bettor holds each combo?
 
-        Also creates a new combo EV for just the showdown.
+        Returns an array of fold ratios, and an array of whether each ratio is
+        valid (i.e. folder has any combos when bettor holds that combo).
         """
-        for ev in self.combo_orders[userid][combo]:
-            if ev.track:
-                ev.showdown_ev(order, eq, pot, weight)
-        new_ev = self._new_combo_ev(userid, combo, order)
-        new_ev.showdown_ev(order, eq, pot, 1.0)
-        new_ev.showdown_reduce(order, 1.0)
-        new_ev.track = False
+        compatible = (COMBO_MASKS[bettor_indices][:, numpy.newaxis] &
+                      COMBO_MASKS[all_indices][numpy.newaxis, :]) == 0
+        folds = numpy.in1d(all_indices, folding_indices)
+        count_all = compatible.sum(axis=1)
+        count_folds = compatible[:, folds].sum(axis=1)
+        valid = count_all > 0
+        ratios = numpy.zeros(len(bettor_indices))
+        ratios[valid] = 1.0 * count_folds[valid] / count_all[valid]
+        return ratios, valid
 
-    def _combo_showdown_call(self, order, userid, combo, contribution, weight):
-        """
-        Apply a showdown call contribution, but no weight reduction
+    def _all_combos_fold_equity(self, order, range_action, folder, nonfolder):
         """
-        for ev in self.combo_orders[userid][combo]:
-            if ev.track:
-                ev.showdown_call(order, contribution, weight)
+        Unique fold equity payment for each combo of bettor's range.
 
-    def _combo_showdown_reduce(self, order, userid, combo, weight):
-        """
-        Apply weight reduction after al the showdowns for an action.
+        Note that folding has no effect on folder's combo EV.
         """
-        for ev in self.combo_orders[userid][combo]:
-            if ev.track:
-                ev.showdown_reduce(order, weight)
+        bettor_indices = self.memo.indices(self.ranges[nonfolder], self.board)
+        self.profiler.count(combos=len(bettor_indices))
+        if not len(bettor_indices):
+            return
+        ratios, valid = self._fold_ratios(
+            bettor_indices,
+            self.memo.indices(self.ranges[folder], self.board),
+            self.memo.indices(range_action.fold_range, self.board))
+        self.combo_evs[nonfolder].fold_equity(order, bettor_indices[valid],
+                                              self.pot, ratios[valid])
 
     def _one_combo_one_showdown(self, combo, board, ranges):
         """
@@ -720,37 +1163,43 @@ class AnalysisReplayer(object):
         """
         if len(ranges) == 1:
             # we can do exact calculations
-            villain = HandRange(ranges.values()[0])
-            if not villain.generate_options(board + list(combo)):
+            villain = self.memo.range(ranges.values()[0])
+            size = self.memo.size_vs_combo(villain.description, combo, board)
+            if not size:
                 # sorry bro, this never happens
                 return None
             elif len(board) == 5:
                 eq = py_hand_vs_range_exact(combo, villain, board)
+                self.profiler.count(equity_calls=1, iterations=size)
                 if eq is None:
                     logging.warning("_one_combo_one_showdown, heads up, river, "
                         "combo %r has %d options but equity None.", combo,
-                        len(villain.generate_options(board + list(combo))))
+                        size)
             else:
                 eq = py_hand_vs_range_monte_carlo(combo, villain, board, 10000)
+                self.profiler.count(equity_calls=1, iterations=10000)
                 if eq is None:
                     logging.warning("_one_combo_one_showdown, heads up, all in "
                         "(not river), combo %r has %d options but equity None.",
-                        combo, len(villain.generate_options(board + list(combo))))
+                        combo, size)
         else:
             # we must simulate
-            players_options = {k: HandRange(v).generate_options(board)
-                               for k, v in ranges.iteritems()}
-            total = 0
+            players = ranges.keys()
+            dealt = deal_indices(
+                [self.memo.indices(ranges[player], board)
+                 for player in players],
+                1000 * len(ranges),
+                excluded=combo)
+            self.profiler.count(equity_calls=1, iterations=len(dealt))
+            total = len(dealt)
             wins = 0.0
-            for _i in xrange(1000 * len(ranges)):
-                dealt = {None: combo}  # showdown requires a key, we'll use None
-                for player, options in players_options.iteritems():
-                    dealt[player] = random.choice(options)
-                if _impossible_deal(dealt.values()):
-                    continue
-                total += 1
+            for row in dealt:
+                # showdown requires a key, we'll use None for Hero
+                hands = {player: ALL_COMBOS[index]
+                         for player, index in zip(players, row)}
+                hands[None] = combo
                 # and see who wins!
-                _shown_down, winners = run_it_once(board, dealt, {})
+                _shown_down, winners = run_it_once(board, hands, {})
                 if None in winners:  # key for Hero, from before
                     wins += 1.0 / len(winners)
             eq = wins / total if total else None
@@ -781,23 +1230,27 @@ class AnalysisReplayer(object):
         if len(ranges) == 1:
             # we can do exact calculations
             # start with weights, exactly
-            f = _range_size_vs_combo(item.fold_range, combo, board)
-            p = _range_size_vs_combo(item.passive_range, combo, board)
-            a = _range_size_vs_combo(item.aggressive_range, combo, board)
+            f = _range_size_vs_combo(self.memo, item.fold_range, combo, board)
+            p = _range_size_vs_combo(self.memo, item.passive_range, combo,
+                                     board)
+            a = _range_size_vs_combo(self.memo, item.aggressive_range, combo,
+                                     board)
             total = f + p + a
             c_weight = 1.0 * p / total if total else None
             r_weight = 1.0 * a / total if total else None
-            villain = HandRange(item.passive_range)
+            villain = self.memo.range(item.passive_range)
             if c_weight is None or c_weight == 0.0:
                 c_eq = None
             elif len(board) == 5:
                 c_eq = py_hand_vs_range_exact(combo, villain, board)
+                self.profiler.count(equity_calls=1, iterations=p)
                 if c_eq is None:
                     logging.warning("_one_combo_both_showdowns, heads up, "
                         "river, combo %r has weight %r but equity None.",
                         combo, c_weight)
             else:
                 c_eq = py_hand_vs_range_monte_carlo(combo, villain, board, 1000)
+                self.profiler.count(equity_calls=1, iterations=1000)
                 if c_eq is None:
                     logging.warning("_one_combo_both_showdowns, heads up, "
                         "all in (not river), combo %r has weight %r but equity "
@@ -805,49 +1258,32 @@ class AnalysisReplayer(object):
         else:
             # this is the only scenario where a combos gets multiple showdowns
             # we must simulate
-            players_options = {k: HandRange(v).generate_options(board)
-                               for k, v in ranges.iteritems()}
-            last_f = HandRange(item.fold_range).generate_options(board)
-            last_p = HandRange(item.passive_range).generate_options(board)
-            last_a = HandRange(item.aggressive_range).generate_options(board)
-            f = p = a = 0  # count of times we hit the fold, the call, the raise
-            wins_f = wins_p = 0.0  # wins in the fold showdown, call showdown
-            for _ in xrange(1000 * len(ranges)):
-                dealt = {None: combo}  # showdown requires a key, we'll use None
-                # we actually deal to all remaining players here, and use that
-                # deal to decide if it's the first showdown (because last player
-                # folds) or the second showdown (because last player calls), or
-                # no showdown (because they raise).
-                for player, options in players_options.iteritems():
-                    dealt[player] = random.choice(options)
-                if _impossible_deal(dealt.values()):
-                    continue
-                if dealt[item.userid] in last_f:
-                    # we have a non-passive showdown
-                    f += 1
-                    dealt.pop(item.userid)
-                    assert len(dealt) >= 2
-                    _shown_down, winners = run_it_once(board, dealt, {})
-                    if None in winners:  # key for Hero, from before
-                        wins_f += 1.0 / len(winners)
-                elif dealt[item.userid] in last_p:
-                    # we have a passive showdown
-                    p += 1
-                    _shown_down, winners = run_it_once(board, dealt, {})
-                    if None in winners:  # key for Hero, from before
-                        wins_p += 1.0 / len(winners)
-                else:
-                    # we have no showdown
-                    assert dealt[item.userid] in last_a
-                    a += 1
-            total = f + p + a
-            f_eq = wins_f / f if f else None
-            c_eq = wins_p / p if p else None
-            f_weight = 1.0 * f / total if total else None
-            c_weight = 1.0 * p / total if total else None
-            r_weight = 1.0 * a / total if total else None
+            f_eq, c_eq, f_weight, c_weight, r_weight = \
+                self._multiway_both_showdowns(item, [combo], board, ranges)[0]
         return f_eq, c_eq, f_weight, c_weight, r_weight
 
+    def _multiway_both_showdowns(self, item, combos, board, ranges):
+        """
+        The multiway case of _one_combo_both_showdowns, for many combos at
+        once.
+
+        We deal to all remaining players, and use that deal to decide if it's
+        the first showdown (because the last player folds) or the second
+        showdown (because the last player calls), or no showdown (because they
+        raise). The dealing and the showdowns run in the compiled evaluator,
+        for every combo in one call.
+        """
+        others = [self.memo.options(ranges[player], board)
+                  for player in ranges if player != item.userid]
+        self.profiler.count(equity_calls=1,
+                            iterations=1000 * len(ranges) * len(combos))
+        return py_all_hands_both_showdowns(
+            combos, others,
+            self.memo.options(item.fold_range, board),
+            self.memo.options(item.passive_range, board),
+            self.memo.options(item.aggressive_range, board),
+            board, 1000 * len(ranges))
+
     def _one_player_both_showdowns(self, item, userid, others, pot, call_cost,
                                    board, ranges, fold_order, call_order):
         """
@@ -862,43 +1298,61 @@ class AnalysisReplayer(object):
                           call_order, ranges, item.fold_range,
                           item.passive_range, item.aggressive_range)
         other_ranges = {k: v for k, v in ranges.iteritems() if k != userid}
-        combos = HandRange(ranges[userid]).generate_options(board)
-        for combo in combos:
-            eq_fold, eq_call, w_fold, w_call, w_raise = \
-                self._one_combo_both_showdowns(item=item,
-                                               combo=combo,
-                                               board=board,
-                                               ranges=other_ranges)
-            if len(others) == 1:
-                # from this combo's perspective, the call only happens sometimes
-                if w_call:
+        combos = self.memo.options(ranges[userid], board)
+        self.profiler.count(combos=len(combos))
+        if len(other_ranges) > 1:
+            results = self._multiway_both_showdowns(item, combos, board,
+                                                    other_ranges)
+        else:
+            results = [self._one_combo_both_showdowns(item=item,
+                                                      combo=combo,
+                                                      board=board,
+                                                      ranges=other_ranges)
+                       for combo in combos]
+        indices = self.memo.indices(ranges[userid], board)
+        store = self.combo_evs[userid]
+        if len(others) == 1:
+            # from this combo's perspective, the call only happens sometimes
+            calls = []
+            for index, result in zip(indices, results):
+                _eq_fold, eq_call, _w_fold, w_call, w_raise = result
+                if w_call and eq_call is not None:
                     # heads up, we already got fold equity paid and reduced,
                     if w_raise:
                         weight = w_call / (w_call + w_raise)
                     else:
                         weight = 1.0
-                    if eq_call is not None:
-                        self._combo_showdown_ev(call_order, userid, combo,
-                            eq_call, pot + call_cost, weight)
-                        # now reduce to residual aggressive line.
-                        self._combo_showdown_reduce(call_order, userid, combo,
-                                                    weight)
-            else:
-                if w_fold and eq_fold is not None:
-                    self._combo_showdown_ev(fold_order, userid, combo,
-                                            eq_fold, pot, w_fold)
-                if w_call and eq_call is not None:
-                    self._combo_showdown_ev(call_order, userid, combo,
-                                            eq_call, pot + call_cost, w_call)
-                # There's no fold equity in this situation.
-                # Reduce for both showdowns, residual is weight of the
-                # aggressive line.
-                if w_raise:
-                    weight = 1.0 - w_raise
-                else:
-                    weight = 1.0
-                self._combo_showdown_reduce(max(fold_order, call_order),
-                                            userid, combo, weight)
+                    calls.append((index, eq_call, weight))
+            if calls:
+                call_indices, eqs, weights = [numpy.array(column)
+                                              for column in zip(*calls)]
+                store.showdown_ev(call_order, call_indices, eqs,
+                                  pot + call_cost, weights)
+                # now reduce to residual aggressive line.
+                store.showdown_reduce(call_order, call_indices, weights)
+        else:
+            folds = [(index, result[0], result[2])
+                     for index, result in zip(indices, results)
+                     if result[2] and result[0] is not None]
+            if folds:
+                fold_indices, eqs, weights = [numpy.array(column)
+                                              for column in zip(*folds)]
+                store.showdown_ev(fold_order, fold_indices, eqs, pot, weights)
+            calls = [(index, result[1], result[3])
+                     for index, result in zip(indices, results)
+                     if result[3] and result[1] is not None]
+            if calls:
+                call_indices, eqs, weights = [numpy.array(column)
+                                              for column in zip(*calls)]
+                store.showdown_ev(call_order, call_indices, eqs,
+                                  pot + call_cost, weights)
+            # There's no fold equity in this situation.
+            # Reduce for both showdowns, residual is weight of the
+            # aggressive line.
+            weights = numpy.array([1.0 - result[4] if result[4] else 1.0
+                                   for result in results])
+            store.showdown_reduce(max(fold_order, call_order), indices,
+                                  weights)
 
     def _one_player_one_showdown(self, order, userid, pot, call_cost,
                                  board, passive_range, ranges):
@@ -911,19 +1365,26 @@ class AnalysisReplayer(object):
                           "userid=%r, passive_range=%r, ranges=%r",
                           order, userid, passive_range, ranges)
         other_ranges = {k: v for k, v in ranges.iteritems() if k != userid}
-        combos = HandRange(passive_range).generate_options(board)
-        for combo in combos:
+        combos = self.memo.options(passive_range, board)
+        self.profiler.count(combos=len(combos))
+        showdowns = []
+        for combo, index in zip(combos,
+                                self.memo.indices(passive_range, board)):
             eq = self._one_combo_one_showdown(
                 combo=combo,
                 board=board,
                 ranges=other_ranges)
-            if eq is None:
-                continue
-            self._combo_showdown_call(order, userid, combo, call_cost, 1.0)
-            self._combo_showdown_ev(order, userid, combo,
-                                    eq, pot + call_cost, 1.0)
-            self._combo_showdown_reduce(order, userid, combo, 1.0)
+            if eq is not None:
+                showdowns.append((index, eq))
+        if not showdowns:
+            return
+        indices, eqs = [numpy.array(column) for column in zip(*showdowns)]
+        store = self.combo_evs[userid]
+        store.showdown_call(order, indices, call_cost, 1.0)
+        store.showdown_ev(order, indices, eqs, pot + call_cost, 1.0)
+        store.showdown_reduce(order, indices, 1.0)
 
+    @profiled("combo_showdowns")
     def _all_combos_both_showdowns(self, item, other_userids, pot, call_cost,
                                    board, ranges, has_fold, has_call):
         """
@@ -954,6 +1415,7 @@ class AnalysisReplayer(object):
             passive_range=item.passive_range,
             ranges=ranges)
 
+    @profiled("process_board")
     def process_board(self, item):
         """
         Process a GameHistoryBoard
@@ -964,12 +1426,13 @@ class AnalysisReplayer(object):
         self.street = item.street
         self.board = Card.many_from_text(item.cards)
 
+    @profiled("process_action_result")
     def process_action_result(self, item):
         """
         Process a GameHistoryActionResult
         """
         self._new_combo_evs(userid=item.userid,
-                            range_=HandRange(self.ranges[item.userid]),
+                            range_raw=self.ranges[item.userid],
                             order=item.order)
         if item.is_fold:
             self.remaining_userids.remove(item.userid)
@@ -1035,21 +1498,22 @@ class AnalysisReplayer(object):
             return
         self._combo_vpips(action_item.order,
                           action_item.userid,
-                          HandRange(action_range),
+                          action_range,
                           contribution)
         amount = -action_item.factor * contribution
         logging.debug('gameid %d, order %d, userid %d, pot payment: '
                       'factor %0.4f * contribution %d = amount %0.8f',
-                      action_item.gameid, action_item.order, action_item.userid,
+                      self.game.gameid, action_item.order, action_item.userid,
                       action_item.factor, contribution, amount)
         payment = PaymentToPlayer()
         payment.reason = PaymentToPlayer.REASON_POT
-        payment.gameid = action_item.gameid
+        payment.gameid = self.game.gameid
         payment.order = action_item.order
         payment.userid = action_item.userid
         payment.amount = amount
-        self.session.add(payment)
+        self._add(payment)
 
+    @profiled("fold_equity_payments")
     def fold_equity_payments(self, range_action, fold_ratio):
         """
         Fold equity payment occurs for every range action with only two players
@@ -1071,7 +1535,7 @@ class AnalysisReplayer(object):
         if not fold_ratio:
             logging.debug('gameid %d, order %d, fold ratio 0.0, '
                           'skipping fold equity payments',
-                          range_action.gameid, range_action.order)
+                          self.game.gameid, range_action.order)
             return
         amount = self.pot * range_action.factor * fold_ratio
         assert range_action.userid in self.remaining_userids
@@ -1081,70 +1545,70 @@ class AnalysisReplayer(object):
             nonfolder = self.remaining_userids[0]
         logging.debug('gameid %d, order %d, userid %d, fold equity payment: '
                       'pot %d * factor %0.4f * fold ratio %0.4f = amount %0.8f',
-                      range_action.gameid, range_action.order,
+                      self.game.gameid, range_action.order,
                       nonfolder,
                       self.pot, range_action.factor, fold_ratio, amount)
         nonfolder_payment = PaymentToPlayer()
         nonfolder_payment.reason = PaymentToPlayer.REASON_FOLD_EQUITY
-        nonfolder_payment.gameid = range_action.gameid
+        nonfolder_payment.gameid = self.game.gameid
         nonfolder_payment.order = range_action.order
         nonfolder_payment.userid = nonfolder
         nonfolder_payment.amount = amount
-        self.session.add(nonfolder_payment)
+        self._add(nonfolder_payment)
         self._all_combos_fold_equity(range_action.order,
                                      range_action,
                                      folder=range_action.userid,
                                      nonfolder=nonfolder)
 
-    def showdown_payments(self, showdown, equities):
+    def showdown_payments(self, showdown, userids, equity_map):
         """
         Create showdown payments for all participants of this showdown.
         """
         logging.debug('gameid %d, order %d, creating showdown payments',
-                      showdown.gameid, showdown.order)
-        for participant in equities:
+                      self.game.gameid, showdown.order)
+        for userid in userids:
             payment = PaymentToPlayer()
             payment.reason = PaymentToPlayer.REASON_SHOWDOWN
-            payment.gameid = showdown.gameid
+            payment.gameid = self.game.gameid
             payment.order = showdown.order
-            payment.userid = participant.userid
-            payment.amount = showdown.factor * showdown.pot * participant.equity
+            payment.userid = userid
+            payment.amount = showdown.factor * showdown.pot * equity_map[userid]
             logging.debug('gameid %d, order %d, userid %d, showdown payment: '
                           'factor %0.4f * pot %d * equity %0.4f = '
                           'amount %0.8f',
-                          showdown.gameid, showdown.order, participant.userid,
-                          showdown.factor, showdown.pot, participant.equity,
+                          self.game.gameid, showdown.order, userid,
+                          showdown.factor, showdown.pot, equity_map[userid],
                           payment.amount)
-            self.session.add(payment)
+            self._add(payment)
             # and redline and blueline
             total_contrib = showdown.factor *  \
-                (showdown.pot - self.starting_pot) / len(equities)
+                (showdown.pot - self.starting_pot) / len(userids)
             payment = PaymentToPlayer()
             payment.reason = PaymentToPlayer.REASON_REDLINE
-            payment.gameid = showdown.gameid
+            payment.gameid = self.game.gameid
             payment.order = showdown.order
-            payment.userid = participant.userid
+            payment.userid = userid
             payment.amount = total_contrib
             logging.debug('gameid %d, order %d, userid %d, redline payment: '
                           'factor %0.4f * (pot %d - start %d) / people %d = '
                           'amount %0.8f',
-                          showdown.gameid, showdown.order, participant.userid,
+                          self.game.gameid, showdown.order, userid,
                           showdown.factor, showdown.pot, self.starting_pot,
-                          len(equities), payment.amount)
-            self.session.add(payment)
+                          len(userids), payment.amount)
+            self._add(payment)
             payment = PaymentToPlayer()
             payment.reason = PaymentToPlayer.REASON_BLUELINE
-            payment.gameid = showdown.gameid
+            payment.gameid = self.game.gameid
             payment.order = showdown.order
-            payment.userid = participant.userid
+            payment.userid = userid
             payment.amount = -total_contrib
             logging.debug('gameid %d, order %d, userid %d, blueline payment: '
                           '-factor %0.4f * (pot %d - start %d) / people %d = '
                           'amount %0.8f',
-                          showdown.gameid, showdown.order, participant.userid,
+                          self.game.gameid, showdown.order, userid,
                           showdown.factor, showdown.pot, self.starting_pot,
-                          len(equities), payment.amount)
-            self.session.add(payment)
+                          len(userids), payment.amount)
+            self._add(payment)
 
     def showdown_call(self, gameid, order, caller, call_cost, call_ratio,
                       factor):
@@ -1164,14 +1628,15 @@ class AnalysisReplayer(object):
             'amount %0.8f',
             gameid, order, caller, call_cost, factor, call_ratio,
             payment.amount)
-        self.session.add(payment)
+        self._add(payment)
 
+    @profiled("analyse_showdown")
     def analyse_showdown(self, ranges, order, is_passive, userids):
         """
         Create a showdown with given userids. Pre-river if pre-river.
         """
         showdowns = self.session.query(GameHistoryShowdown)  \
-            .filter(GameHistoryShowdown.gameid == self.game.gameid)  \
+            .filter(self.game.history_filter(GameHistoryShowdown))  \
             .filter(GameHistoryShowdown.order == order)  \
             .filter(GameHistoryShowdown.is_passive == is_passive).all()
         if len(showdowns) != 1:
@@ -1194,11 +1659,26 @@ class AnalysisReplayer(object):
         range_map = {k: v for k, v in ranges.iteritems() if k in userids}
         assert self.board == self.game.board
         equity_map, iterations = showdown_equity(range_map, self.game.board)
+        self.profiler.count(equity_calls=1, iterations=iterations)
         logging.debug('gameid %d, order %d, is_passive %r, factor %0.8f, '
                       'showdown with userids: %r, equity: %r '
                       '(iterations %d)',
                       self.game.gameid, order, is_passive, showdown.factor,
                       userids, equity_map, iterations)
+        if showdown.gameid == self.game.gameid:
+            self.record_showdown_equities(showdown, userids, equity_map)
+        # Otherwise the showdown belongs to an ancestor, whose own analysis
+        # records its equities. This game's equities are only used for its
+        # payments.
+        self.showdown_payments(showdown=showdown, userids=userids,
+                               equity_map=equity_map)
+        self.showdown_combo_evs(showdown=showdown, ranges=range_map,
+                                userids=userids)
+
+    def record_showdown_equities(self, showdown, userids, equity_map):
+        """
+        Record each participant's equity in the showdown.
+        """
         existing_equities = {p.showdown_order: p
             for p in showdown.participants}  #pylint:disable=no-member
         for showdown_order, userid in enumerate(userids):
@@ -1209,16 +1689,33 @@ class AnalysisReplayer(object):
                 # TODO: REVISIT: this is ordered by situation player order,
                 # not showdown order
                 participant = GameHistoryShowdownEquity()
-                self.session.add(participant)
-                existing_equities[showdown_order] = participant
-                participant.gameid = self.game.gameid
-                participant.order = order
-                participant.is_passive = is_passive
+                self._add(participant)
+                participant.gameid = showdown.gameid
+                participant.order = showdown.order
+                participant.is_passive = showdown.is_passive
                 participant.showdown_order = showdown_order
                 participant.userid = userid
             participant.equity = equity_map[userid]
-        self.showdown_payments(showdown=showdown,
-                               equities=existing_equities.values())
+
+    @profiled("showdown_combo_evs")
+    def showdown_combo_evs(self, showdown, ranges, userids):
+        """
+        Record EV of every combo for each player in the showdown, so that the
+        showdown page doesn't need to calculate it.
+        """
+        results = all_combos_ev(board=self.board, userids=userids,
+                                pot=showdown.pot, all_ranges=ranges)
+        rows = [{'gameid': self.game.gameid,
+                 'order': showdown.order,
+                 'userid': userid,
+                 'combo': combo,
+                 'ev': ev}
+                for userid, combos_and_ev in results
+                for combo, ev in combos_and_ev]
+        self.profiler.count(equity_calls=1, combos=len(rows), rows=len(rows))
+        _bulk_insert(self.session, ShowdownComboEV, rows)
+        logging.debug("gameid %d, order %d, recorded showdown combo EVs",
+                      self.game.gameid, showdown.order)
 
     def _calculate_call_cost(self, userid):
         """
@@ -1228,6 +1725,7 @@ class AnalysisReplayer(object):
         """
         return max(self.contrib.values()) - self.contrib[userid]
 
+    @profiled("range_action_showdowns")
     def range_action_showdowns(self, item, fold_ratio, call_ratio,
             fold_combos, passive_combos, aggressive_combos):
         """
@@ -1275,7 +1773,7 @@ class AnalysisReplayer(object):
         if has_fold:
             # this player folds, but the pot is contested, so we have a showdown
             order += 1
-            ranges = {key: HandRange(txt)
+            ranges = {key: self.memo.range(txt)
                       for key, txt in self.ranges.iteritems()}
             # They (temporarily) fold
             ranges.pop(item.userid)
@@ -1285,15 +1783,15 @@ class AnalysisReplayer(object):
                 userids=[userid for userid in self.remaining_userids
                          if userid != item.userid])
 
-        ranges = {key: HandRange(txt)
+        ranges = {key: self.memo.range(txt)
                   for key, txt in self.ranges.iteritems()}
         # They (temporarily) call
-        ranges[item.userid] = HandRange(item.passive_range)
+        ranges[item.userid] = self.memo.range(item.passive_range)
         if has_call:
             # It's a real call, not folding 100%
             order += 1
             if call_cost != 0:
-                self.showdown_call(gameid=item.gameid, order=order,
+                self.showdown_call(gameid=self.game.gameid, order=order,
                     caller=item.userid, call_cost=call_cost,
                     call_ratio=call_ratio, factor=item.factor)
             self.analyse_showdown(ranges=ranges,
@@ -1301,19 +1799,20 @@ class AnalysisReplayer(object):
                 is_passive=True,
                 userids=self.remaining_userids)
 
+    @profiled("process_range_action")
     def process_range_action(self, item):
         """
         Process a GameHistoryRangeAction
         """
         self._new_combo_evs(userid=item.userid,
-                            range_=HandRange(self.ranges[item.userid]),
+                            range_raw=self.ranges[item.userid],
                             order=item.order)
         self._all_combos_fold(order=item.order,
                               userid=item.userid,
                               fold_range=item.fold_range)
-        fol = HandRange(item.fold_range).generate_options(self.board)
-        pas = HandRange(item.passive_range).generate_options(self.board)
-        agg = HandRange(item.aggressive_range).generate_options(self.board)
+        fol = self.memo.options(item.fold_range, self.board)
+        pas = self.memo.options(item.passive_range, self.board)
+        agg = self.memo.options(item.aggressive_range, self.board)
         legacy_fol = len(fol)
         legacy_pas = len(pas)
         legacy_agg = len(agg)
@@ -1357,6 +1856,7 @@ class AnalysisReplayer(object):
             self.process_range_action(item)
             self.prev_range_action = item
 
+    @profiled("finalise_results")
     def finalise_results(self):
         """
         Calculate RunningGameParticipant's result, under each scheme
@@ -1373,82 +1873,255 @@ class AnalysisReplayer(object):
                 rgpr.scheme = scheme
                 rgpr.result = sum(payment.amount for payment in payments
                                   if payment.reason in include)
-                self.session.add(rgpr)
+                self._add(rgpr)
                 logging.debug("gameid %d, userid %d, scheme %s: result %0.4f",
                     rgpr.gameid, rgpr.userid, rgpr.scheme, rgpr.result)
 
+    @profiled("finalise_combo_evs")
     def finalise_combo_evs(self):
-        """ Write combo EVs to UserComboGameEV andUserComboOrderEV """
+        """ Write combo EVs to UserComboGameEV and UserComboOrderEV """
         if self.debug_combo:
             logging.debug("Debugging combo: %r", self.debug_combo)
-        for _userid, user_evs in self.combo_orders.iteritems():
-            for _combo, accumulators in user_evs.iteritems():
-                for acc in accumulators:
-                    if _combo == self.debug_combo:
-                        acc.log_details()
-                    if acc.factor != 0.0:
-                        # Wormhole to another game?
-                        #
-                        # Hopefully.
-                        #
-                        # Because as I write this I think that this should only
-                        # happen when the combo is not fully played out in this
-                        # game's betting line - but I believe that's probably
-                        # not the case.
-                        #
-                        # Rather than lose the info (the fact that this
-                        # happened), we will very very subtly let people know,
-                        # by not recording an EV for this combo.
-                        #
-                        # Oh, and I'm not even going to log a debug event when
-                        # this happens because it's going to happen far too many
-                        # times to have the patience for that!
-                        continue
-                    if acc.order == None:
-                        gev = UserComboGameEV()
-                        self.session.add(gev)
-                        gev.gameid = self.game.gameid
-                        gev.userid = acc.userid
-                        gev.combo = _combo_to_mnemonic(acc.combo)
-                        gev.ev = acc.ev
-                    else:
-                        oev = UserComboOrderEV()
-                        self.session.add(oev)
-                        oev.gameid = self.game.gameid
-                        oev.userid = acc.userid
-                        oev.order = acc.order
-                        oev.combo = _combo_to_mnemonic(acc.combo)
-                        oev.ev = acc.ev
-            self.session.commit()
+        game_rows = []
+        order_rows = []
+        for userid, store in self.combo_evs.iteritems():
+            if self.debug_index is not None:
+                store.log_details(self.debug_index)
+            for order, index, ev, factor in store.results():
+                if factor != 0.0:
+                    # Wormhole to another game?
+                    #
+                    # Hopefully.
+                    #
+                    # Because as I write this I think that this should only
+                    # happen when the combo is not fully played out in this
+                    # game's betting line - but I believe that's probably
+                    # not the case.
+                    #
+                    # Rather than lose the info (the fact that this
+                    # happened), we will very very subtly let people know,
+                    # by not recording an EV for this combo.
+                    #
+                    # Oh, and I'm not even going to log a debug event when
+                    # this happens because it's going to happen far too many
+                    # times to have the patience for that!
+                    continue
+                combo = _combo_to_mnemonic(ALL_COMBOS[index])
+                if order == None:
+                    game_rows.append({'gameid': self.game.gameid,
+                                      'userid': userid,
+                                      'combo': combo,
+                                      'ev': float(ev)})
+                else:
+                    order_rows.append({'gameid': self.game.gameid,
+                                       'userid': userid,
+                                       'order': order,
+                                       'combo': combo,
+                                       'ev': float(ev)})
+        _bulk_insert(self.session, UserComboGameEV, game_rows)
+        _bulk_insert(self.session, UserComboOrderEV, order_rows)
+        self.profiler.count(rows=len(game_rows) + len(order_rows))
+        logging.debug("gameid %d, recorded %d game and %d order combo EVs",
+                      self.game.gameid, len(game_rows), len(order_rows))
 
-    def analyse(self):
+    def _record_input_hash(self):
+        """
+        Record what the analysis was calculated from
         """
-        Perform all analysis on game that has not been done.
+        self.session.query(AnalysisInputHash)  \
+            .filter(AnalysisInputHash.gameid == self.game.gameid).delete()
+        row = AnalysisInputHash()
+        row.gameid = self.game.gameid
+        row.input_hash = analysis_input_hash(self.session, self.game)
+        self._add(row)
 
-        If you need to reanalyse the game, delete the existing analysis first.
+    def _range_action_at(self, order):
         """
-        gameid = self.game.gameid
+        The GameHistoryRangeAction at this order in the game's history
+        """
+        return self.session.query(GameHistoryRangeAction)  \
+            .filter(self.game.history_filter(GameHistoryRangeAction))  \
+            .filter(GameHistoryRangeAction.order == order).one()
 
-        logging.debug("gameid %d, AnalysisReplayer, analyse", gameid)
+    @profiled("load_checkpoint")
+    def _load_checkpoint(self):
+        """
+        Restore state from the game's checkpoint, if it has one.
+
+        Returns the order of the last item processed, or -1.
+        """
+        checkpoint = self.session.query(AnalysisCheckpoint)  \
+            .filter(AnalysisCheckpoint.gameid == self.game.gameid).first()
+        if checkpoint is None:
+            return -1
+        try:
+            state = pickle.loads(zlib.decompress(checkpoint.state))
+        except AttributeError:
+            # saved before combo EVs were kept in arrays, by a class that no
+            # longer exists, so start again
+            logging.warning("gameid %d, discarding old-style checkpoint at "
+                            "order %d", self.game.gameid, checkpoint.order)
+            self.session.delete(checkpoint)
+            self.session.flush()
+            return -1
+        prev_order = state.pop('prev_range_action')
+        if prev_order is not None:
+            self.prev_range_action = self._range_action_at(prev_order)
+        fea = state.pop('fea')
+        if fea is not None:
+            fea.range_action = self._range_action_at(fea.range_action)
+        self.fea = fea
+        self.__dict__.update(state)
+        for store in self.combo_evs.itervalues():
+            store.set_debug(self.debug_index)
+        self.checkpoint_order = checkpoint.order
+        logging.debug("gameid %d, loaded checkpoint at order %d",
+                      self.game.gameid, checkpoint.order)
+        return checkpoint.order
+
+    @profiled("save_checkpoint")
+    def _save_checkpoint(self, order):
+        """
+        Save state, as of having processed the item at this order. Doesn't
+        commit, so the checkpoint is committed along with the payments and
+        showdown analysis created since the last one.
+
+        Raises ValueError if someone else has saved a checkpoint since we loaded
+        ours.
+        """
+        state = {name: getattr(self, name) for name in self.CHECKPOINTED
+                 if hasattr(self, name)}
+        state['prev_range_action'] = self.prev_range_action.order  \
+            if self.prev_range_action is not None else None
+        fea = None
+        if self.fea is not None:
+            fea = copy.copy(self.fea)
+            fea.range_action = fea.range_action.order
+        state['fea'] = fea
+        data = zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+        now = datetime.datetime.utcnow()
+        if self.checkpoint_order is None:
+            checkpoint = AnalysisCheckpoint()
+            checkpoint.gameid = self.game.gameid
+            checkpoint.order = order
+            checkpoint.state = data
+            checkpoint.updated_time = now
+            self._add(checkpoint)
+        else:
+            updated = self.session.query(AnalysisCheckpoint)  \
+                .filter(AnalysisCheckpoint.gameid == self.game.gameid)  \
+                .filter(AnalysisCheckpoint.order == self.checkpoint_order)  \
+                .update({AnalysisCheckpoint.order: order,
+                         AnalysisCheckpoint.state: data,
+                         AnalysisCheckpoint.updated_time: now},
+                        synchronize_session=False)
+            if not updated:
+                raise ValueError("Checkpoint for game %d has moved on from "
+                                 "order %d" % (self.game.gameid,
+                                               self.checkpoint_order))
+        self.checkpoint_order = order
+        logging.debug("gameid %d, saved checkpoint at order %d, %d bytes",
+                      self.game.gameid, order, len(data))
+
+    def _process_new_items(self, checkpoint=True):
+        """
+        Process history items since the checkpoint, and (unless told not to)
+        checkpoint the result.
+
+        Returns the number of items processed.
+        """
+        after = self._load_checkpoint()
         items = [self.session.query(table)
-                 .filter(table.gameid == gameid).all()
+                 .filter(self.game.history_filter(table))
+                 .filter(table.order > after).all()
                  for table in [GameHistoryBoard,
                                GameHistoryUserRange,
                                GameHistoryActionResult,
                                GameHistoryRangeAction]]
         child_items = sorted(concatenate(items),
                              key=lambda c: c.order)
-        for item in child_items:
-            self.process_child_item(item)
+        try:
+            for item in child_items:
+                # seeded per item, so it doesn't matter where checkpoints were
+                _seed_random((self.seed * 1000003 + item.order) % 2 ** 32)
+                self.process_child_item(item)
+        finally:
+            _reseed_random()
+        if child_items and checkpoint:
+            self._save_checkpoint(child_items[-1].order)
+        return len(child_items)
+
+    def advance(self):
+        """
+        Analyse the history recorded since the last checkpoint, for a game in
+        progress, and commit. This means that analysing the finished game only
+        has to process the last few items, and finalise.
+
+        Returns the number of items processed.
+        """
+        with self.profiler.phase("advance"):
+            processed = self._process_new_items()
+        self.profiler.save(self.session, self.game.gameid)
+        self.session.commit()
+        self.memo.log_stats("gameid %d" % self.game.gameid)
+        logging.debug("gameid %d, AnalysisReplayer, advanced %d items",
+                      self.game.gameid, processed)
+        return processed
 
-        self.finalise_results()
-        self.finalise_combo_evs()
+    def analyse(self):
+        """
+        Perform all analysis on game that has not been done, continuing from the
+        checkpoint if there is one.
+
+        If you need to reanalyse the game, delete the existing analysis first.
+        """
+        gameid = self.game.gameid
+        if not self.game.game_finished:
+            raise ValueError("Can't analyse game until finished.")
+
+        logging.debug("gameid %d, AnalysisReplayer, analyse", gameid)
+        with self.profiler.phase("analyse"):
+            self._process_new_items()
+            # Commit the final checkpoint, so that if finalising fails, a retry
+            # can start from here.
+            self.session.commit()
+
+            self.finalise_results()
+            self.finalise_combo_evs()
+            self._record_input_hash()
+        self.profiler.save(self.session, gameid)
+        self.session.commit()
+        self.memo.log_stats("gameid %d" % gameid)
+
+    def rebuild(self):
+        """
+        Analyse the whole of a finished game, and mark it analysed, without
+        committing (or notifying anyone). Used for reanalysis, so that the
+        caller can delete the existing analysis and commit the new analysis in
+        one transaction.
+        """
+        gameid = self.game.gameid
+        if not self.game.game_finished:
+            raise ValueError("Can't analyse game until finished.")
+        logging.debug("gameid %d, AnalysisReplayer, rebuild", gameid)
+        with self.profiler.phase("rebuild"):
+            self._process_new_items(checkpoint=False)
+            self.finalise_results()
+            self.finalise_combo_evs()
+            self._record_input_hash()
+        self.profiler.save(self.session, gameid)
+        self.game.analysis_performed = True
+        add_game_results(self.session, self.game)
+        self.memo.log_stats("gameid %d" % gameid)
 
     def finalise(self):
         """
         Commit, send out notification
         """
         self.game.analysis_performed = True
+        self.session.query(AnalysisCheckpoint)  \
+            .filter(AnalysisCheckpoint.gameid == self.game.gameid).delete()
+        add_game_results(self.session, self.game)
         self.session.commit()  # ensure it can only notify once
         logging.debug("gameid %d, notifying", self.game.gameid)
         notify_finished(self.game)
@@ -1460,7 +2133,7 @@ class Test(unittest.TestCase):
     """
     # pylint:disable=W0212,C0103,R0904
     def test_create_afei_one_folder_bet(self):
-        """ Test _create_afei for a bet against one player"""
+        """ Test _create_afeis for a bet against one player"""
         # bet 10 on a pot of 10
         # unprofitable bluff
         fea = FoldEquityAccumulator(
@@ -1478,15 +2151,15 @@ class Test(unittest.TestCase):
         fold_range = HandRange("KK")
         nonfold_range = HandRange("AA")
         fea.folds.append((1, fold_range, nonfold_range))
-        afei = fea._create_afei(combo=Card.many_from_text("KsQh"), is_agg=True)
-        self.assertAlmostEqual(afei.fold_ratio, 1.0 / 3.0)
-        self.assertAlmostEqual(afei.immediate_result,
+        afei = fea._create_afeis([Card.many_from_text("KsQh")], is_agg=True)[0]
+        self.assertAlmostEqual(afei['fold_ratio'], 1.0 / 3.0)
+        self.assertAlmostEqual(afei['immediate_result'],
             1.0 / 3.0 * 10.0 + (2.0 / 3.0) * (-10))
-        self.assertAlmostEqual(afei.semibluff_ev, 5.0)
-        self.assertAlmostEqual(afei.semibluff_equity, 5.0 / 30.0)
+        self.assertAlmostEqual(afei['semibluff_ev'], 5.0)
+        self.assertAlmostEqual(afei['semibluff_equity'], 5.0 / 30.0)
 
     def test_create_afei_one_folder_raise(self):
-        """ Test _create_afei for a raise against one player"""
+        """ Test _create_afeis for a raise against one player"""
         # raise from 10 to 30 on an original pot of 10
         # profitable bluff
         fea = FoldEquityAccumulator(
@@ -1504,15 +2177,15 @@ class Test(unittest.TestCase):
         fold_range = HandRange("KK-JJ")
         nonfold_range = HandRange("AA")
         fea.folds.append((1, fold_range, nonfold_range))
-        afei = fea._create_afei(combo=Card.many_from_text("KsQh"), is_agg=True)
-        self.assertAlmostEqual(afei.fold_ratio, 2.0 / 3.0)
-        self.assertAlmostEqual(afei.immediate_result,
+        afei = fea._create_afeis([Card.many_from_text("KsQh")], is_agg=True)[0]
+        self.assertAlmostEqual(afei['fold_ratio'], 2.0 / 3.0)
+        self.assertAlmostEqual(afei['immediate_result'],
             2.0 / 3.0 * 20.0 + (1.0 / 3.0) * (-30.0))  # 3.33...
-        self.assertAlmostEqual(afei.semibluff_ev, -10.0)
-        self.assertAlmostEqual(afei.semibluff_equity, -10.0 / 70.0)
+        self.assertAlmostEqual(afei['semibluff_ev'], -10.0)
+        self.assertAlmostEqual(afei['semibluff_equity'], -10.0 / 70.0)
 
     def test_create_afei_one_folder_reraise(self):
-        """ Test _create_afei for a reraise against one player"""
+        """ Test _create_afeis for a reraise against one player"""
         # raise from 30 to 50 on an original pot of 10
         # unprofitable bluff
         fea = FoldEquityAccumulator(
@@ -1530,15 +2203,16 @@ class Test(unittest.TestCase):
         fold_range = HandRange("QQ")
         nonfold_range = HandRange("AA-KK")
         fea.folds.append((1, fold_range, nonfold_range))
-        afei = fea._create_afei(combo=Card.many_from_text("KsQh"), is_agg=True)
-        self.assertAlmostEqual(afei.fold_ratio, 1.0 / 4.0)
-        self.assertAlmostEqual(afei.immediate_result,
+        afei = fea._create_afeis([Card.many_from_text("KsQh")], is_agg=True)[0]
+        self.assertAlmostEqual(afei['fold_ratio'], 1.0 / 4.0)
+        self.assertAlmostEqual(afei['immediate_result'],
             1.0 / 4.0 * 50.0 + (3.0 / 4.0) * (-40.0))  # -17.5
-        self.assertAlmostEqual(afei.semibluff_ev, 4.0 / 3.0 * 17.5)
-        self.assertAlmostEqual(afei.semibluff_equity, 4.0 / 3.0 * 17.5 / 110.0)
+        self.assertAlmostEqual(afei['semibluff_ev'], 4.0 / 3.0 * 17.5)
+        self.assertAlmostEqual(afei['semibluff_equity'],
+                               4.0 / 3.0 * 17.5 / 110.0)
 
     def test_create_afei_two_folders_bet(self):
-        """ Test _create_afei for a bet against two players"""
+        """ Test _create_afeis for a bet against two players"""
         # bet 10 on a pot of 10
         # profitable bluff
         fea = FoldEquityAccumulator(
@@ -1559,15 +2233,15 @@ class Test(unittest.TestCase):
         fold_range = HandRange("KK")
         nonfold_range = HandRange("AA")
         fea.folds.append((1, fold_range, nonfold_range))
-        afei = fea._create_afei(combo=Card.many_from_text("AsQh"), is_agg=True)
-        self.assertAlmostEqual(afei.fold_ratio, 4.0 / 9.0)
-        self.assertAlmostEqual(afei.immediate_result,
+        afei = fea._create_afeis([Card.many_from_text("AsQh")], is_agg=True)[0]
+        self.assertAlmostEqual(afei['fold_ratio'], 4.0 / 9.0)
+        self.assertAlmostEqual(afei['immediate_result'],
             4.0 / 9.0 * 10.0 + (5.0 / 9.0) * (-10))
-        self.assertEqual(afei.semibluff_ev, None)
-        self.assertEqual(afei.semibluff_equity, None)
+        self.assertEqual(afei['semibluff_ev'], None)
+        self.assertEqual(afei['semibluff_equity'], None)
 
     def test_create_afei_two_folders_raise(self):
-        """ Test _create_afei for a raise against two players"""
+        """ Test _create_afeis for a raise against two players"""
         # raise from 10 to 30 on an original pot of 10
         # unprofitable bluff
         fea = FoldEquityAccumulator(
@@ -1588,15 +2262,15 @@ class Test(unittest.TestCase):
         fold_range = HandRange("QQ")
         nonfold_range = HandRange("KK+")
         fea.folds.append((1, fold_range, nonfold_range))  # folds 1/4
-        afei = fea._create_afei(combo=Card.many_from_text("AsQh"), is_agg=True)
-        self.assertAlmostEqual(afei.fold_ratio, 1.0 / 6.0)
-        self.assertAlmostEqual(afei.immediate_result,
+        afei = fea._create_afeis([Card.many_from_text("AsQh")], is_agg=True)[0]
+        self.assertAlmostEqual(afei['fold_ratio'], 1.0 / 6.0)
+        self.assertAlmostEqual(afei['immediate_result'],
             1.0 / 6.0 * 20.0 + (5.0 / 6.0) * (-30))  # -21.66...
-        self.assertAlmostEqual(afei.semibluff_ev, None)
-        self.assertAlmostEqual(afei.semibluff_equity, None)
+        self.assertAlmostEqual(afei['semibluff_ev'], None)
+        self.assertAlmostEqual(afei['semibluff_equity'], None)
 
     def test_create_afei_two_fodlers_reraise(self):
-        """ Test _create_afei for a reraise against two players"""
+        """ Test _create_afeis for a reraise against two players"""
         # raise from 30 to 50 on an original pot of 10
         # profitable bluff
         fea = FoldEquityAccumulator(
@@ -1617,12 +2291,187 @@ class Test(unittest.TestCase):
         fold_range = HandRange("KK-JJ")
         nonfold_range = HandRange("AA")
         fea.folds.append((1, fold_range, nonfold_range))  # folds 5/6
-        afei = fea._create_afei(combo=Card.many_from_text("AsQh"), is_agg=True)
-        self.assertAlmostEqual(afei.fold_ratio, 10.0 / 18.0)
-        self.assertAlmostEqual(afei.immediate_result,
+        afei = fea._create_afeis([Card.many_from_text("AsQh")], is_agg=True)[0]
+        self.assertAlmostEqual(afei['fold_ratio'], 10.0 / 18.0)
+        self.assertAlmostEqual(afei['immediate_result'],
             10.0 / 18.0 * 50.0 + 8.0 / 18.0 * (-50.0))  # 5.55...
-        self.assertAlmostEqual(afei.semibluff_ev, None)
-        self.assertAlmostEqual(afei.semibluff_equity, None)
+        self.assertAlmostEqual(afei['semibluff_ev'], None)
+        self.assertAlmostEqual(afei['semibluff_equity'], None)
+
+    def test_create_afeis_range(self):
+        """ Test _create_afeis for a whole range against brute force """
+        board = Card.many_from_text("AhKd2c")
+        fea = FoldEquityAccumulator(
+            gameid=0,
+            order=0,
+            street=PREFLOP,
+            board=board,
+            bettor=0,
+            range_action=None,
+            raise_total=10,
+            pot_before_bet=10,
+            bet_cost=10,
+            pot_if_called=30,
+            potential_folders=[])
+        fea.folds.append((1, HandRange("KK-JJ,AQ"), HandRange("AA,AK")))
+        fea.folds.append((2, HandRange("QJ,T9s"), HandRange("KQ,22+")))
+        combos = HandRange("AQ,KJs,JJ-TT").generate_options(board)
+        rows = fea._create_afeis(combos, is_pas=True)
+        self.assertEqual(len(rows), len(combos))
+        for combo, row in zip(combos, rows):
+            fold_ratio = 1.0
+            for _, fold_range, nonfold_range in fea.folds:
+                fold_size = len(fold_range.generate_options(
+                    board + list(combo)))
+                nonfold_size = len(nonfold_range.generate_options(
+                    board + list(combo)))
+                fold_ratio *= 1.0 * fold_size / (fold_size + nonfold_size)
+            self.assertEqual(Card.many_from_text(row['higher_card'] +
+                                                 row['lower_card']),
+                             sorted(combo, reverse=True))
+            self.assertTrue(row['is_passive'])
+            self.assertFalse(row['is_aggressive'] or row['is_fold'])
+            self.assertAlmostEqual(row['fold_ratio'], fold_ratio)
+            self.assertAlmostEqual(row['immediate_result'],
+                fold_ratio * 10.0 - (1.0 - fold_ratio) * 10.0)
+            self.assertAlmostEqual(row['semibluff_ev'],
+                -row['immediate_result'] / (1.0 - fold_ratio))
+
+    def test_seed_random(self):
+        """ Test that seeding makes analysis random numbers repeatable """
+        def draw():
+            """ one from each random number generator """
+            return (random.random(), numpy.random.randint(1000000),
+                    py_hand_vs_range_monte_carlo(
+                        Card.many_from_text("AsKs"), HandRange("QQ+,AK"),
+                        Card.many_from_text("Qh2c3d"), 100))
+        _seed_random(analysis_seed(123))
+        first = draw()
+        _reseed_random()
+        self.assertNotEqual(draw(), first)
+        _seed_random(analysis_seed(123))
+        self.assertEqual(draw(), first)
+        _reseed_random()
+
+    def test_options_memo(self):
+        """ Test OptionsMemo """
+        memo = OptionsMemo()
+        board = Card.many_from_text("AhKd2c")
+        options = memo.options("AK,KQs,22", board)
+        self.assertEqual(options,
+                         HandRange("AK,KQs,22").generate_options(board))
+        self.assertIs(memo.options("AK,KQs,22", board), options)
+        self.assertIs(memo.range("AK,KQs,22").generate_options(board), options)
+        self.assertEqual(memo.generated, 1)
+        self.assertEqual(memo.avoided, 2)
+        self.assertIsNot(memo.options("AK,KQs,22", []), options)
+        for combo in HandRange("AQ,KK,QJs").generate_options(board):
+            self.assertEqual(memo.size_vs_combo("AK,KQs,22", combo, board),
+                             len([o for o in options if not o & combo]))
+
+    def test_calculate_all_weights(self):
+        """ Test _calculate_all_weights against brute force """
+        board = Card.many_from_text("AhKd2c")
+        range_action = GameHistoryRangeAction()
+        range_action.userid = 2
+        range_action.fold_range = "QJ,T9s"
+        range_action.passive_range = "KQ,JJ"
+        range_action.aggressive_range = "AA,AKo"
+        lines = [HandRange(range_action.fold_range).generate_options(board),
+                 HandRange(range_action.passive_range).generate_options(board),
+                 HandRange(range_action.aggressive_range)  \
+                    .generate_options(board)]
+        hero = HandRange("AQ,KJs,JJ-TT").generate_options(board)
+        other = HandRange("QQ,AJ,T9").generate_options(board)
+        villain = "QJ,T9s,KQ,JJ,AA,AKo"
+        # heads-up
+        memo = OptionsMemo()
+        weights = _calculate_all_weights(memo, hero, range_action, {2: villain},
+                                         board)
+        for combo in hero:
+            counts = [len([1 for v in line if not v.intersection(combo)])
+                      for line in lines]
+            total = sum(counts)
+            self.assertEqual(weights[combo] is None, total == 0)
+            if total:
+                for weight, count in zip(weights[combo], counts):
+                    self.assertAlmostEqual(weight, 1.0 * count / total)
+        # three-handed
+        weights = _calculate_all_weights(memo, hero, range_action,
+                                         {2: villain, 3: "QQ,AJ,T9"}, board)
+        for combo in hero:
+            counts = [len([1 for v in line for o in other
+                           if len(combo.union(v).union(o)) == 6])
+                      for line in lines]
+            total = sum(counts)
+            self.assertEqual(weights[combo] is None, total == 0)
+            if total:
+                for weight, count in zip(weights[combo], counts):
+                    self.assertAlmostEqual(weight, 1.0 * count / total)
+
+    def test_checkpoint_state(self):
+        """ Test that replayer state survives a checkpoint """
+        board = Card.many_from_text("AhKd2c")
+        store = ComboEVStore(1, options_to_indices(
+            HandRange("QQ+").generate_options(board)))
+        store.vpip(4, numpy.array([combo_index(Card.many_from_text("QsQh"))]),
+                   10)
+        state = {'board': board, 'combo_evs': {1: store}}
+        loaded = pickle.loads(zlib.decompress(zlib.compress(
+            pickle.dumps(state, pickle.HIGHEST_PROTOCOL))))
+        self.assertEqual(loaded['board'], board)
+        store = loaded['combo_evs'][1]
+        self.assertEqual(store.present.sum(), 12)
+        # only the rows in use are saved
+        self.assertEqual(store.ev.shape, (1, 1326))
+        self.assertEqual(len(store.__getstate__()['factor']), 1)
+        index = combo_index(Card.many_from_text("QhQs"))
+        self.assertEqual([(order, ev, factor)
+                          for order, i, ev, factor in store.results()
+                          if i == index],
+                         [(None, -10.0, 1.0)])
+
+    def test_combo_ev_store(self):
+        """ Test ComboEVStore events across orders """
+        board = Card.many_from_text("AhKd2c")
+        indices = options_to_indices(HandRange("QQ+").generate_options(board))
+        store = ComboEVStore(1, indices)
+        store.vpip(1, indices, 10)
+        store.add_order(2, indices[:6])
+        store.fold_equity(3, indices[:6], 30, numpy.array([0.5] * 6))
+        store.showdown_ev(4, indices[:3], numpy.array([1.0, 0.5, 0.0]), 40,
+                          0.5)
+        store.showdown_reduce(4, indices[:3], 0.5)
+        store.fold(5, indices[3:])
+        results = {(order, index): (ev, factor)
+                   for order, index, ev, factor in store.results()
+                   if order != 4}
+        # folded after vpip
+        self.assertEqual(results[(None, indices[-1])], (-10.0, 0.0))
+        # 30 * 0.5 in fold equity, then half the time 40 * 0.5 at showdown
+        self.assertEqual(results[(None, indices[1])], (-10.0 + 15.0 + 5.0,
+                                                       0.25))
+        self.assertEqual(results[(2, indices[1])], (15.0 + 5.0, 0.25))
+        self.assertEqual(results[(2, indices[4])], (15.0, 0.0))
+        self.assertNotIn((2, indices[6]), results)
+        self.assertEqual(sorted(ev for order, _index, ev, factor
+                                in store.results() if order == 4),
+                         [0.0, 20.0, 40.0])
+        # rows beyond the initial capacity
+        for order in xrange(10, 30):
+            store.add_order(order, indices[:1])
+        self.assertEqual(store.present.shape, (22, 1326))
+        self.assertEqual(store.present[2:].sum(), 20)
+        self.assertEqual(store.factor[2:, indices[0]].tolist(), [1.0] * 20)
+        self.assertEqual(results[(2, indices[1])], (store.ev[1, indices[1]],
+                                                    store.factor[1,
+                                                                 indices[1]]))
+        # no factor left
+        self.assertRaises(AssertionError, store.showdown_reduce, 6,
+                          indices[3:4], 0.5)
+        # invalid weight
+        self.assertRaises(AssertionError, store.fold_equity, 6, indices[:1],
+                          30, numpy.array([1.5]))
 
 if __name__ == '__main__':
-    unittest.main()
+    unittest.main()
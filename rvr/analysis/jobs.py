@@ -0,0 +1,454 @@
+"""
+Durable queue of analysis jobs, and the worker processes that run them.
+
+Every action in a game enqueues an AnalysisJob, in the same transaction, so that
+the game is analysed as it is played (see AnalysisReplayer.advance), and
+finishing the game enqueues the job that completes its analysis. Workers, each
+in its own process with its own database session, claim jobs by taking a lease
+on them, extend the lease (heartbeat) while they work, and record how long each
+job took. A failed job is retried with exponential backoff, up to MAX_ATTEMPTS
+times. If a worker dies, its job is claimed again when the lease expires. Only
+one job at a time runs for any one game.
+
+Run the workers with analysis_worker.py.
+"""
+import datetime
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+import unittest
+from sqlalchemy import create_engine, and_, or_, func, exists
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.session import sessionmaker
+from rvr.db.creation import ENGINE, SESSION
+from rvr.db.tables import AnalysisJob, RunningGame
+from rvr.analysis.analyse import AnalysisReplayer, reset_analysis
+from rvr.core.dtos import AnalysisQueueStatus
+from rvr.local_settings import SQLALCHEMY_DATABASE_URI
+
+WORKER_COUNT = 2
+LEASE_SECONDS = 300
+# SQLite can't take a write from another connection while the analysis has its
+# transaction open, so there, leases aren't extended.
+HEARTBEAT_SECONDS = None if SQLALCHEMY_DATABASE_URI.startswith('sqlite')  \
+    else 60
+POLL_SECONDS = 5
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 60
+MAX_BACKOFF_SECONDS = 3600
+CLAIM_CANDIDATES = 5
+
+def worker_name():
+    """
+    Unique name for this worker process
+    """
+    return "%s:%d" % (socket.gethostname()[:40], os.getpid())
+
+def retry_delay(attempts):
+    """
+    Seconds to wait before retrying a job that has failed <attempts> times
+    """
+    return min(BACKOFF_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS)
+
+def enqueue_analysis(session, gameid, now=None):
+    """
+    Add a job to analyse this game, unless one is already queued. (A running job
+    may have started before whatever the caller is recording, so it doesn't
+    count.)
+
+    Doesn't commit, so the job is created along with the rest of the caller's
+    transaction (typically, an action in the game).
+    """
+    existing = session.query(AnalysisJob)  \
+        .filter(AnalysisJob.gameid == gameid)  \
+        .filter(AnalysisJob.status == AnalysisJob.STATUS_QUEUED).first()
+    if existing is not None:
+        return existing
+    now = now or datetime.datetime.utcnow()
+    job = AnalysisJob()
+    job.gameid = gameid
+    job.status = AnalysisJob.STATUS_QUEUED
+    job.attempts = 0
+    job.available_time = now
+    job.created_time = now
+    session.add(job)
+    logging.debug("gameid %d, analysis job queued", gameid)
+    return job
+
+def _claimable(now):
+    """
+    Filter for jobs that can be claimed at <now>, which excludes jobs for a game
+    that another worker is analysing
+    """
+    other = aliased(AnalysisJob)
+    busy = exists().where(and_(other.gameid == AnalysisJob.gameid,
+                               other.jobid != AnalysisJob.jobid,
+                               other.status == AnalysisJob.STATUS_RUNNING,
+                               other.lease_expires >= now))
+    return and_(or_(and_(AnalysisJob.status == AnalysisJob.STATUS_QUEUED,
+                         AnalysisJob.available_time <= now),
+                    and_(AnalysisJob.status == AnalysisJob.STATUS_RUNNING,
+                         AnalysisJob.lease_expires < now,
+                         AnalysisJob.attempts < MAX_ATTEMPTS)),
+                ~busy)
+
+def _fail_abandoned(session, now):
+    """
+    Jobs whose lease has expired on their last attempt won't be retried.
+    """
+    count = session.query(AnalysisJob)  \
+        .filter(AnalysisJob.status == AnalysisJob.STATUS_RUNNING)  \
+        .filter(AnalysisJob.lease_expires < now)  \
+        .filter(AnalysisJob.attempts >= MAX_ATTEMPTS)  \
+        .update({AnalysisJob.status: AnalysisJob.STATUS_FAILED,
+                 AnalysisJob.finished_time: now,
+                 AnalysisJob.lease_expires: None,
+                 AnalysisJob.error: "lease expired"},
+                synchronize_session=False)
+    if count:
+        logging.warning("%d analysis jobs abandoned", count)
+
+def claim_job(session, worker, now=None):
+    """
+    Claim the next available job for <worker>, and commit. Returns the job, or
+    None if there is nothing to do.
+
+    The claim is an UPDATE conditional on the job still being claimable, so
+    when two workers go for the same job, only one of them gets it.
+    """
+    now = now or datetime.datetime.utcnow()
+    _fail_abandoned(session, now)
+    candidates = session.query(AnalysisJob.jobid)  \
+        .filter(_claimable(now))  \
+        .order_by(AnalysisJob.available_time, AnalysisJob.jobid)  \
+        .limit(CLAIM_CANDIDATES).all()
+    for jobid, in candidates:
+        lease = now + datetime.timedelta(seconds=LEASE_SECONDS)
+        claimed = session.query(AnalysisJob)  \
+            .filter(AnalysisJob.jobid == jobid)  \
+            .filter(_claimable(now))  \
+            .update({AnalysisJob.status: AnalysisJob.STATUS_RUNNING,
+                     AnalysisJob.worker: worker,
+                     AnalysisJob.attempts: AnalysisJob.attempts + 1,
+                     AnalysisJob.lease_expires: lease,
+                     AnalysisJob.heartbeat_time: now,
+                     AnalysisJob.started_time: now,
+                     AnalysisJob.finished_time: None},
+                    synchronize_session=False)
+        session.commit()
+        if claimed:
+            return session.query(AnalysisJob)  \
+                .filter(AnalysisJob.jobid == jobid).one()
+    session.commit()
+    return None
+
+def heartbeat(session, jobid, worker, now=None):
+    """
+    Extend <worker>'s lease on a job, and commit. Returns False if the worker no
+    longer holds the lease.
+    """
+    now = now or datetime.datetime.utcnow()
+    held = session.query(AnalysisJob)  \
+        .filter(AnalysisJob.jobid == jobid)  \
+        .filter(AnalysisJob.worker == worker)  \
+        .filter(AnalysisJob.status == AnalysisJob.STATUS_RUNNING)  \
+        .update({AnalysisJob.lease_expires:
+                 now + datetime.timedelta(seconds=LEASE_SECONDS),
+                 AnalysisJob.heartbeat_time: now},
+                synchronize_session=False)
+    session.commit()
+    return bool(held)
+
+def finish_job(session, jobid, worker, duration, error=None, now=None):
+    """
+    Record the outcome of a job, and commit. A failed job is queued again after
+    a delay, unless it has already had MAX_ATTEMPTS attempts.
+    """
+    now = now or datetime.datetime.utcnow()
+    job = session.query(AnalysisJob).filter(AnalysisJob.jobid == jobid).one()
+    if job.worker != worker or job.status != AnalysisJob.STATUS_RUNNING:
+        logging.warning("analysis job %d, worker %s no longer holds lease",
+                        jobid, worker)
+        session.commit()
+        return
+    job.duration = duration
+    job.lease_expires = None
+    job.error = error[:200] if error is not None else None
+    if error is None:
+        job.status = AnalysisJob.STATUS_DONE
+        job.finished_time = now
+    elif job.attempts >= MAX_ATTEMPTS:
+        job.status = AnalysisJob.STATUS_FAILED
+        job.finished_time = now
+    else:
+        job.status = AnalysisJob.STATUS_QUEUED
+        job.available_time = now + datetime.timedelta(
+            seconds=retry_delay(job.attempts))
+    session.commit()
+
+def analyse_game(session, gameid):
+    """
+    Analyse the game, unless it has already been analysed. For a game that's
+    still in progress, analyse as far as it has got.
+    """
+    game = session.query(RunningGame)  \
+        .filter(RunningGame.gameid == gameid).one()
+    if game.analysis_performed:
+        logging.debug("gameid %d, already analysed", gameid)
+        return
+    if not game.game_finished:
+        AnalysisReplayer(session, game).advance()
+        return
+    # clear anything committed by a previous failed attempt
+    reset_analysis(session, gameid)
+    replayer = AnalysisReplayer(session, game)
+    replayer.analyse()
+    replayer.finalise()
+
+class Heartbeat(threading.Thread):
+    """
+    Keeps extending the lease on a job, with its own session, while the job's
+    worker is busy analysing.
+    """
+    def __init__(self, jobid, worker, session_maker, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.jobid = jobid
+        self.worker = worker
+        self.session_maker = session_maker
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        session = self.session_maker()
+        try:
+            while not self.stopped.wait(self.interval):
+                try:
+                    if not heartbeat(session, self.jobid, self.worker):
+                        logging.warning("analysis job %d, worker %s lost lease",
+                                        self.jobid, self.worker)
+                        return
+                except Exception:  # pylint:disable=broad-except
+                    logging.exception("analysis job %d, heartbeat failed",
+                                      self.jobid)
+                    session.rollback()
+        finally:
+            session.close()
+
+    def stop(self):
+        """
+        Stop heartbeating, and wait for the thread to finish
+        """
+        self.stopped.set()
+        self.join()
+
+def run_one_job(worker, session_maker=SESSION, function=analyse_game):
+    """
+    Claim and run one job. Returns False if there was nothing to do.
+    """
+    session = session_maker()
+    try:
+        job = claim_job(session, worker)
+        if job is None:
+            return False
+        jobid, gameid = job.jobid, job.gameid
+        logging.info("analysis job %d, gameid %d, attempt %d, claimed by %s",
+                     jobid, gameid, job.attempts, worker)
+        beat = None
+        if HEARTBEAT_SECONDS:
+            beat = Heartbeat(jobid, worker, session_maker, HEARTBEAT_SECONDS)
+            beat.start()
+        start = time.time()
+        error = None
+        try:
+            function(session, gameid)
+        except Exception:  # pylint:disable=broad-except
+            logging.exception("analysis job %d, gameid %d, failed",
+                              jobid, gameid)
+            session.rollback()
+            error = traceback.format_exc().splitlines()[-1]
+        finally:
+            if beat is not None:
+                beat.stop()
+        duration = time.time() - start
+        finish_job(session, jobid, worker, duration, error)
+        logging.info("analysis job %d, gameid %d, %s after %0.1f seconds",
+                     jobid, gameid, "failed" if error else "done", duration)
+        return True
+    finally:
+        session.close()
+
+def run_worker(poll=POLL_SECONDS):
+    """
+    Work jobs forever, polling every <poll> seconds when there's nothing to do.
+
+    This is the body of a worker process.
+    """
+    ENGINE.dispose()  # don't share the parent process's connections
+    worker = worker_name()
+    logging.info("analysis worker %s starting", worker)
+    while True:
+        try:
+            if not run_one_job(worker):
+                time.sleep(poll)
+        except Exception:  # pylint:disable=broad-except
+            logging.exception("analysis worker %s, error", worker)
+            time.sleep(poll)
+
+def run_workers(count=WORKER_COUNT, target=run_worker):
+    """
+    Start <count> worker processes, and wait for them (i.e. forever).
+    """
+    processes = [multiprocessing.Process(target=target,
+                                         name="analysis-worker-%d" % (i,))
+                 for i in range(count)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+def queue_status(session, now=None):
+    """
+    Returns AnalysisQueueStatus
+    """
+    now = now or datetime.datetime.utcnow()
+    counts = dict(session.query(AnalysisJob.status, func.count())  \
+        .group_by(AnalysisJob.status).all())
+    due, oldest = session.query(func.count(),
+                                func.min(AnalysisJob.available_time))  \
+        .filter(AnalysisJob.status == AnalysisJob.STATUS_QUEUED)  \
+        .filter(AnalysisJob.available_time <= now).one()
+    hour_ago = now - datetime.timedelta(hours=1)
+    day_ago = now - datetime.timedelta(days=1)
+    done_last_hour = session.query(func.count())  \
+        .filter(AnalysisJob.status == AnalysisJob.STATUS_DONE)  \
+        .filter(AnalysisJob.finished_time >= hour_ago).scalar()
+    done_last_day, mean_duration = session.query(
+        func.count(), func.avg(AnalysisJob.duration))  \
+        .filter(AnalysisJob.status == AnalysisJob.STATUS_DONE)  \
+        .filter(AnalysisJob.finished_time >= day_ago).one()
+    return AnalysisQueueStatus(
+        queued=counts.get(AnalysisJob.STATUS_QUEUED, 0),
+        due=due,
+        running=counts.get(AnalysisJob.STATUS_RUNNING, 0),
+        failed=counts.get(AnalysisJob.STATUS_FAILED, 0),
+        done_last_hour=done_last_hour,
+        done_last_day=done_last_day,
+        mean_duration=mean_duration,
+        oldest_due=oldest)
+
+class Test(unittest.TestCase):
+    """ Tests for the analysis job queue """
+    # pylint:disable=C0103
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        AnalysisJob.__table__.create(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.now = datetime.datetime(2016, 1, 1)
+
+    def tearDown(self):
+        self.session.close()
+
+    def _later(self, seconds):
+        return self.now + datetime.timedelta(seconds=seconds)
+
+    def test_retry_delay(self):
+        self.assertEqual(retry_delay(1), BACKOFF_SECONDS)
+        self.assertEqual(retry_delay(2), BACKOFF_SECONDS * 2)
+        self.assertEqual(retry_delay(3), BACKOFF_SECONDS * 4)
+        self.assertEqual(retry_delay(20), MAX_BACKOFF_SECONDS)
+
+    def test_enqueue(self):
+        enqueue_analysis(self.session, 1, self.now)
+        enqueue_analysis(self.session, 1, self.now)
+        enqueue_analysis(self.session, 2, self.now)
+        self.session.commit()
+        self.assertEqual(self.session.query(AnalysisJob).count(), 2)
+
+    def test_one_job_per_game(self):
+        enqueue_analysis(self.session, 1, self.now)
+        self.session.commit()
+        job = claim_job(self.session, "a", self.now)
+        # the running job doesn't stop another being queued
+        enqueue_analysis(self.session, 1, self.now)
+        enqueue_analysis(self.session, 2, self.now)
+        self.session.commit()
+        self.assertEqual(self.session.query(AnalysisJob).count(), 3)
+        # but it can't be claimed until the first is done
+        self.assertEqual(claim_job(self.session, "b", self.now).gameid, 2)
+        self.assertIsNone(claim_job(self.session, "b", self.now))
+        finish_job(self.session, job.jobid, "a", 1.0, None, self.now)
+        self.assertEqual(claim_job(self.session, "b", self.now).gameid, 1)
+
+    def test_claim_and_lease(self):
+        enqueue_analysis(self.session, 1, self.now)
+        self.session.commit()
+        job = claim_job(self.session, "a", self.now)
+        self.assertEqual((job.gameid, job.attempts), (1, 1))
+        self.assertIsNone(claim_job(self.session, "b", self.now))
+        # a keeps it alive
+        self.assertTrue(heartbeat(self.session, job.jobid, "a",
+                                  self._later(LEASE_SECONDS - 1)))
+        self.assertIsNone(claim_job(self.session, "b",
+                                    self._later(LEASE_SECONDS + 1)))
+        # a goes quiet, b takes over
+        job = claim_job(self.session, "b", self._later(3 * LEASE_SECONDS))
+        self.assertEqual((job.worker, job.attempts), ("b", 2))
+        self.assertFalse(heartbeat(self.session, job.jobid, "a",
+                                   self._later(3 * LEASE_SECONDS)))
+        # a's result is ignored
+        finish_job(self.session, job.jobid, "a", 1.0, None,
+                   self._later(3 * LEASE_SECONDS))
+        self.assertEqual(job.status, AnalysisJob.STATUS_RUNNING)
+        finish_job(self.session, job.jobid, "b", 2.0, None,
+                   self._later(3 * LEASE_SECONDS))
+        self.assertEqual((job.status, job.duration),
+                         (AnalysisJob.STATUS_DONE, 2.0))
+
+    def test_retry_then_fail(self):
+        enqueue_analysis(self.session, 1, self.now)
+        self.session.commit()
+        now = self.now
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            self.assertIsNone(claim_job(self.session, "a",
+                                        now - datetime.timedelta(seconds=1)))
+            job = claim_job(self.session, "a", now)
+            self.assertEqual(job.attempts, attempt)
+            finish_job(self.session, job.jobid, "a", 1.0, "oops", now)
+            now = job.available_time
+        self.assertEqual(job.status, AnalysisJob.STATUS_FAILED)
+        self.assertEqual(job.error, "oops")
+        self.assertIsNone(claim_job(self.session, "a", self._later(10 ** 6)))
+
+    def test_run_one_job(self):
+        enqueue_analysis(self.session, 1)
+        enqueue_analysis(self.session, 2)
+        self.session.commit()
+        maker = lambda: self.session
+        self.session.close = lambda: None
+        analysed = []
+        def analyse(_session, gameid):
+            """ succeed for game 1, fail for game 2 """
+            analysed.append(gameid)
+            if gameid == 2:
+                raise ValueError("bad game")
+        self.assertTrue(run_one_job("a", maker, analyse))
+        self.assertTrue(run_one_job("a", maker, analyse))
+        self.assertFalse(run_one_job("a", maker, analyse))
+        self.assertEqual(analysed, [1, 2])
+        status = queue_status(self.session)
+        self.assertEqual((status.queued, status.due, status.running,
+                          status.failed, status.done_last_hour),
+                         (1, 0, 0, 0, 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+"""
+Leaderboards: the users with the highest confidence in each seat of each
+situation, in each mode.
+
+The top CACHE_SIZE entries of each leaderboard are cached, with screennames, in
+CachedLeaderboardEntry. When users' UserSituationPlayer change, only the
+leaderboards they are on, or have now made it onto, are refreshed.
+"""
+import datetime
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.orm.session import sessionmaker
+from rvr.db.tables import CachedLeaderboardEntry, UserSituationPlayer, User
+from rvr.core.dtos import LeaderboardEntry
+
+CACHE_SIZE = 20
+# only users doing better than a breakeven player are on the leaderboards
+MIN_CONFIDENCE = 0.5
+
+def _on_board(table, situationid, order, public_ranges):
+    """
+    Filter for the rows of table in this leaderboard
+    """
+    return (table.situationid == situationid) & (table.order == order) &  \
+        (table.public_ranges == public_ranges)
+
+def _ranking(session, situationid, order, public_ranges):
+    """
+    Query of (UserSituationPlayer, User) for this leaderboard, best first
+    """
+    return session.query(UserSituationPlayer, User)  \
+        .join(User, User.userid == UserSituationPlayer.userid)  \
+        .filter(_on_board(UserSituationPlayer, situationid, order,
+                          public_ranges))  \
+        .filter(UserSituationPlayer.confidence > MIN_CONFIDENCE)  \
+        .order_by(UserSituationPlayer.confidence.desc(),
+                  UserSituationPlayer.userid)
+
+def refresh_leaderboard(session, situationid, order, public_ranges):
+    """
+    Recalculate the cached top of this leaderboard. Doesn't commit.
+    """
+    session.query(CachedLeaderboardEntry)  \
+        .filter(_on_board(CachedLeaderboardEntry, situationid, order,
+                          public_ranges)).delete()
+    rows = [{'situationid': situationid, 'order': order,
+             'public_ranges': public_ranges, 'rank': rank,
+             'userid': usp.userid, 'screenname': user.screenname,
+             'amount_won': usp.amount_won, 'redline': usp.redline,
+             'blueline': usp.blueline, 'hands_played': usp.hands_played,
+             'confidence': usp.confidence}
+            for rank, (usp, user) in enumerate(
+                _ranking(session, situationid, order, public_ranges)
+                .limit(CACHE_SIZE))]
+    if rows:
+        session.execute(CachedLeaderboardEntry.__table__.insert(), rows)
+
+def refresh_all_leaderboards(session):
+    """
+    Recalculate the cached top of every leaderboard. Doesn't commit.
+    """
+    session.query(CachedLeaderboardEntry).delete()
+    for situationid, order, public_ranges in session.query(
+            UserSituationPlayer.situationid, UserSituationPlayer.order,
+            UserSituationPlayer.public_ranges).distinct().all():
+        refresh_leaderboard(session, situationid, order, public_ranges)
+
+def _is_affected(cached, changed):
+    """
+    Could the top of a leaderboard, currently cached, be different now that
+    these UserSituationPlayer on it have changed?
+    """
+    if set(entry.userid for entry in cached) &  \
+            set(usp.userid for usp in changed):
+        return True  # someone on it has moved (or dropped off)
+    contenders = [usp.confidence for usp in changed
+                  if usp.confidence is not None and
+                  usp.confidence > MIN_CONFIDENCE]
+    if not contenders:
+        return False
+    if len(cached) < CACHE_SIZE:
+        return True
+    return max(contenders) >= min(entry.confidence for entry in cached)
+
+def update_leaderboards(session, usps):
+    """
+    Refresh the leaderboards that changes to these UserSituationPlayer affect.
+    Doesn't commit.
+    """
+    boards = {}
+    for usp in usps:
+        boards.setdefault((usp.situationid, usp.order, usp.public_ranges),
+                          []).append(usp)
+    for (situationid, order, public_ranges), changed in boards.iteritems():
+        cached = session.query(CachedLeaderboardEntry)  \
+            .filter(_on_board(CachedLeaderboardEntry, situationid, order,
+                              public_ranges)).all()
+        if _is_affected(cached, changed):
+            refresh_leaderboard(session, situationid, order, public_ranges)
+
+def rename_user(session, userid, screenname):
+    """
+    Update the user's screenname on the leaderboards. Doesn't commit.
+    """
+    session.query(CachedLeaderboardEntry)  \
+        .filter(CachedLeaderboardEntry.userid == userid)  \
+        .update({CachedLeaderboardEntry.screenname: screenname})
+
+def _entry(screenname, row):
+    """
+    LeaderboardEntry from a CachedLeaderboardEntry or UserSituationPlayer
+    """
+    return LeaderboardEntry(
+        screenname=screenname,
+        average=row.amount_won / row.hands_played,
+        redline=row.redline / row.hands_played,
+        blueline=row.blueline / row.hands_played,
+        confidence=row.confidence,
+        played=row.hands_played)
+
+def get_leaderboard(session, situationid, order, public_ranges, size,
+                    min_played):
+    """
+    List (with max length size) of LeaderboardEntry for users who have played
+    at least min_played hands in this seat, best first
+    """
+    cached = session.query(CachedLeaderboardEntry)  \
+        .filter(_on_board(CachedLeaderboardEntry, situationid, order,
+                          public_ranges))  \
+        .order_by(CachedLeaderboardEntry.rank).all()
+    entries = [_entry(row.screenname, row) for row in cached
+               if row.hands_played >= min_played][:size]
+    if len(entries) == size or len(cached) < CACHE_SIZE:
+        return entries
+    # not enough of the cached entries have played enough hands
+    ranking = _ranking(session, situationid, order, public_ranges)  \
+        .filter(UserSituationPlayer.hands_played >= min_played)  \
+        .limit(size)
+    return [_entry(user.screenname, usp) for usp, user in ranking]
+
+class Test(unittest.TestCase):
+    """ Tests for cached leaderboards """
+    # pylint:disable=C0103,R0904
+    def setUp(self):
+        from rvr.db.creation import BASE
+        engine = create_engine('sqlite://')
+        BASE.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.usps = {}
+
+    def tearDown(self):
+        self.session.close()
+
+    def _usp(self, userid, confidence, hands_played=10, order=0):
+        """ Create or change a user's UserSituationPlayer """
+        if userid not in self.usps:
+            user = User()
+            user.userid = userid
+            user.identity = user.email = str(userid)
+            user.unsubscribed = False
+            user.last_seen = datetime.datetime(2016, 1, 1)
+            self.session.add(user)
+            usp = UserSituationPlayer()
+            usp.userid = userid
+            usp.situationid = 1
+            usp.order = order
+            usp.public_ranges = False
+            self.session.add(usp)
+            self.usps[userid] = usp
+        usp = self.usps[userid]
+        usp.amount_won = usp.redline = usp.blueline = 1.0 * hands_played
+        usp.hands_played = hands_played
+        usp.confidence = confidence
+        self.session.flush()
+        update_leaderboards(self.session, [usp])
+
+    def _board(self, size=CACHE_SIZE, min_played=1):
+        """ userids on the leaderboard """
+        return [int(entry.screenname.split()[1])
+                for entry in get_leaderboard(self.session, 1, 0, False, size,
+                                             min_played)]
+
+    def test_update(self):
+        for userid in range(1, CACHE_SIZE + 2):
+            self._usp(userid, 0.5 + userid / 100.0)
+        self._usp(100, 0.4)
+        self.assertEqual(self._board(3), [CACHE_SIZE + 1, CACHE_SIZE, 19])
+        self.assertEqual(len(self._board()), CACHE_SIZE)
+        self.assertNotIn(1, self._board())
+        # user 1 moves to the top, and the last user drops off
+        self._usp(1, 0.99)
+        self.assertEqual(self._board(2), [1, CACHE_SIZE + 1])
+        self._usp(CACHE_SIZE + 1, 0.1)
+        self.assertEqual(len(self._board()), CACHE_SIZE)
+        self.assertNotIn(CACHE_SIZE + 1, self._board())
+        # below the cached entries, nothing changes
+        entries = self.session.query(CachedLeaderboardEntry).all()
+        self._usp(100, 0.505)
+        self.assertEqual(self.session.query(CachedLeaderboardEntry).all(),
+                         entries)
+        # other seats don't matter
+        self._usp(200, 0.99, order=1)
+        self.assertEqual(self._board(1), [1])
+        rename_user(self.session, 1, "Player 1000")
+        self.assertEqual(self._board(1), [1000])
+
+    def test_min_played(self):
+        # the users who've played most are doing worst
+        for userid in range(1, CACHE_SIZE + 2):
+            self._usp(userid, 0.5 + userid / 100.0,
+                      hands_played=CACHE_SIZE + 2 - userid)
+        self.assertNotIn(1, self._board())
+        self.assertEqual(self._board(2, min_played=CACHE_SIZE), [2, 1])
+        self.assertEqual(self._board(3, min_played=CACHE_SIZE), [2, 1])
+        self.assertEqual(self._board(2, min_played=CACHE_SIZE + 2), [])
+        self.session.query(CachedLeaderboardEntry).delete()
+        refresh_all_leaderboards(self.session)
+        self.assertEqual(self._board(1), [CACHE_SIZE + 1])
+
+if __name__ == '__main__':
+    unittest.main()
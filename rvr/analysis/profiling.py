@@ -0,0 +1,203 @@
+"""
+Lightweight timers and counters for the phases of analysing a game, aggregated
+per game into AnalysisProfile.
+
+A phase is timed from start to finish, including any phases nested in it.
+Counters (equity calculations, their iterations, combos processed, rows written)
+go to the innermost phase in progress.
+"""
+import time
+import unittest
+from contextlib import contextmanager
+from functools import wraps
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm.session import sessionmaker
+from rvr.db.tables import AnalysisProfile
+from rvr.core.dtos import AnalysisPhaseProfile, GameAnalysisTime
+
+COUNTERS = ['equity_calls', 'iterations', 'combos', 'rows']
+# phases that aren't nested in anything, which add up to the game's total
+TOP_PHASES = ['advance', 'analyse', 'rebuild']
+
+class PhaseStats(object):
+    """
+    Time and counters for one phase
+    """
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.equity_calls = 0
+        self.iterations = 0
+        self.combos = 0
+        self.rows = 0
+
+    def __repr__(self):
+        return "PhaseStats(calls=%r, seconds=%r, equity_calls=%r, "  \
+            "iterations=%r, combos=%r, rows=%r)" %  \
+            (self.calls, self.seconds, self.equity_calls, self.iterations,
+             self.combos, self.rows)
+
+class AnalysisProfiler(object):
+    """
+    Phase timers and counters for one AnalysisReplayer
+    """
+    def __init__(self):
+        self.stats = {}  # map of phase name to PhaseStats
+        self.stack = []  # names of phases in progress, innermost last
+
+    def _stats(self, name):
+        """
+        PhaseStats for this phase, created if necessary
+        """
+        if name not in self.stats:
+            self.stats[name] = PhaseStats()
+        return self.stats[name]
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the body of a with statement as this phase
+        """
+        self.stack.append(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.stack.pop()
+            stats = self._stats(name)
+            stats.calls += 1
+            stats.seconds += elapsed
+
+    def count(self, **counters):
+        """
+        Add to the counters of the innermost phase in progress, e.g.
+        count(equity_calls=1, iterations=1000)
+        """
+        stats = self._stats(self.stack[-1] if self.stack else 'other')
+        for name, value in counters.iteritems():
+            setattr(stats, name, getattr(stats, name) + value)
+
+    def save(self, session, gameid):
+        """
+        Add what we've measured to the game's AnalysisProfile rows, and start
+        measuring again from zero. Doesn't commit.
+        """
+        existing = {row.phase: row for row in session.query(AnalysisProfile)
+                    .filter(AnalysisProfile.gameid == gameid).all()}
+        for name, stats in self.stats.iteritems():
+            row = existing.get(name)
+            if row is None:
+                row = AnalysisProfile()
+                row.gameid = gameid
+                row.phase = name
+                row.calls = row.seconds = 0
+                for counter in COUNTERS:
+                    setattr(row, counter, 0)
+                session.add(row)
+            row.calls += stats.calls
+            row.seconds += stats.seconds
+            for counter in COUNTERS:
+                setattr(row, counter,
+                        getattr(row, counter) + getattr(stats, counter))
+        self.stats = {}
+
+def profiled(name):
+    """
+    Decorator for a method of an object with a profiler, timing it as a phase
+    """
+    def decorator(fun):
+        """ the decorator """
+        @wraps(fun)
+        def inner(self, *args, **kwargs):
+            """ the decorated method """
+            with self.profiler.phase(name):
+                return fun(self, *args, **kwargs)
+        return inner
+    return decorator
+
+def game_profile(session, gameid):
+    """
+    List of AnalysisPhaseProfile for a game, slowest first
+    """
+    rows = session.query(AnalysisProfile)  \
+        .filter(AnalysisProfile.gameid == gameid)  \
+        .order_by(AnalysisProfile.seconds.desc()).all()
+    return [AnalysisPhaseProfile(row.phase, row.calls, row.seconds,
+                                 *[getattr(row, counter)
+                                   for counter in COUNTERS])
+            for row in rows]
+
+def slowest_phases(session):
+    """
+    List of AnalysisPhaseProfile, totalled over all games, slowest first
+    """
+    total = func.sum(AnalysisProfile.seconds)
+    rows = session.query(AnalysisProfile.phase,
+                         func.sum(AnalysisProfile.calls), total,
+                         *[func.sum(getattr(AnalysisProfile, counter))
+                           for counter in COUNTERS])  \
+        .group_by(AnalysisProfile.phase)  \
+        .order_by(total.desc()).all()
+    return [AnalysisPhaseProfile(*row) for row in rows]
+
+def slowest_games(session, count=10):
+    """
+    List of GameAnalysisTime for the <count> games that took longest to analyse
+    """
+    total = func.sum(AnalysisProfile.seconds)
+    rows = session.query(AnalysisProfile.gameid, total)  \
+        .filter(AnalysisProfile.phase.in_(TOP_PHASES))  \
+        .group_by(AnalysisProfile.gameid)  \
+        .order_by(total.desc()).limit(count).all()
+    return [GameAnalysisTime(gameid, seconds) for gameid, seconds in rows]
+
+class Test(unittest.TestCase):
+    """ Tests for AnalysisProfiler """
+    # pylint:disable=C0103,R0904
+    def test_nested_phases(self):
+        profiler = AnalysisProfiler()
+        with profiler.phase('outer'):
+            profiler.count(rows=1)
+            for _ in range(2):
+                with profiler.phase('inner'):
+                    profiler.count(equity_calls=1, iterations=100)
+        profiler.count(combos=3)
+        self.assertEqual(profiler.stats['outer'].calls, 1)
+        self.assertEqual(profiler.stats['outer'].rows, 1)
+        self.assertEqual(profiler.stats['outer'].equity_calls, 0)
+        self.assertEqual(profiler.stats['inner'].calls, 2)
+        self.assertEqual(profiler.stats['inner'].iterations, 200)
+        self.assertEqual(profiler.stats['other'].combos, 3)
+        self.assertTrue(profiler.stats['outer'].seconds >=
+                        profiler.stats['inner'].seconds)
+
+    def test_save(self):
+        engine = create_engine('sqlite://')
+        AnalysisProfile.__table__.create(engine)
+        session = sessionmaker(bind=engine)()
+        profiler = AnalysisProfiler()
+        for _ in range(2):
+            with profiler.phase('advance'):
+                profiler.count(rows=5)
+            profiler.save(session, 1)
+            session.commit()
+        row = session.query(AnalysisProfile).one()
+        self.assertEqual((row.gameid, row.phase), (1, 'advance'))
+        self.assertEqual((row.calls, row.rows), (2, 10))
+        with profiler.phase('analyse'):
+            with profiler.phase('finalise_results'):
+                profiler.count(rows=2)
+        profiler.save(session, 2)
+        session.commit()
+        self.assertEqual(set(game.gameid for game in slowest_games(session)),
+                         set([1, 2]))
+        self.assertEqual(set(phase.phase for phase in slowest_phases(session)),
+                         set(['advance', 'analyse', 'finalise_results']))
+        phases = game_profile(session, 2)
+        self.assertEqual(phases[0].phase, 'analyse')
+        self.assertEqual(phases[1].rows, 2)
+        session.close()
+
+if __name__ == '__main__':
+    unittest.main()
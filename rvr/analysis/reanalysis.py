@@ -0,0 +1,482 @@
+"""
+Sharded, resumable bulk reanalysis of every finished game.
+
+Starting a run partitions the finished games by game id into shards
+(ReanalysisShard). Worker processes claim shards with a lease, the same way
+analysis jobs are claimed, and reanalyse each shard's games in order. Each
+game's old analysis is deleted and its new analysis written in a single
+transaction, along with the shard's progress, so the site keeps serving the old
+analysis until the new one replaces it, and a shard whose worker dies continues
+from its last game when it is claimed again. A shard that fails is retried, up
+to MAX_ATTEMPTS times, and can be queued again with resume_reanalysis().
+
+Games whose analysis inputs haven't changed (see analysis_input_hash) are
+skipped, unless the run is forced.
+
+Reanalysis doesn't notify anyone, unlike analysing a game as it finishes.
+"""
+import datetime
+import logging
+import time
+import traceback
+import unittest
+from sqlalchemy import create_engine, and_, or_, func
+from sqlalchemy.orm.session import sessionmaker
+from rvr.db.creation import BASE, ENGINE, SESSION
+from rvr.db.tables import ReanalysisShard, RunningGame
+from rvr.analysis.analyse import AnalysisReplayer, delete_analysis,  \
+    analysis_is_current
+from rvr.analysis.jobs import worker_name, run_workers, WORKER_COUNT,  \
+    MAX_ATTEMPTS, POLL_SECONDS
+from rvr.core.dtos import ReanalysisStatus
+from rvr.local_settings import SUPPRESSED_GAME_MAX
+from rvr.poker.cards import FINISHED
+
+SHARD_SIZE = 50  # games per shard
+# The lease is extended as each game is swapped in, so it needs to be longer
+# than it takes to analyse any one game.
+LEASE_SECONDS = 900
+
+def _finished_games(session):
+    """
+    Query for the ids of games to be reanalysed
+    """
+    return session.query(RunningGame.gameid)  \
+        .filter(RunningGame.current_round == FINISHED)  \
+        .filter(RunningGame.gameid > SUPPRESSED_GAME_MAX)
+
+def _unfinished_shards(session):
+    """
+    Query for shards that haven't finished (or given up)
+    """
+    return session.query(ReanalysisShard).filter(ReanalysisShard.status.in_(
+        [ReanalysisShard.STATUS_QUEUED, ReanalysisShard.STATUS_RUNNING]))
+
+def start_reanalysis(session, shard_size=SHARD_SIZE, now=None, force=False):
+    """
+    Create the shards for a new run, and commit. Returns the run id, or None if
+    a previous run hasn't finished.
+
+    If force, games are reanalysed even if their analysis inputs haven't
+    changed.
+    """
+    if _unfinished_shards(session).count():
+        return None
+    now = now or datetime.datetime.utcnow()
+    gameids = [gameid for gameid, in
+               _finished_games(session).order_by(RunningGame.gameid).all()]
+    runid = (session.query(func.max(ReanalysisShard.runid)).scalar() or 0) + 1
+    for i in range(0, len(gameids), shard_size):
+        chunk = gameids[i:i + shard_size]
+        shard = ReanalysisShard()
+        shard.runid = runid
+        shard.min_gameid = chunk[0]
+        shard.max_gameid = chunk[-1]
+        shard.status = ReanalysisShard.STATUS_QUEUED
+        shard.attempts = 0
+        shard.force = force
+        shard.games_total = len(chunk)
+        shard.games_done = 0
+        shard.created_time = now
+        session.add(shard)
+    session.commit()
+    logging.info("reanalysis run %d, %d games in %d shards", runid,
+                 len(gameids), (len(gameids) + shard_size - 1) / shard_size)
+    return runid
+
+def resume_reanalysis(session):
+    """
+    Queue failed shards of the latest run again, and commit. Returns the number
+    of shards.
+    """
+    runid = session.query(func.max(ReanalysisShard.runid)).scalar()
+    count = session.query(ReanalysisShard)  \
+        .filter(ReanalysisShard.runid == runid)  \
+        .filter(ReanalysisShard.status == ReanalysisShard.STATUS_FAILED)  \
+        .update({ReanalysisShard.status: ReanalysisShard.STATUS_QUEUED,
+                 ReanalysisShard.attempts: 0,
+                 ReanalysisShard.finished_time: None,
+                 ReanalysisShard.error: None},
+                synchronize_session=False)
+    session.commit()
+    return count
+
+def _claimable(now, worker):
+    """
+    Filter for shards that <worker> can claim at <now>, including one it still
+    holds after an error (e.g. a database lock) stopped it recording the outcome
+    """
+    return or_(ReanalysisShard.status == ReanalysisShard.STATUS_QUEUED,
+               and_(ReanalysisShard.status == ReanalysisShard.STATUS_RUNNING,
+                    or_(ReanalysisShard.lease_expires < now,
+                        ReanalysisShard.worker == worker),
+                    ReanalysisShard.attempts < MAX_ATTEMPTS))
+
+def _fail_abandoned(session, now):
+    """
+    Shards whose lease has expired on their last attempt won't be retried.
+    """
+    count = session.query(ReanalysisShard)  \
+        .filter(ReanalysisShard.status == ReanalysisShard.STATUS_RUNNING)  \
+        .filter(ReanalysisShard.lease_expires < now)  \
+        .filter(ReanalysisShard.attempts >= MAX_ATTEMPTS)  \
+        .update({ReanalysisShard.status: ReanalysisShard.STATUS_FAILED,
+                 ReanalysisShard.finished_time: now,
+                 ReanalysisShard.lease_expires: None,
+                 ReanalysisShard.error: "lease expired"},
+                synchronize_session=False)
+    if count:
+        logging.warning("%d reanalysis shards abandoned", count)
+
+def claim_shard(session, worker, now=None):
+    """
+    Claim the next available shard for <worker>, and commit. Returns the shard,
+    or None if there is nothing to do.
+    """
+    now = now or datetime.datetime.utcnow()
+    _fail_abandoned(session, now)
+    candidates = session.query(ReanalysisShard.shardid)  \
+        .filter(_claimable(now, worker))  \
+        .order_by(ReanalysisShard.shardid).limit(5).all()
+    for shardid, in candidates:
+        claimed = session.query(ReanalysisShard)  \
+            .filter(ReanalysisShard.shardid == shardid)  \
+            .filter(_claimable(now, worker))  \
+            .update({ReanalysisShard.status: ReanalysisShard.STATUS_RUNNING,
+                     ReanalysisShard.worker: worker,
+                     ReanalysisShard.attempts: ReanalysisShard.attempts + 1,
+                     ReanalysisShard.lease_expires:
+                         now + datetime.timedelta(seconds=LEASE_SECONDS),
+                     ReanalysisShard.started_time:
+                         func.coalesce(ReanalysisShard.started_time, now),
+                     ReanalysisShard.updated_time: now},
+                    synchronize_session=False)
+        session.commit()
+        if claimed:
+            return session.query(ReanalysisShard)  \
+                .filter(ReanalysisShard.shardid == shardid).one()
+    session.commit()
+    return None
+
+def _held(shardid, worker):
+    """
+    Filter for <worker> still holding the lease on a shard
+    """
+    return and_(ReanalysisShard.shardid == shardid,
+                ReanalysisShard.worker == worker,
+                ReanalysisShard.status == ReanalysisShard.STATUS_RUNNING)
+
+def _record_progress(session, shardid, worker, gameid, now=None):
+    """
+    Record that a game has been reanalysed, and extend the lease, but don't
+    commit. Returns False if the worker no longer holds the lease.
+    """
+    now = now or datetime.datetime.utcnow()
+    return bool(session.query(ReanalysisShard)
+                .filter(_held(shardid, worker))
+                .update({ReanalysisShard.last_gameid: gameid,
+                         ReanalysisShard.games_done:
+                             ReanalysisShard.games_done + 1,
+                         ReanalysisShard.lease_expires:
+                             now + datetime.timedelta(seconds=LEASE_SECONDS),
+                         ReanalysisShard.updated_time: now},
+                        synchronize_session=False))
+
+def _finish_shard(session, shardid, worker, error=None, now=None):
+    """
+    Record the outcome of a shard, and commit. A failed shard is queued again,
+    unless it has already had MAX_ATTEMPTS attempts.
+    """
+    now = now or datetime.datetime.utcnow()
+    shard = session.query(ReanalysisShard)  \
+        .filter(_held(shardid, worker)).first()
+    if shard is None:
+        logging.warning("reanalysis shard %d, worker %s no longer holds lease",
+                        shardid, worker)
+        session.commit()
+        return
+    shard.lease_expires = None
+    shard.updated_time = now
+    shard.error = error[:200] if error is not None else None
+    if error is None:
+        shard.status = ReanalysisShard.STATUS_DONE
+        shard.finished_time = now
+    elif shard.attempts >= MAX_ATTEMPTS:
+        shard.status = ReanalysisShard.STATUS_FAILED
+        shard.finished_time = now
+    else:
+        shard.status = ReanalysisShard.STATUS_QUEUED
+    session.commit()
+
+def reanalyse_game(session, gameid):
+    """
+    Replace the game's analysis with a new analysis, without committing.
+    """
+    game = session.query(RunningGame)  \
+        .filter(RunningGame.gameid == gameid).one()
+    delete_analysis(session, gameid)
+    game.analysis_performed = False
+    AnalysisReplayer(session, game).rebuild()
+
+def _is_current(session, gameid):
+    """
+    Is the game's analysis current, so it doesn't need reanalysing?
+    """
+    return analysis_is_current(session, session.query(RunningGame)
+                               .filter(RunningGame.gameid == gameid).one())
+
+def run_shard(session, shardid, worker, function=reanalyse_game,
+              is_current=_is_current):
+    """
+    Reanalyse the shard's games, from where it got to, committing each game
+    along with the shard's progress. Returns True if the shard was completed.
+
+    Unless the shard is forced, games whose analysis is current are skipped
+    (but count as done).
+    """
+    shard = session.query(ReanalysisShard)  \
+        .filter(ReanalysisShard.shardid == shardid).one()
+    force = shard.force
+    games = _finished_games(session)  \
+        .filter(RunningGame.gameid >= shard.min_gameid)  \
+        .filter(RunningGame.gameid <= shard.max_gameid)
+    if shard.last_gameid is not None:
+        games = games.filter(RunningGame.gameid > shard.last_gameid)
+    gameids = [gameid for gameid, in games.order_by(RunningGame.gameid).all()]
+    session.commit()
+    skipped = 0
+    for gameid in gameids:
+        try:
+            if not force and is_current(session, gameid):
+                skipped += 1
+            else:
+                function(session, gameid)
+        except Exception:  # pylint:disable=broad-except
+            logging.exception("reanalysis shard %d, gameid %d, failed",
+                              shardid, gameid)
+            session.rollback()
+            _finish_shard(session, shardid, worker,
+                          "gameid %d: %s" % (gameid,
+                              traceback.format_exc().splitlines()[-1]))
+            return False
+        if not _record_progress(session, shardid, worker, gameid):
+            logging.warning("reanalysis shard %d, worker %s lost lease",
+                            shardid, worker)
+            session.rollback()
+            return False
+        session.commit()
+        logging.debug("reanalysis shard %d, gameid %d, swapped in",
+                      shardid, gameid)
+    if skipped:
+        logging.info("reanalysis shard %d, %d games unchanged", shardid,
+                     skipped)
+    _finish_shard(session, shardid, worker)
+    return True
+
+def run_one_shard(worker, session_maker=SESSION, function=reanalyse_game):
+    """
+    Claim and run one shard. Returns False if there was nothing to do.
+    """
+    session = session_maker()
+    try:
+        shard = claim_shard(session, worker)
+        if shard is None:
+            return False
+        shardid = shard.shardid
+        logging.info("reanalysis shard %d, games %d to %d, attempt %d, "
+                     "claimed by %s", shardid, shard.min_gameid,
+                     shard.max_gameid, shard.attempts, worker)
+        done = run_shard(session, shardid, worker, function)
+        logging.info("reanalysis shard %d, %s", shardid,
+                     "done" if done else "not done")
+        return True
+    finally:
+        session.close()
+
+def run_reanalysis_worker(poll=POLL_SECONDS):
+    """
+    Work shards until there are none left to claim.
+
+    This is the body of a reanalysis worker process.
+    """
+    ENGINE.dispose()  # don't share the parent process's connections
+    worker = worker_name()
+    logging.info("reanalysis worker %s starting", worker)
+    while True:
+        try:
+            if not run_one_shard(worker):
+                break
+        except Exception:  # pylint:disable=broad-except
+            logging.exception("reanalysis worker %s, error", worker)
+            time.sleep(poll)
+    logging.info("reanalysis worker %s finished", worker)
+
+def run_reanalysis(count=WORKER_COUNT):
+    """
+    Start <count> reanalysis worker processes, and wait for them to finish.
+    """
+    run_workers(count, target=run_reanalysis_worker)
+
+def reanalysis_status(session, now=None):
+    """
+    Returns ReanalysisStatus for the latest run, or None if there hasn't been
+    one.
+    """
+    now = now or datetime.datetime.utcnow()
+    runid = session.query(func.max(ReanalysisShard.runid)).scalar()
+    if runid is None:
+        return None
+    counts = dict(session.query(ReanalysisShard.status, func.count())
+                  .filter(ReanalysisShard.runid == runid)
+                  .group_by(ReanalysisShard.status).all())
+    games_total, games_done, started = session.query(
+        func.sum(ReanalysisShard.games_total),
+        func.sum(ReanalysisShard.games_done),
+        func.min(ReanalysisShard.started_time))  \
+        .filter(ReanalysisShard.runid == runid).one()
+    games_total = games_total or 0
+    games_done = games_done or 0
+    eta = None
+    if games_done and started is not None:
+        elapsed = (now - started).total_seconds()
+        eta = elapsed / games_done * max(games_total - games_done, 0)
+    return ReanalysisStatus(
+        runid=runid,
+        queued=counts.get(ReanalysisShard.STATUS_QUEUED, 0),
+        running=counts.get(ReanalysisShard.STATUS_RUNNING, 0),
+        done=counts.get(ReanalysisShard.STATUS_DONE, 0),
+        failed=counts.get(ReanalysisShard.STATUS_FAILED, 0),
+        games_total=games_total,
+        games_done=games_done,
+        started=started,
+        eta_seconds=eta)
+
+class Test(unittest.TestCase):
+    """ Tests for sharded reanalysis """
+    # pylint:disable=C0103,R0904
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        BASE.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.now = datetime.datetime(2016, 1, 1)
+
+    def tearDown(self):
+        self.session.close()
+
+    def _later(self, seconds):
+        return self.now + datetime.timedelta(seconds=seconds)
+
+    def _shard(self, min_gameid, max_gameid, status=None, force=False):
+        shard = ReanalysisShard()
+        shard.runid = 1
+        shard.min_gameid = min_gameid
+        shard.max_gameid = max_gameid
+        shard.status = status or ReanalysisShard.STATUS_QUEUED
+        shard.attempts = 0
+        shard.force = force
+        shard.games_total = max_gameid - min_gameid + 1
+        shard.games_done = 0
+        shard.created_time = self.now
+        self.session.add(shard)
+        self.session.commit()
+        return shard.shardid
+
+    def test_claim_and_lease(self):
+        shardid = self._shard(1, 10)
+        shard = claim_shard(self.session, "a", now=self.now)
+        self.assertEqual(shard.shardid, shardid)
+        self.assertIsNone(claim_shard(self.session, "b", now=self.now))
+        # lease expires, and someone else takes over where it got to
+        self.assertTrue(_record_progress(self.session, shardid, "a", 4,
+                                         now=self.now))
+        self.session.commit()
+        shard = claim_shard(self.session, "b",
+                            now=self._later(LEASE_SECONDS + 1))
+        self.assertEqual(shard.worker, "b")
+        self.assertEqual(shard.attempts, 2)
+        self.assertEqual(shard.last_gameid, 4)
+        self.assertEqual(shard.started_time, self.now)
+        self.assertFalse(_record_progress(self.session, shardid, "a", 5))
+        self.session.rollback()
+        # b can take back its own shard, e.g. after an error
+        self.assertEqual(claim_shard(self.session, "b",
+                                     now=self._later(LEASE_SECONDS + 2))
+                         .shardid, shardid)
+        self.assertIsNone(claim_shard(self.session, "a",
+                                      now=self._later(LEASE_SECONDS + 2)))
+
+    def _game(self, gameid, current_round=FINISHED):
+        self.session.execute(RunningGame.__table__.insert(), {
+            'gameid': gameid, 'situationid': 1, 'public_ranges': False,
+            'next_hh': 0, 'board_raw': '', 'total_board_raw': '',
+            'current_round': current_round, 'pot_pre': 0, 'increment': 1,
+            'bet_count': 0, 'current_factor': 1.0,
+            'last_action_time': self.now, 'analysis_performed': True,
+            'spawn_finished': True, 'spawn_factor': 1.0})
+
+    def test_run_shard(self):
+        for gameid in [1, 2, 3, 11]:
+            self._game(gameid)
+        self._game(4, current_round="Flop")
+        shardid = self._shard(1, 10)
+        claim_shard(self.session, "a", now=self.now)
+        done = []
+        def reanalyse(_session, gameid):
+            if gameid == 3 and 3 not in done:
+                done.append(3)
+                raise ValueError("boom")
+            done.append(gameid)
+        self.assertFalse(run_shard(self.session, shardid, "a", reanalyse))
+        shard = self.session.query(ReanalysisShard).one()
+        self.assertEqual(shard.status, ReanalysisShard.STATUS_QUEUED)
+        self.assertEqual(shard.last_gameid, 2)
+        self.assertEqual(shard.games_done, 2)
+        self.assertIn("boom", shard.error)
+        # the retry continues from game 3
+        claim_shard(self.session, "a", now=self.now)
+        self.assertTrue(run_shard(self.session, shardid, "a", reanalyse))
+        self.assertEqual(done, [1, 2, 3, 3])
+        shard = self.session.query(ReanalysisShard).one()
+        self.assertEqual(shard.status, ReanalysisShard.STATUS_DONE)
+        self.assertEqual(shard.games_done, 3)
+
+    def test_skip_current(self):
+        for gameid in [1, 2, 3]:
+            self._game(gameid)
+        done = []
+        is_current = lambda _session, gameid: gameid == 2
+        shardid = self._shard(1, 10)
+        claim_shard(self.session, "a", now=self.now)
+        self.assertTrue(run_shard(self.session, shardid, "a",
+                                  lambda _session, gameid: done.append(gameid),
+                                  is_current))
+        self.assertEqual(done, [1, 3])
+        shard = self.session.query(ReanalysisShard).one()
+        self.assertEqual(shard.games_done, 3)
+        # forced
+        shardid = self._shard(1, 10, force=True)
+        claim_shard(self.session, "a", now=self.now)
+        del done[:]
+        self.assertTrue(run_shard(self.session, shardid, "a",
+                                  lambda _session, gameid: done.append(gameid),
+                                  is_current))
+        self.assertEqual(done, [1, 2, 3])
+
+    def test_status(self):
+        self.assertIsNone(reanalysis_status(self.session))
+        self._shard(1, 10)
+        shardid = self._shard(11, 20)
+        claim_shard(self.session, "a", now=self.now)
+        for gameid in [1, 2, 3, 4, 5]:
+            _record_progress(self.session, shardid - 1, "a", gameid,
+                             now=self.now)
+        self.session.commit()
+        status = reanalysis_status(self.session, now=self._later(50))
+        self.assertEqual(status.runid, 1)
+        self.assertEqual((status.queued, status.running), (1, 1))
+        self.assertEqual((status.games_total, status.games_done), (20, 5))
+        # 5 games in 50 seconds, so 15 more take 150 seconds
+        self.assertAlmostEqual(status.eta_seconds, 150.0)
+
+if __name__ == '__main__':
+    unittest.main()
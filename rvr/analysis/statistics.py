@@ -5,6 +5,14 @@ from rvr.core.dtos import PositionResult, SituationResult
 import math
 from scipy import stats
 import logging
+import datetime
+import unittest
+from sqlalchemy import create_engine, and_, or_, func, bindparam, false
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.session import sessionmaker
+from rvr.poker.cards import FINISHED
+from rvr.analysis.leaderboards import update_leaderboards,  \
+    refresh_leaderboard, refresh_all_leaderboards
 
 def _calculate_confidence(total_result, num_games,
                           be_mean, stddev):
@@ -28,62 +36,388 @@ def _calculate_confidence(total_result, num_games,
 
     Well if X has mean M and std S, then N*X has mean N*M and std sqrt(N)*S
     """
+    return _calculate_confidences(numpy.array([total_result]),
+                                  numpy.array([num_games]),
+                                  numpy.array([be_mean]),
+                                  numpy.array([stddev]))[0]
+
+def _calculate_confidences(total_results, num_games, be_means, stddevs):
+    """
+    _calculate_confidence for many users and positions at once, over numpy
+    arrays of the same shape
+    """
+    # pylint:disable=no-member
+    total_results = total_results.astype(float)
+    be_totals = be_means * num_games
+    be_stddevs = stddevs * numpy.sqrt(num_games)
+    # the average player's results total after num_games games is normally
+    # distributed with mean be_total and standard deviation be_stddev
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        confidences = stats.norm.cdf((total_results - be_totals) / be_stddevs)
+    # too few games: 1.0, 0.0, or if they're equal, 0.5 (that's just silly!)
+    too_few = be_stddevs == 0.0
+    confidences[too_few] =  \
+        0.5 + 0.5 * numpy.sign(total_results - be_totals)[too_few]
+    confidences[num_games == 0] = 0.5
+    return confidences
+
+def _group_key():
+    """
+    The spawn group of a RunningGame, as a column expression (a game without a
+    spawn group is a group of its own)
+    """
+    return func.coalesce(tables.RunningGame.spawn_group,
+                         tables.RunningGame.gameid)
+
+def _in_group(spawn_group):
+    """
+    Filter for the games in this spawn group
+    """
+    game = tables.RunningGame
+    return or_(game.spawn_group == spawn_group,
+               and_(game.spawn_group == None, game.gameid == spawn_group))
+
+def _incomplete_groups(session):
+    """
+    Query of spawn groups that don't count towards users' statistics: groups
+    with a game that isn't finished, hasn't been analysed, or has a timeout in
+    its history.
+    """
+    # pylint:disable=no-member
+    game = tables.RunningGame
+    return session.query(_group_key())  \
+        .filter(or_(game.current_round != FINISHED,
+                    game.analysis_performed == False,
+                    _timed_out(_timed_out_gameids(session))))
+
+def _group_results(session):
+    """
+    Query of (spawn_group, userid, situationid, order, public_ranges, scheme,
+    result) for each user's result in each spawn group they've played, summed
+    over the group's games, weighted by spawn factor
+    """
+    # pylint:disable=no-member
+    rgp = tables.RunningGameParticipant
+    result = tables.RunningGameParticipantResult
+    game = tables.RunningGame
+    group = _group_key()
+    return session.query(group.label('spawn_group'),
+                         rgp.userid.label('userid'),
+                         game.situationid.label('situationid'),
+                         rgp.order.label('order'),
+                         game.public_ranges.label('public_ranges'),
+                         result.scheme.label('scheme'),
+                         func.sum(result.result * game.spawn_factor)
+                         .label('result'))  \
+        .join(rgp, rgp.gameid == game.gameid)  \
+        .join(result, and_(result.gameid == rgp.gameid,
+                           result.userid == rgp.userid))  \
+        .filter(game.gameid > SUPPRESSED_GAME_MAX)  \
+        .group_by(group, rgp.userid, game.situationid, rgp.order,
+                  game.public_ranges, result.scheme)
+
+def _totals(rollups):
+    """
+    (played, total, redline, blueline) for a user in a seat, from their
+    UserPositionResult rows for it, as a map of scheme to row
+    """
+    ev = rollups.get(tables.RunningGameParticipantResult.SCHEME_EV)
+    redline = rollups.get(tables.RunningGameParticipantResult.SCHEME_NSD)
+    blueline = rollups.get(tables.RunningGameParticipantResult.SCHEME_SD)
+    return (ev.groups if ev is not None else 0,
+            ev.total if ev is not None else None,
+            redline.total if redline is not None else None,
+            blueline.total if blueline is not None else None)
+
+def _position_result(player, rollups):
+    """
+    PositionResult for a user in this seat, from their UserPositionResult rows
+    for it, as a map of scheme to row
+    """
+    played, total, redline, blueline = _totals(rollups)
+    if player.average_result is None:
+        confidence = None  # before global statistics are calculated
+    else:
+        confidence = _calculate_confidence(
+            total_result=total or 0.0,
+            num_games=played,
+            be_mean=player.average_result,
+            stddev=player.stddev)  # population stats are more reliable
+    return PositionResult(
+        situationid=player.situationid,
+        order=player.order,
+        name=player.name,
+        ev=player.average_result,  # situation ev
+        stddev=player.stddev,  # population stats are more reliable
+        played=played,
+        total=total,
+        redline=redline,
+        blueline=blueline,
+        average=total / played if played else None,
+        confidence=confidence)
+
+def _write_user_situation_players(session, keys=None):
+    """
+    Write UserSituationPlayer, for leaderboards, from UserPositionResult, for
+    these (userid, situationid, order, public_ranges), or for everyone, and
+    update the leaderboards to match
+    """
     # pylint:disable=no-member
-    if num_games == 0:
-        return 0.5
-    be_total = be_mean * num_games
-    be_stddev = stddev * math.sqrt(num_games)
-    if be_stddev == 0.0:  # too few games
-        if total_result > be_total:
-            return 1.0
-        elif total_result < be_total:
-            return 0.0
-        else:
-            return 0.5  # now that's just silly!
-    # the following is what the average player's results total looks like after
-    # num_games games
-    be_norm = stats.norm(loc=be_total, scale=be_stddev)
-    return be_norm.cdf(total_result)
-
-def _get_ev(game, order, userid, scheme):
-    """
-    Return user's result for scheme, or None
-    """
-    for rgp in game.rgps:
-        if rgp.order == order and rgp.userid == userid:
-            for result in rgp.results:
-                if result.scheme == scheme:
-                    return result.result
-    return None
-
-def _get_all_results(groups, order, userid, scheme):
-    """
-    Return user's results for scheme
-    """
-    results = {}
-    for spawn_group, games in groups.iteritems():
-        for game in games:
-            ev = _get_ev(game=game, order=order,
-                         userid=userid, scheme=scheme)
-            if ev is not None:  # they did play this position
-                results.setdefault(spawn_group, 0.0)
-                results[spawn_group] += ev * game.spawn_factor
-    return filter(lambda x: x is not None, results.values())
-
-def _game_timed_out(session, game):
-    """
-    Did this game time out?
-    """
-    return session.query(tables.GameHistoryTimeout)  \
-        .filter(tables.GameHistoryTimeout.gameid == game.gameid)  \
-        .count() > 0
+    rollup = tables.UserPositionResult
+    query = session.query(rollup)
+    if keys is not None:
+        if not keys:
+            return
+        query = query  \
+            .filter(rollup.userid.in_(set(key[0] for key in keys)))  \
+            .filter(rollup.situationid.in_(set(key[1] for key in keys)))
+    positions = {}
+    for row in query.all():
+        positions.setdefault((row.userid, row.situationid, row.order,
+                              row.public_ranges), {})[row.scheme] = row
+    if keys is None:
+        _insert_user_situation_players(session, positions)
+        return
+    players = {(player.situationid, player.order): player
+               for player in session.query(tables.SituationPlayer).all()}
+    usps = []
+    for userid, situationid, order, public_ranges in keys:
+        pos = _position_result(players[situationid, order],
+            positions.get((userid, situationid, order, public_ranges), {}))
+        usp = tables.UserSituationPlayer()
+        usp.userid = userid
+        usp.situationid = situationid
+        usp.order = order
+        usp.public_ranges = public_ranges
+        usp.amount_won = pos.total
+        usp.redline = pos.redline
+        usp.blueline = pos.blueline
+        usp.hands_played = pos.played
+        usp.confidence = pos.confidence
+        usps.append(session.merge(usp))  # insert or update
+    update_leaderboards(session, usps)
+
+def _insert_user_situation_players(session, positions):
+    """
+    Replace all UserSituationPlayer with these, from a map of (userid,
+    situationid, order, public_ranges) to a map of scheme to UserPositionResult,
+    and refresh the leaderboards
+    """
+    session.query(tables.UserSituationPlayer).delete()
+    rows = []
+    for (userid, situationid, order, public_ranges), rollups  \
+            in positions.iteritems():
+        played, total, redline, blueline = _totals(rollups)
+        rows.append({'userid': userid, 'situationid': situationid,
+                     'order': order, 'public_ranges': public_ranges,
+                     'amount_won': total, 'redline': redline,
+                     'blueline': blueline, 'hands_played': played})
+    if rows:
+        session.execute(tables.UserSituationPlayer.__table__.insert(), rows)
+    refresh_confidences(session)
+
+def _floats(values, default):
+    """
+    numpy array of values, with default for None
+    """
+    return numpy.array([default if value is None else value
+                        for value in values], dtype=float)
+
+def refresh_confidences(session, positions=None):
+    """
+    Recalculate UserSituationPlayer's confidence, relative to the current
+    situation averages, in one pass, and refresh their leaderboards. This is
+    for the (situationid, order) in positions, or for everyone.
+
+    Doesn't commit.
+    """
+    # pylint:disable=no-member
+    usp = tables.UserSituationPlayer
+    player = tables.SituationPlayer
+    query = session.query(usp.userid, usp.situationid, usp.order,
+                          usp.public_ranges, usp.amount_won, usp.hands_played,
+                          player.average_result, player.stddev)  \
+        .join(player, and_(player.situationid == usp.situationid,
+                           player.order == usp.order))
+    if positions is not None:
+        if not positions:
+            return
+        query = query.filter(or_(*[and_(usp.situationid == situationid,
+                                         usp.order == order)
+                                   for situationid, order in positions]))
+    rows = query.all()
+    if rows:
+        _, _, _, _, totals, played, means, stddevs = zip(*rows)
+        means = _floats(means, numpy.nan)
+        confidences = _calculate_confidences(_floats(totals, 0.0),
+                                             _floats(played, 0),
+                                             means,
+                                             _floats(stddevs, numpy.nan))
+        table = usp.__table__
+        session.execute(table.update()
+            .where(and_(table.c.userid == bindparam('b_userid'),
+                        table.c.situationid == bindparam('b_situationid'),
+                        table.c.order == bindparam('b_order'),
+                        table.c.public_ranges == bindparam('b_public_ranges')))
+            .values(confidence=bindparam('b_confidence')),
+            [{'b_userid': values[0], 'b_situationid': values[1],
+              'b_order': values[2], 'b_public_ranges': values[3],
+              # unknown before global statistics are calculated
+              'b_confidence': None if numpy.isnan(mean) else float(confidence)}
+             for values, mean, confidence in zip(rows, means, confidences)])
+    # the ORM doesn't know about the update
+    for obj in session.identity_map.values():
+        if isinstance(obj, usp):
+            session.expire(obj)
+    if positions is None:
+        refresh_all_leaderboards(session)
+    else:
+        for board in set((values[1], values[2], values[3]) for values in rows):
+            refresh_leaderboard(session, *board)
+    logging.info("refreshed confidence for %d users' positions", len(rows))
+
+def _roll_up(session, spawn_group, sign):
+    """
+    Add (sign 1) or subtract (sign -1) the spawn group's results to or from
+    UserPositionResult, and update UserSituationPlayer to match
+    """
+    # pylint:disable=no-member
+    rows = _group_results(session).filter(_in_group(spawn_group)).all()
+    for row in rows:
+        key = (row.userid, row.situationid, row.order, row.public_ranges,
+               row.scheme)
+        rollup = session.query(tables.UserPositionResult).get(key)
+        if rollup is None:
+            rollup = tables.UserPositionResult()
+            (rollup.userid, rollup.situationid, rollup.order,
+             rollup.public_ranges, rollup.scheme) = key
+            rollup.groups = 0
+            rollup.total = rollup.total_squares = 0.0
+            session.add(rollup)
+        rollup.groups += sign
+        rollup.total += sign * row.result
+        rollup.total_squares += sign * row.result * row.result
+        if rollup.groups == 0:
+            session.delete(rollup)
+    session.flush()
+    _write_user_situation_players(session, set(
+        (row.userid, row.situationid, row.order, row.public_ranges)
+        for row in rows))
+    logging.debug("spawn group %d, %s %d results", spawn_group,
+                  "added" if sign > 0 else "removed", len(rows))
+
+def _spawn_group(game):
+    """
+    The game's spawn group (a game without one is a group of its own)
+    """
+    return game.spawn_group if game.spawn_group is not None else game.gameid
+
+def add_game_results(session, game):
+    """
+    Add the game's results to its situation's global statistics (if it counts
+    towards them), and its spawn group's results to users' statistics, if all
+    of the group's games have now been analysed (and it counts). Either is only
+    added once.
+
+    Doesn't commit.
+    """
+    if session.query(tables.GlobalStatisticsGame).get(game.gameid) is None  \
+            and _update_global_statistics(session, game.gameid, 1):
+        marker = tables.GlobalStatisticsGame()
+        marker.gameid = game.gameid
+        session.add(marker)
+    spawn_group = _spawn_group(game)
+    if session.query(tables.SpawnGroupRollup).get(spawn_group) is not None:
+        return
+    if _incomplete_groups(session).filter(_in_group(spawn_group)).count():
+        return
+    _roll_up(session, spawn_group, 1)
+    marker = tables.SpawnGroupRollup()
+    marker.spawn_group = spawn_group
+    session.add(marker)
+
+def remove_game_results(session, gameid):
+    """
+    Remove this game's results from its situation's global statistics, and its
+    spawn group's results from users' statistics, if they were added, before
+    the game's results are deleted.
+
+    Doesn't commit.
+    """
+    marker = session.query(tables.GlobalStatisticsGame).get(gameid)
+    if marker is not None:
+        _update_global_statistics(session, gameid, -1)
+        session.delete(marker)
+    game = session.query(tables.RunningGame)  \
+        .filter(tables.RunningGame.gameid == gameid).first()
+    if game is None:
+        return
+    spawn_group = _spawn_group(game)
+    marker = session.query(tables.SpawnGroupRollup).get(spawn_group)
+    if marker is None:
+        return
+    _roll_up(session, spawn_group, -1)
+    session.delete(marker)
+
+def clear_user_statistics(session):
+    """
+    Delete all users' statistics, e.g. because all results are being deleted.
+
+    Doesn't commit.
+    """
+    session.query(tables.CachedLeaderboardEntry).delete()
+    session.query(tables.UserSituationPlayer).delete()
+    session.query(tables.UserPositionResult).delete()
+    session.query(tables.SpawnGroupRollup).delete()
+
+def rebuild_user_statistics(session):
+    """
+    Recalculate all users' statistics from every complete spawn group's results.
+
+    Doesn't commit.
+    """
+    # pylint:disable=no-member
+    clear_user_statistics(session)
+    incomplete = _incomplete_groups(session).subquery()
+    groups = _group_results(session)  \
+        .filter(~_group_key().in_(incomplete)).subquery()
+    rows = session.query(groups.c.userid, groups.c.situationid,
+                         groups.c.order, groups.c.public_ranges,
+                         groups.c.scheme, func.count(),
+                         func.sum(groups.c.result),
+                         func.sum(groups.c.result * groups.c.result))  \
+        .group_by(groups.c.userid, groups.c.situationid, groups.c.order,
+                  groups.c.public_ranges, groups.c.scheme).all()
+    if rows:
+        session.execute(tables.UserPositionResult.__table__.insert(), [
+            {'userid': userid, 'situationid': situationid, 'order': order,
+             'public_ranges': public_ranges, 'scheme': scheme,
+             'groups': count, 'total': total, 'total_squares': total_squares}
+            for userid, situationid, order, public_ranges, scheme,
+                count, total, total_squares in rows])
+    spawn_groups = session.query(groups.c.spawn_group).distinct().all()
+    if spawn_groups:
+        session.execute(tables.SpawnGroupRollup.__table__.insert(),
+                        [{'spawn_group': spawn_group}
+                         for spawn_group, in spawn_groups])
+    _write_user_situation_players(session)
+    logging.info("rebuilt statistics from %d spawn groups",
+                 len(spawn_groups))
 
 def get_user_statistics(session, userid, min_hands, is_competition):
     """
     Get user's personal stats for all situations
     """
     # pylint:disable=no-member
-    all_situations = session.query(tables.Situation).all()
+    all_situations = session.query(tables.Situation)  \
+        .options(joinedload(tables.Situation.players)).all()
+    rollup = tables.UserPositionResult
+    positions = {}
+    for row in session.query(rollup)  \
+            .filter(rollup.userid == userid)  \
+            .filter(rollup.public_ranges != is_competition).all():
+        positions.setdefault((row.situationid, row.order),
+                             {})[row.scheme] = row
     # For now, there are only situation-specific results (nothing global).
     situation_results = []
     for situation in all_situations:
@@ -95,54 +429,18 @@ def get_user_statistics(session, userid, min_hands, is_competition):
             # Suppress situation for now.
             continue
         position_results = []
-        games = session.query(tables.RunningGame)  \
-            .filter(tables.RunningGame.public_ranges != is_competition)  \
-            .filter(tables.RunningGame.situationid ==
-                    situation.situationid)  \
-            .filter(tables.RunningGame.gameid > SUPPRESSED_GAME_MAX)  \
-            .all()
-        groups = {}
-        for game in games:
-            groups.setdefault(game.spawn_group, []).append(game)
-        for spawn_group in groups.keys():
-            if any(not g.game_finished or _game_timed_out(session, g)
-                   for g in groups[spawn_group]):
-                groups.pop(spawn_group)
         orbit_average = 0.0 - situation.pot_pre
         total_played = 0
         for player in situation.players:
-            data = _get_all_results(groups=groups, order=player.order,
-                                    userid=userid, scheme='ev')
-            redline_data = _get_all_results(groups=groups, order=player.order,
-                                            userid=userid, scheme='nsd')
-            blueline_data = _get_all_results(groups=groups, order=player.order,
-                                             userid=userid, scheme='sd')
-            total = sum(data)
-            redline = sum(redline_data)
-            blueline = sum(blueline_data)
-            confidence = _calculate_confidence(
-                total_result=total,
-                num_games=len(data),
-                be_mean=player.average_result,
-                stddev=player.stddev)  # population stats are more reliable
-            position_results.append(PositionResult(
-                situationid=situation.situationid,
-                order=player.order,
-                name=player.name,
-                ev=player.average_result,  # situation ev
-                stddev=player.stddev,  # population stats are more reliable
-                played=len(data),
-                total=total if data else None,
-                redline=redline if redline_data else None,
-                blueline=blueline if blueline_data else None,
-                average=total / len(data) if data else None,
-                confidence=confidence))
-            if data and orbit_average is not None:
-                orbit_average += total / len(data)
+            pos = _position_result(player, positions.get(
+                (situation.situationid, player.order), {}))
+            position_results.append(pos)
+            if pos.played and orbit_average is not None:
+                orbit_average += pos.average
                 orbit_average -= player.contributed
             else:
                 orbit_average = None
-            total_played += len(data)
+            total_played += pos.played
         if total_played >= min_hands:
             situation_results.append(SituationResult(
                 situationid=situation.situationid,
@@ -151,43 +449,495 @@ def get_user_statistics(session, userid, min_hands, is_competition):
                 positions=position_results))
     return situation_results
 
+def _timed_out_gameids(session, gameid=None):
+    """
+    Set of gameids of games with a timeout in their history, including games
+    spawned after their parent (or an earlier ancestor) timed out, which share
+    the parent's history from before the fork (see
+    RunningGame.history_sources). Only for this game, if gameid is given.
+    """
+    # pylint:disable=no-member
+    timeout = tables.GameHistoryTimeout
+    game = tables.RunningGame
+    if gameid is not None:
+        running_game = session.query(game).get(gameid)
+        if running_game is not None and session.query(timeout)  \
+                .filter(running_game.history_filter(timeout)).count():
+            return set([gameid])
+        return set()
+    # map of gameid to the order of the first timeout in its history
+    first = dict(session.query(timeout.gameid, func.min(timeout.order))
+                 .group_by(timeout.gameid).all())
+    timed_out = dict(first)
+    parents = first
+    while parents:
+        children = session.query(game.gameid, game.parent_gameid,
+                                  game.fork_order)  \
+            .filter(game.parent_gameid.in_(parents.keys())).all()
+        parents = {}
+        for gameid, parent_gameid, fork_order in children:
+            order = timed_out[parent_gameid]
+            if order < fork_order and gameid not in parents:
+                parents[gameid] = min(order, first.get(gameid, order))
+        timed_out.update(parents)
+    return set(timed_out)
+
+def _timed_out(gameids):
+    """
+    Filter clause for RunningGame being one of these timed out games
+    """
+    if not gameids:
+        return false()
+    return tables.RunningGame.gameid.in_(gameids)
+
+def _ev_results(session, gameid=None):
+    """
+    Query of (gameid, situationid, order, result) for every EV result that
+    counts towards the global statistics, or just this game's
+    """
+    # pylint:disable=no-member
+    rgp = tables.RunningGameParticipant
+    result = tables.RunningGameParticipantResult
+    game = tables.RunningGame
+    # Note: we're only including competition mode - because it's more
+    # popular. We can't include both (unless we track them separately).
+    # Optimisation mode would be a better estimator, but we'd have to
+    # calculate over groups, not games, because optimisation mode makes
+    # rare lines more likely - it makes them 100% likely.
+    query = session.query(game.gameid.label('gameid'),
+                         game.situationid.label('situationid'),
+                         rgp.order.label('order'),
+                         result.result.label('result'))  \
+        .join(rgp, rgp.gameid == game.gameid)  \
+        .join(result, and_(result.gameid == rgp.gameid,
+                           result.userid == rgp.userid))  \
+        .filter(result.scheme == result.SCHEME_EV)  \
+        .filter(game.gameid > SUPPRESSED_GAME_MAX)  \
+        .filter(game.public_ranges == False)  \
+        .filter(~_timed_out(_timed_out_gameids(session, gameid)))
+    if gameid is not None:
+        query = query.filter(game.gameid == gameid)
+    return query
+
+def _welford(count, mean, m2, value, sign):
+    """
+    Add (sign 1) or remove (sign -1) value to or from the count, mean and sum
+    of squared differences from the mean of a set of values, returning the new
+    (count, mean, m2). The mean of no values is None.
+    """
+    if sign > 0:
+        count += 1
+        old_mean = mean if mean is not None else 0.0
+        mean = old_mean + (value - old_mean) / count
+        m2 += (value - old_mean) * (value - mean)
+    else:
+        count -= 1
+        if count == 0:
+            return 0, None, 0.0
+        old_mean = mean
+        mean = (old_mean * (count + 1) - value) / count
+        m2 -= (value - mean) * (value - old_mean)
+    return count, mean, max(m2, 0.0)
+
+def _update_global_statistics(session, gameid, sign):
+    """
+    Add (sign 1) or remove (sign -1) the game's results to or from its
+    situation players' average_result and stddev, if the game counts towards
+    them, and users' confidence in those positions to match. Returns the number
+    of results.
+    """
+    rows = _ev_results(session, gameid).all()
+    positions = set()
+    for row in rows:
+        player = session.query(tables.SituationPlayer)  \
+            .get((row.situationid, row.order))
+        if player.result_count is None and player.average_result is not None:
+            # calculated before we kept count; needs a full recalculation
+            continue
+        count, mean, m2 = _welford(player.result_count or 0,
+                                   player.average_result,
+                                   player.result_m2 or 0.0, row.result, sign)
+        player.result_count = count
+        player.average_result = mean
+        player.result_m2 = m2
+        player.stddev = math.sqrt(m2 / count) if count else None
+        positions.add((player.situationid, player.order))
+        logging.debug("gameid %d, situationid %d, position %d, "
+                      "average_result %r (stddev %r) over %d games", gameid,
+                      player.situationid, player.order,
+                      player.average_result, player.stddev, count)
+    session.flush()
+    refresh_confidences(session, positions)
+    return len(rows)
+
+def clear_global_statistics(session):
+    """
+    Reset situation players' averages, e.g. because all results are being
+    deleted.
+
+    Doesn't commit.
+    """
+    session.query(tables.GlobalStatisticsGame).delete()
+    session.query(tables.SituationPlayer)  \
+        .update({tables.SituationPlayer.result_count: 0,
+                 tables.SituationPlayer.average_result: None,
+                 tables.SituationPlayer.result_m2: 0.0,
+                 tables.SituationPlayer.stddev: None})
+
+def _position_statistics(session):
+    """
+    Map of (situationid, order) to (count, mean, m2) of EV results, where m2 is
+    the sum of squared differences from the mean, aggregated in the database
+    """
+    results = _ev_results(session).subquery()
+    means = session.query(results.c.situationid, results.c.order,
+                          func.count(results.c.result).label('count'),
+                          func.avg(results.c.result).label('mean'))  \
+        .group_by(results.c.situationid, results.c.order)  \
+        .subquery()
+    deviation = results.c.result - means.c.mean
+    rows = session.query(means.c.situationid, means.c.order,
+                         means.c.count, means.c.mean,
+                         func.sum(deviation * deviation))  \
+        .join(results, and_(results.c.situationid == means.c.situationid,
+                            results.c.order == means.c.order))  \
+        .group_by(means.c.situationid, means.c.order,
+                  means.c.count, means.c.mean)  \
+        .all()
+    return {(situationid, order): (count, mean, m2)
+            for situationid, order, count, mean, m2 in rows}
+
 def recalculate_global_statistics(session):
     """
-    Calculate situation players' averages
+    Calculate situation players' averages from scratch.
+
+    These are kept up to date as games are analysed, so this is only needed to
+    correct them (e.g. for rounding errors building up).
     """
-    suppressed_game_ids = set([h.gameid for h in  \
-                              session.query(tables.GameHistoryTimeout).all()])
-    logging.debug('%d timed-out games suppressed', len(suppressed_game_ids))
+    statistics = _position_statistics(session)
     positions = session.query(tables.SituationPlayer).all()
     for position in positions:
-        results = []
-        # TODO: REVISIT: This is inefficient. Query RunningGame first...
-        # ... then use game.rgps.
-        rgps = session.query(tables.RunningGameParticipant)  \
-            .filter(tables.RunningGameParticipant.gameid >
-                    SUPPRESSED_GAME_MAX)  \
-            .filter(tables.RunningGameParticipant.order == position.order) \
-            .all()
-        # Note: we're only including competition mode - because it's more
-        # popular. We can't include both (unless we track them separately).
-        # Optimisation mode would be a better estimator, but we'd have to
-        # calculate over groups, not games, because optimisation mode makes
-        # rare lines more likely - it makes them 100% likely.
-        for rgp in [r for r in rgps
-                    if r.game.situationid == position.situationid
-                    and not r.game.public_ranges
-                    and r.gameid not in suppressed_game_ids]:
-            for result in rgp.results:
-                if result.scheme == 'ev':
-                    results.append(result.result)
-        if results:
-            position.average_result = sum(results) / len(results)
-            position.stddev = numpy.std(results)  # pylint:disable=no-member
-        else:
-            position.average_result = None
-            position.stddev = None
+        count, mean, m2 = statistics.get(
+            (position.situationid, position.order), (0, None, 0.0))
+        position.result_count = count
+        position.average_result = mean
+        position.result_m2 = m2
+        # population standard deviation, like numpy.std
+        position.stddev = math.sqrt(m2 / count) if count else None
         logging.debug('situationid %d (%s), position %d (%s), '
             'average_result %r (stddev %r) over %d games',
             position.situationid, position.situation.description,
             position.order, position.name, position.average_result,
-            position.stddev, len(results))
+            position.stddev, count)
+    session.query(tables.GlobalStatisticsGame).delete()
+    session.execute(tables.GlobalStatisticsGame.__table__.insert()
+                    .from_select(['gameid'], _ev_results(session)
+                                 .with_entities(tables.RunningGame.gameid)
+                                 .distinct().statement))
+    # users' confidence is relative to the new averages
+    refresh_confidences(session)
+
+class Test(unittest.TestCase):
+    """ Tests for global statistics """
+    # pylint:disable=C0103,R0904
+    def setUp(self):
+        from rvr.db.creation import BASE
+        engine = create_engine('sqlite://')
+        BASE.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.session.execute(tables.Situation.__table__.insert(), {
+            'situationid': 1, 'description': 'test', 'participants': 2,
+            'is_limit': False, 'big_blind': 2, 'board_raw': '',
+            'current_round': 'Preflop', 'pot_pre': 0, 'increment': 1,
+            'bet_count': 0, 'current_player_num': 0})
+        for order in [0, 1, 2]:
+            self.session.execute(tables.SituationPlayer.__table__.insert(), {
+                'situationid': 1, 'order': order, 'stack': 100,
+                'contributed': 0, 'range_raw': 'anything',
+                'left_to_act': True, 'average_result': 1.0, 'stddev': 1.0})
+        for userid in [1, 2]:
+            self.session.execute(tables.User.__table__.insert(), {
+                'userid': userid, 'identity': '', 'email': '',
+                'unsubscribed': False,
+                'last_seen': datetime.datetime(2016, 1, 1)})
+
+    def tearDown(self):
+        self.session.close()
+
+    def _game(self, gameid, results, public_ranges=False, timed_out=False,
+              spawn_group=None, spawn_factor=1.0, analysed=True, parent=None,
+              fork_order=None):
+        """ A game, with EV (and SD) results for order 0 and 1 """
+        gameid += SUPPRESSED_GAME_MAX
+        if spawn_group is not None:
+            spawn_group += SUPPRESSED_GAME_MAX
+        if parent is not None:
+            parent += SUPPRESSED_GAME_MAX
+        self.session.execute(tables.RunningGame.__table__.insert(), {
+            'gameid': gameid, 'situationid': 1,
+            'public_ranges': public_ranges, 'next_hh': 0, 'board_raw': '',
+            'total_board_raw': '', 'current_round': 'Finish', 'pot_pre': 0,
+            'increment': 1, 'bet_count': 0, 'current_factor': 1.0,
+            'last_action_time': datetime.datetime(2016, 1, 1),
+            'analysis_performed': analysed, 'spawn_group': spawn_group,
+            'spawn_finished': True, 'spawn_factor': spawn_factor,
+            'parent_gameid': parent, 'fork_order': fork_order})
+        for order, result in enumerate(results):
+            userid = order + 1
+            self.session.execute(
+                tables.RunningGameParticipant.__table__.insert(), {
+                    'userid': userid, 'gameid': gameid, 'order': order,
+                    'stack': 100, 'contributed': 0, 'range_raw': 'nothing',
+                    'left_to_act': False, 'folded': False})
+            for scheme, value in [('ev', result), ('sd', result * 10)]:
+                self.session.execute(
+                    tables.RunningGameParticipantResult.__table__.insert(),
+                    {'gameid': gameid, 'userid': userid, 'scheme': scheme,
+                     'result': value})
+        if timed_out:
+            self.session.execute(tables.GameHistoryTimeout.__table__.insert(),
+                                 {'gameid': gameid, 'order': 3, 'userid': 1})
+
+    def test_recalculate(self):
+        self._game(1, [3.0, -3.0])
+        self._game(2, [-1.0, 1.0])
+        self._game(3, [10.5, -10.5])
+        self._game(4, [100.0, -100.0], public_ranges=True)
+        self._game(5, [200.0, -200.0], timed_out=True)
+        recalculate_global_statistics(self.session)
+        players = self.session.query(tables.SituationPlayer)  \
+            .order_by(tables.SituationPlayer.order).all()
+        self.assertAlmostEqual(players[0].average_result, 12.5 / 3)
+        self.assertAlmostEqual(players[0].stddev,
+                               numpy.std([3.0, -1.0, 10.5]))
+        self.assertAlmostEqual(players[1].average_result, -12.5 / 3)
+        self.assertAlmostEqual(players[1].stddev,
+                               numpy.std([-3.0, 1.0, -10.5]))
+        self.assertIsNone(players[2].average_result)
+        self.assertIsNone(players[2].stddev)
+
+    def test_spawned_after_timeout(self):
+        self._game(1, [100.0, -100.0], spawn_group=1, timed_out=True)
+        # spawned after the timeout, and from that game
+        self._game(2, [200.0, -200.0], spawn_group=1, parent=1, fork_order=4)
+        self._game(3, [300.0, -300.0], spawn_group=1, parent=2, fork_order=6)
+        # spawned before the timeout
+        self._game(4, [3.0, -3.0], spawn_group=1, parent=1, fork_order=3)
+        self._game(5, [1.0, -1.0])
+        self.assertEqual(_timed_out_gameids(self.session),
+                         set(gameid + SUPPRESSED_GAME_MAX
+                             for gameid in [1, 2, 3]))
+        self.session.query(tables.SituationPlayer)  \
+            .update({tables.SituationPlayer.average_result: None,
+                     tables.SituationPlayer.stddev: None})
+        for game in self.session.query(tables.RunningGame).all():
+            add_game_results(self.session, game)
+        online = self._players()
+        recalculate_global_statistics(self.session)
+        self.assertEqual(self._players()[:2], [(2, 2.0, 1.0), (2, -2.0, 1.0)])
+        self.assertEqual(online[:2], self._players()[:2])
+
+    def _rollups(self):
+        """ Map of (userid, order, scheme) to (groups, total, total_squares) """
+        return {(row.userid, row.order, row.scheme):
+                (row.groups, row.total, row.total_squares)
+                for row in self.session.query(tables.UserPositionResult)}
+
+    def test_rollup(self):
+        self._game(1, [3.0, -3.0], spawn_group=1, spawn_factor=0.25)
+        self._game(2, [-1.0, 1.0], spawn_group=1, spawn_factor=0.75,
+                   analysed=False)
+        self._game(3, [10.0, -10.0])
+        self._game(4, [100.0, -100.0], timed_out=True)
+        games = {game.gameid - SUPPRESSED_GAME_MAX: game
+                 for game in self.session.query(tables.RunningGame)}
+        add_game_results(self.session, games[1])
+        self.assertEqual(self._rollups(), {})
+        for gameid in [3, 4, 3]:
+            add_game_results(self.session, games[gameid])
+        self.assertEqual(self._rollups()[1, 0, 'ev'], (1, 10.0, 100.0))
+        self.session.query(tables.RunningGame)  \
+            .update({tables.RunningGame.analysis_performed: True})
+        add_game_results(self.session, games[2])
+        rollups = self._rollups()
+        self.assertEqual(len(rollups), 4)
+        self.assertEqual(rollups[1, 0, 'ev'], (2, 10.0, 100.0))
+        self.assertEqual(rollups[2, 1, 'sd'], (2, -100.0, 10000.0))
+        usp = self.session.query(tables.UserSituationPlayer)  \
+            .filter(tables.UserSituationPlayer.userid == 2).one()
+        self.assertEqual((usp.order, usp.public_ranges, usp.amount_won,
+                          usp.blueline, usp.redline, usp.hands_played),
+                         (1, False, -10.0, -100.0, None, 2))
+        # rebuilding from scratch gives the same
+        rebuild_user_statistics(self.session)
+        self.assertEqual(self._rollups(), rollups)
+        # reanalysing a game takes its group out again
+        remove_game_results(self.session, 2 + SUPPRESSED_GAME_MAX)
+        self.assertEqual(self._rollups()[1, 0, 'ev'], (1, 10.0, 100.0))
+        remove_game_results(self.session, 2 + SUPPRESSED_GAME_MAX)
+        self.assertEqual(self._rollups()[1, 0, 'ev'], (1, 10.0, 100.0))
+        remove_game_results(self.session, 3 + SUPPRESSED_GAME_MAX)
+        self.assertEqual(self._rollups(), {})
+        self.assertEqual(self.session.query(tables.UserSituationPlayer)
+                         .filter(tables.UserSituationPlayer.hands_played > 0)
+                         .count(), 0)
+
+    def test_get_user_statistics(self):
+        self._game(1, [3.0, -3.0], spawn_group=1, spawn_factor=0.5)
+        self._game(2, [-1.0, 1.0], spawn_group=1, spawn_factor=0.5)
+        self._game(3, [10.0, -10.0], public_ranges=True)
+        rebuild_user_statistics(self.session)
+        results = get_user_statistics(self.session, 1, 1, True)
+        self.assertEqual(len(results), 1)
+        positions = {pos.order: pos for pos in results[0].positions}
+        self.assertEqual((positions[0].played, positions[0].total,
+                          positions[0].average, positions[0].blueline),
+                         (1, 1.0, 1.0, 10.0))
+        self.assertEqual((positions[1].played, positions[1].total),
+                         (0, None))
+        self.assertIsNone(results[0].average)
+        self.assertEqual(get_user_statistics(self.session, 1, 2, True), [])
+        results = get_user_statistics(self.session, 1, 1, False)
+        self.assertEqual(results[0].positions[0].total, 10.0)
+
+    def test_welford(self):
+        values = [3.0, -1.5, 10.0, 0.25, -7.0]
+        count, mean, m2 = 0, None, 0.0
+        for value in values:
+            count, mean, m2 = _welford(count, mean, m2, value, 1)
+        self.assertEqual(count, 5)
+        self.assertAlmostEqual(mean, numpy.mean(values))
+        self.assertAlmostEqual(m2 / count, numpy.var(values))
+        for value in values[:3]:
+            count, mean, m2 = _welford(count, mean, m2, value, -1)
+        self.assertEqual(count, 2)
+        self.assertAlmostEqual(mean, numpy.mean(values[3:]))
+        self.assertAlmostEqual(m2 / count, numpy.var(values[3:]))
+        for value in values[3:]:
+            count, mean, m2 = _welford(count, mean, m2, value, -1)
+        self.assertEqual((count, mean, m2), (0, None, 0.0))
+
+    def _players(self):
+        """ (result_count, average_result, stddev) for each situation player """
+        return [(player.result_count, player.average_result, player.stddev)
+                for player in self.session.query(tables.SituationPlayer)
+                .order_by(tables.SituationPlayer.order)]
+
+    def test_online_global_statistics(self):
+        self._game(1, [3.0, -3.0])
+        self._game(2, [-1.0, 1.0])
+        self._game(3, [10.5, -10.5])
+        self._game(4, [100.0, -100.0], public_ranges=True)
+        self._game(5, [200.0, -200.0], timed_out=True)
+        self.session.query(tables.SituationPlayer)  \
+            .update({tables.SituationPlayer.average_result: None,
+                     tables.SituationPlayer.stddev: None})
+        games = self.session.query(tables.RunningGame)  \
+            .order_by(tables.RunningGame.gameid).all()
+        for game in games + games:
+            add_game_results(self.session, game)
+        online = self._players()
+        recalculate_global_statistics(self.session)
+        recalculated = self._players()
+        for actual, expected in zip(online, recalculated):
+            self.assertEqual(actual[0] or 0, expected[0])
+            if expected[1] is None:
+                self.assertEqual(actual[1:], expected[1:])
+            else:
+                self.assertAlmostEqual(actual[1], expected[1])
+                self.assertAlmostEqual(actual[2], expected[2])
+        self.assertEqual(recalculated[0][0], 3)
+        # reanalysing a game takes it out again (once), as does recalculating
+        remove_game_results(self.session, games[2].gameid)
+        remove_game_results(self.session, games[2].gameid)
+        self.assertEqual(self._players()[0][0], 2)
+        self.assertAlmostEqual(self._players()[0][1], 1.0)
+        self.assertAlmostEqual(self._players()[0][2], 2.0)
+        add_game_results(self.session, games[2])
+        self.assertEqual(self._players()[0][0], 3)
+        self.session.query(tables.RunningGameParticipantResult)  \
+            .filter(tables.RunningGameParticipantResult.gameid ==
+                    games[0].gameid).delete()
+        recalculate_global_statistics(self.session)
+        self.assertEqual(self._players()[0][0], 2)
+        self.assertEqual(self.session.query(tables.GlobalStatisticsGame)
+                         .count(), 2)
+
+    def test_calculate_confidences(self):
+        cases = [(0.0, 0, 1.0, 2.0),  # no games
+                 (5.0, 3, 1.0, 0.0),  # too few games
+                 (-5.0, 3, 1.0, 0.0),
+                 (3.0, 3, 1.0, 0.0),
+                 (10.0, 4, 1.0, 2.0),
+                 (-10.0, 9, 0.5, 3.0),
+                 (2.5, 1, 2.5, 0.1)]
+        totals, num_games, be_means, stddevs = [numpy.array(column)
+                                                for column in zip(*cases)]
+        confidences = _calculate_confidences(totals, num_games, be_means,
+                                             stddevs)
+        for case, confidence in zip(cases, confidences):
+            total, games, mean, stddev = case
+            if games and stddev:
+                expected = stats.norm(loc=mean * games,
+                                      scale=stddev * math.sqrt(games))  \
+                    .cdf(total)
+                self.assertAlmostEqual(confidence, expected)
+        self.assertEqual(list(confidences[:4]), [0.5, 1.0, 0.0, 0.5])
+        self.assertEqual(_calculate_confidence(10.0, 4, 1.0, 2.0),
+                         confidences[4])
+
+    def test_refresh_confidences(self):
+        self._game(1, [3.0, -3.0])
+        self._game(2, [1.0, -1.0])
+        rebuild_user_statistics(self.session)
+        usps = self.session.query(tables.UserSituationPlayer)  \
+            .order_by(tables.UserSituationPlayer.order).all()
+        self.assertEqual([usp.confidence for usp in usps], [
+            _calculate_confidence(4.0, 2, 1.0, 1.0),
+            _calculate_confidence(-4.0, 2, 1.0, 1.0)])
+        self.assertEqual(
+            [entry.userid
+             for entry in self.session.query(tables.CachedLeaderboardEntry)],
+            [1])
+        self.session.query(tables.SituationPlayer)  \
+            .filter(tables.SituationPlayer.order == 0)  \
+            .update({tables.SituationPlayer.average_result: None})
+        self.session.query(tables.SituationPlayer)  \
+            .filter(tables.SituationPlayer.order == 1)  \
+            .update({tables.SituationPlayer.average_result: -3.0})
+        refresh_confidences(self.session)
+        usps = self.session.query(tables.UserSituationPlayer)  \
+            .order_by(tables.UserSituationPlayer.order).all()
+        self.assertEqual([usp.confidence for usp in usps], [
+            None, _calculate_confidence(-4.0, 2, -3.0, 1.0)])
+        self.assertEqual(
+            [entry.userid
+             for entry in self.session.query(tables.CachedLeaderboardEntry)],
+            [2])
+
+    def test_confidences_follow_averages(self):
+        self.session.query(tables.SituationPlayer)  \
+            .update({tables.SituationPlayer.average_result: None,
+                     tables.SituationPlayer.stddev: None})
+        self._game(1, [3.0, -3.0])
+        self._game(2, [1.0, -1.0])
+        # a group that isn't complete yet, so only changes the averages
+        self._game(3, [-5.0, 5.0], spawn_group=3)
+        self._game(4, [0.0, 0.0], spawn_group=3, analysed=False)
+        games = self.session.query(tables.RunningGame)  \
+            .order_by(tables.RunningGame.gameid).all()
+        for game in games[:3]:
+            add_game_results(self.session, game)
+        usps = self.session.query(tables.UserSituationPlayer)  \
+            .order_by(tables.UserSituationPlayer.order).all()
+        self.assertEqual([usp.hands_played for usp in usps], [2, 2])
+        self.assertAlmostEqual(usps[0].confidence, _calculate_confidence(
+            4.0, 2, -1.0 / 3, numpy.std([3.0, 1.0, -5.0])))
+        self.assertAlmostEqual(usps[1].confidence, _calculate_confidence(
+            -4.0, 2, 1.0 / 3, numpy.std([-3.0, -1.0, 5.0])))
+        entry = self.session.query(tables.CachedLeaderboardEntry).one()
+        self.assertEqual((entry.userid, entry.confidence),
+                         (1, usps[0].confidence))
+
+if __name__ == '__main__':
+    unittest.main()
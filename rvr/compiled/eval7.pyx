@@ -24,9 +24,10 @@ cdef void wh_init(cython.ulong seed):
     global _wh_seed_x, _wh_seed_y, _wh_seed_z
     # arbitrarily, statically chosen for this eval7 version.
     cdef cython.ulong a = seed
-    _wh_seed_x = a % 30268; a = a / 30268
-    _wh_seed_y = a % 30306; a = a / 30306
-    _wh_seed_z = a % 30322
+    # (plus one, as in Python's WichmannHill, because a zero would stay zero)
+    _wh_seed_x = a % 30268 + 1; a = a / 30268
+    _wh_seed_y = a % 30306 + 1; a = a / 30306
+    _wh_seed_z = a % 30322 + 1
 
 cdef cython.double wh_random():
     """Get the next random number in the range [0.0, 1.0)."""
@@ -65,6 +66,12 @@ cdef cython.int wh_randint(cython.int range):
 def py_wh_randint(range):
     return wh_randint(range)
 
+def py_wh_seed(py_seed):
+    """
+    Seed the random number generator, e.g. so that results are repeatable
+    """
+    wh_init(py_seed)
+
 wh_init(time.time())  # Python code, but done only once
 
 # https://groups.google.com/d/msg/cython-users/cq0y7A4GEYI/COpObK6kp3YJ
@@ -475,6 +482,168 @@ def py_all_hands_vs_range(py_hero, py_villain, py_board, py_iterations):
 
     return py_result
 
+cdef void all_hands_both_showdowns(cython.ulonglong *hands, cython.uint num_hands,
+                                   cython.ulonglong *others, cython.uint *others_start, cython.uint num_others,
+                                   cython.ulonglong *actor, cython.uint *actor_action, cython.uint num_actor,
+                                   cython.ulonglong board, cython.uint num_board,
+                                   cython.uint iterations, cython.double *result):
+    """
+    For each hand, the showdown that comes from the last player to act (the
+    actor) folding, and the one that comes from them calling.
+    Note that only unweighted ranges are supported.
+
+    hands are two-card hand masks; num_hands is how many
+    others are the options of each other player (not hero, not the actor), one
+        player after another; player j's options are from others_start[j] up
+        to others_start[j + 1]
+    actor is an array of num_actor options for the actor, and actor_action
+        says whether each one folds (0), calls (1) or raises (2)
+    board is a hand mask of the board; num_board says how many cards are in it
+    iterations is how many deals to attempt for each hand; deals where cards
+        collide are discarded
+    result is a preallocated array of five per hand: equity in the fold
+        showdown, equity in the call showdown, and the weights of fold, call
+        and raise; -1 where there were no such deals
+    """
+    cdef cython.ulonglong *dealt = <cython.ulonglong *>malloc(sizeof(cython.ulonglong) * num_others)
+    cdef cython.ulonglong hand
+    cdef cython.ulonglong option
+    cdef cython.ulonglong dead
+    cdef cython.ulonglong complete
+    cdef cython.uint action
+    cdef cython.uint hero
+    cdef cython.uint villain
+    cdef cython.uint ties
+    cdef cython.int beaten
+    cdef cython.int collided
+    cdef cython.double share
+    cdef cython.uint f, p, a, total
+    cdef cython.double wins_f, wins_p
+    for 0 <= h < num_hands:
+        hand = hands[h]
+        f = p = a = 0
+        wins_f = wins_p = 0.0
+        for 0 <= i < iterations:
+            # deal to every other player, then the actor
+            dead = board | hand
+            collided = 0
+            for 0 <= j < num_others:
+                option = others[others_start[j] + wh_randint(others_start[j + 1] - others_start[j])]
+                if option & dead:
+                    collided = 1
+                    break
+                dead |= option
+                dealt[j] = option
+            if collided:
+                continue
+            k = wh_randint(num_actor)
+            option = actor[k]
+            if option & dead:
+                continue
+            action = actor_action[k]
+            if action == 2:
+                a += 1
+                continue
+            # showdown, with the actor only if they call
+            if action == 1:
+                dead |= option
+            complete = board
+            for 0 <= n < 5 - num_board:
+                complete |= deal_card(complete | dead)
+            hero = evaluate(complete | hand)
+            ties = 0
+            beaten = 0
+            for 0 <= j < num_others:
+                villain = evaluate(complete | dealt[j])
+                if villain > hero:
+                    beaten = 1
+                    break
+                elif villain == hero:
+                    ties += 1
+            if action == 1 and not beaten:
+                villain = evaluate(complete | option)
+                if villain > hero:
+                    beaten = 1
+                elif villain == hero:
+                    ties += 1
+            share = 0.0 if beaten else 1.0 / (1 + ties)
+            if action == 1:
+                p += 1
+                wins_p += share
+            else:
+                f += 1
+                wins_f += share
+        total = f + p + a
+        result[5 * h] = wins_f / f if f else -1
+        result[5 * h + 1] = wins_p / p if p else -1
+        result[5 * h + 2] = <cython.double>f / total if total else -1
+        result[5 * h + 3] = <cython.double>p / total if total else -1
+        result[5 * h + 4] = <cython.double>a / total if total else -1
+    free(dealt)
+
+def py_all_hands_both_showdowns(py_hands, py_others, py_fold, py_passive, py_aggressive, py_board, py_iterations):
+    """
+    Return a list of (fold equity, call equity, fold weight, call weight, raise
+    weight) for each of hero's hands, with None where not applicable.
+
+    hands are hero's options.
+    others is a list of the options of each other player, not including the
+    last player to act, whose options are split into fold, passive and
+    aggressive.
+    board is a list of cards.
+    iterations is how many deals to attempt for each hand.
+    """
+    nothing = [(None, None, None, None, None)] * len(py_hands)
+    py_actor = list(py_fold) + list(py_passive) + list(py_aggressive)
+    if not py_hands or not py_actor or not all(py_others):
+        return nothing
+    cdef cython.uint num_hands = len(py_hands)
+    cdef cython.uint num_others = len(py_others)
+    cdef cython.uint num_actor = len(py_actor)
+    cdef cython.uint num_options = sum(len(options) for options in py_others)
+    cdef cython.ulonglong *hands = <cython.ulonglong *>malloc(sizeof(cython.ulonglong) * num_hands)
+    cdef cython.ulonglong *others = <cython.ulonglong *>malloc(sizeof(cython.ulonglong) * num_options)
+    cdef cython.uint *others_start = <cython.uint *>malloc(sizeof(cython.uint) * (num_others + 1))
+    cdef cython.ulonglong *actor = <cython.ulonglong *>malloc(sizeof(cython.ulonglong) * num_actor)
+    cdef cython.uint *actor_action = <cython.uint *>malloc(sizeof(cython.uint) * num_actor)
+    cdef cython.double *result = <cython.double *>malloc(sizeof(cython.double) * 5 * num_hands)
+
+    for index, hand in enumerate(py_hands):
+        hands[index] = hand_to_mask(hand)
+    num_options = 0
+    for index, options in enumerate(py_others):
+        others_start[index] = num_options
+        for option in options:
+            others[num_options] = hand_to_mask(option)
+            num_options += 1
+    others_start[num_others] = num_options
+    for index, option in enumerate(py_actor):
+        actor[index] = hand_to_mask(option)
+        if index < len(py_fold):
+            actor_action[index] = 0
+        elif index < len(py_fold) + len(py_passive):
+            actor_action[index] = 1
+        else:
+            actor_action[index] = 2
+
+    all_hands_both_showdowns(hands, num_hands, others, others_start, num_others,
+                             actor, actor_action, num_actor,
+                             many_to_mask(py_board), len(py_board),
+                             py_iterations, result)
+
+    py_result = [tuple(result[5 * i + j] if result[5 * i + j] != -1 else None
+                       for j in range(5))
+                 for i in range(num_hands)]
+
+    free(hands)
+    free(others)
+    free(others_start)
+    free(actor)
+    free(actor_action)
+    free(result)
+
+    return py_result
+
 cdef cython.uint hand_type(cython.uint hand_value):
     return hand_value >> HANDTYPE_SHIFT
 
@@ -8,6 +8,7 @@ from rvr.poker import cards
 from rvr.compiled.eval7 import py_hand_vs_range_exact  # @UnresolvedImport
 from rvr.compiled.eval7 import py_hand_vs_range_monte_carlo  # @UnresolvedImport
 from rvr.compiled.eval7 import py_all_hands_vs_range  # @UnresolvedImport
+from rvr.compiled.eval7 import py_all_hands_both_showdowns  # @UnresolvedImport
 from rvr.compiled.eval7 import py_wh_randint  # @UnresolvedImport
 from rvr.compiled.eval7 import py_hand_to_mask  # @UnresolvedImport
 from rvr.compiled import eval7
@@ -122,8 +123,40 @@ class TestEval7(unittest.TestCase):
         self.assertAlmostEqual(equity_map[hand], 0.03687, delta=0.0002)
         self.assertEqual(len(equity_map), 1)
 
+    def test_all_hands_both_showdowns(self):
+        board = Card.many_from_text("2c7d9hJc3s")
+        aces = frozenset(Card.many_from_text("AhAd"))
+        kings = frozenset(Card.many_from_text("KsKc"))
+        queens = frozenset(Card.many_from_text("QhQc"))
+        others = [[frozenset(Card.many_from_text("KhKd"))]]
+        fold = [frozenset(Card.many_from_text("QhQd"))]
+        passive = [frozenset(Card.many_from_text("8s8c"))]
+        aggressive = [frozenset(Card.many_from_text("7h7c"))]
+        results = py_all_hands_both_showdowns([aces, kings, queens], others,
+                                              fold, passive, aggressive,
+                                              board, 30000)
+        self.assertEqual(len(results), 3)
+        # Aces win both showdowns; each line is equally likely
+        f_eq, c_eq, f_weight, c_weight, r_weight = results[0]
+        self.assertEqual(f_eq, 1.0)
+        self.assertEqual(c_eq, 1.0)
+        self.assertAlmostEqual(f_weight, 1.0 / 3, delta=0.02)
+        self.assertAlmostEqual(c_weight, 1.0 / 3, delta=0.02)
+        self.assertAlmostEqual(r_weight, 1.0 / 3, delta=0.02)
+        # Kings chop with kings, and beat eights
+        f_eq, c_eq, _, _, _ = results[1]
+        self.assertEqual(f_eq, 0.5)
+        self.assertEqual(c_eq, 0.5)
+        # Queens lose to kings, and block the fold
+        f_eq, c_eq, f_weight, c_weight, r_weight = results[2]
+        self.assertIs(f_eq, None)
+        self.assertEqual(c_eq, 0.0)
+        self.assertEqual(f_weight, 0.0)
+        self.assertAlmostEqual(c_weight, 0.5, delta=0.02)
+        self.assertAlmostEqual(r_weight, 0.5, delta=0.02)
+
 if __name__ == '__main__':
     # 2013-02-09 28 seconds (old version)
     # 2014-12-29 28 seconds
     # 2020-06-12 15 seconds (hardware must be faster now)
-    unittest.main()
+    unittest.main()
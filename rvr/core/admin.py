@@ -15,6 +15,9 @@ from rvr.poker.handrange import ANYTHING
 import time
 from rvr.db.creation import create_session
 from rvr.db import tables
+from rvr.analysis import reanalysis
+import datetime
+import pstats
 
 #pylint:disable=R0201,R0904,E1103,unused-argument
 
@@ -33,6 +36,17 @@ def display_game_tree(tree, local=False):
         print "Line '%s', userid %d:" %  \
             (line_description(tree.betting_line), userid), ev_map
 
+def _print_phases(phases):
+    """
+    Display a list of AnalysisPhaseProfile
+    """
+    print "%-24s %8s %10s %8s %12s %10s %10s" % ("phase", "calls", "seconds",
+        "equity", "iterations", "combos", "rows")
+    for phase in phases:
+        print "%-24s %8d %10.2f %8d %12d %10d %10d" % (phase.phase,
+            phase.calls, phase.seconds, phase.equity_calls, phase.iterations,
+            phase.combos, phase.rows)
+
 class AdminCmd(Cmd):
     """
     Cmd class to make calls to an API instance
@@ -416,35 +430,58 @@ class AdminCmd(Cmd):
     def do_recalculate(self, _details):
         """
         recalculate
-        Recalculate global statistics
+        Recalculate global statistics from scratch (they're kept up to date as
+        games are analysed, but this corrects any drift)
         """
         self.api.recalculate_global_statistics()
 
+    def do_rebuild_leaderboards(self, _details):
+        """
+        rebuild_leaderboards
+        Recalculate every user's confidence in every position, relative to the
+        current situation averages, and all leaderboards
+        """
+        result = self.api.rebuild_leaderboards()
+        if isinstance(result, APIError):
+            print "Error:", result.description
+
+    def do_rebuild_statistics(self, _details):
+        """
+        rebuild_statistics
+        Recalculate all users' statistics and leaderboards from scratch, from
+        the results of every spawn group whose games have all been analysed
+        """
+        result = self.api.rebuild_user_statistics()
+        if isinstance(result, APIError):
+            print "Error:", result.description
+
     def do_analyse(self, details):
         """
         analyse
         Run pending analysis
 
-        analyse <gameid>
-        Re/analyse specified gameid
+        analyse <gameid> [force]
+        Re/analyse specified gameid (if forced, even if its analysis inputs
+        haven't changed)
 
         analyse <gameid> <debug_combo>
         Re/analyse specified gameid and debug specified combo
 
-        analyse [refresh]
-        Reanalyse everything.
+        analyse [refresh] [force]
+        Reanalyse everything (if forced, even games whose analysis inputs
+        haven't changed).
         """
         if details == "":
             result = self.api.run_pending_analysis()
-        elif details == "refresh":
+        elif details in ["refresh", "refresh force"]:
             print "This may re-email everyone for games they have already" \
                 " had analysis for. If you don't want to do that, turn off" \
                 " email in local_settings.py first. If you are okay with" \
                 " re-emailing everyone, or you have checked local_settings.py" \
-                " the command is 'analyse refresh confirm'."
+                " the command is '%s confirm'." % ("analyse " + details,)
             return
-        elif details == "refresh confirm":
-            result = self.api.reanalyse_all()
+        elif details in ["refresh confirm", "refresh force confirm"]:
+            result = self.api.reanalyse_all(force="force" in details)
         else:
             params = details.split(None, 1)
             if len(params) > 1:
@@ -452,12 +489,15 @@ class AdminCmd(Cmd):
             else:
                 gameid = details
                 debug_combo = ""
+            force = debug_combo == "force"
+            if force:
+                debug_combo = ""
             try:
                 gameid = int(gameid)
             except ValueError:
                 print "Bad syntax. See 'help analyse'."
                 return
-            result = self.api.reanalyse(gameid, debug_combo)
+            result = self.api.reanalyse(gameid, debug_combo, force)
         if isinstance(result, APIError):
             print "Error:", result.description
         else:
@@ -466,6 +506,158 @@ class AdminCmd(Cmd):
             print "Email is turned off in local_settings.py. You may now"  \
                 " want to turn it back on."
 
+    def do_queue(self, details):
+        """
+        queue
+        Show analysis queue depth and throughput
+
+        queue pending
+        Queue analysis of all finished games that haven't been analysed
+        """
+        if details == "pending":
+            result = self.api.enqueue_pending_analysis()
+            if isinstance(result, APIError):
+                print "Error:", result.description
+            else:
+                print result, "games queued for analysis."
+            return
+        elif details != "":
+            print "Bad syntax. See 'help queue'."
+            return
+        result = self.api.get_analysis_queue()
+        if isinstance(result, APIError):
+            print "Error:", result.description
+            return
+        print "Queued: %d (%d due now, oldest since %s)" %  \
+            (result.queued, result.due, result.oldest_due)
+        print "Running: %d" % (result.running,)
+        print "Failed: %d" % (result.failed,)
+        print "Done in last hour: %d" % (result.done_last_hour,)
+        print "Done in last day: %d" % (result.done_last_day,)
+        if result.mean_duration is not None:
+            print "Mean duration (last day): %0.1f seconds" %  \
+                (result.mean_duration,)
+
+    def do_profile(self, details):
+        """
+        profile
+        Show the games that took longest to analyse, and the time and counters
+        for each phase of analysis over all games
+
+        profile <gameid>
+        Show the time and counters for each phase of the game's analysis
+
+        profile <gameid> <filename>
+        Analyse the game again under cProfile (without keeping the results),
+        and dump the stats to filename
+        """
+        params = details.split()
+        if len(params) > 2:
+            print "Bad syntax. See 'help profile'."
+            return
+        if not params:
+            result = self.api.get_analysis_profile()
+            if isinstance(result, APIError):
+                print "Error:", result.description
+                return
+            games, phases = result
+            print "Slowest games:"
+            for game in games:
+                print "  gameid %d: %0.2f seconds" % (game.gameid, game.seconds)
+            print "Phases, over all games:"
+            _print_phases(phases)
+            return
+        try:
+            gameid = int(params[0])
+        except ValueError:
+            print "Bad syntax. See 'help profile'."
+            return
+        if len(params) == 2:
+            result = self.api.profile_analysis(gameid, params[1])
+        else:
+            result = self.api.get_game_analysis_profile(gameid)
+        if isinstance(result, APIError):
+            print "Error:", result.description
+            return
+        if not result:
+            print "No analysis profile for game %d" % gameid
+            return
+        _print_phases(result)
+        if len(params) == 2:
+            pstats.Stats(params[1]).sort_stats('cumulative').print_stats(20)
+
+    def do_reanalyse(self, details):
+        """
+        reanalyse
+        Show progress of the latest sharded reanalysis
+
+        reanalyse start [<shard size>] [force]
+        Start reanalysing all finished games, in shards of game ids. Existing
+        analysis stays in place until each game's new analysis replaces it.
+        Games whose analysis inputs haven't changed are skipped, unless forced.
+        Nobody is emailed.
+
+        reanalyse run [<processes>]
+        Run reanalysis workers until every shard is done. Can be stopped, and
+        run again, to continue where it got to.
+
+        reanalyse resume
+        Queue shards that failed again
+        """
+        params = details.split()
+        force = params[-1:] == ["force"]
+        if force:
+            params = params[:-1]
+        if params and params[0] == "start" and len(params) <= 2:
+            try:
+                shard_size = int(params[1]) if len(params) > 1  \
+                    else reanalysis.SHARD_SIZE
+            except ValueError:
+                print "Bad syntax. See 'help reanalyse'."
+                return
+            result = self.api.start_reanalysis(shard_size, force)
+            if isinstance(result, APIError):
+                print "Error:", result.description
+            else:
+                print "Reanalysis run %d started." % (result,)
+            return
+        elif force:
+            print "Bad syntax. See 'help reanalyse'."
+            return
+        elif params and params[0] == "run" and len(params) <= 2:
+            try:
+                count = int(params[1]) if len(params) > 1  \
+                    else reanalysis.WORKER_COUNT
+            except ValueError:
+                print "Bad syntax. See 'help reanalyse'."
+                return
+            reanalysis.run_reanalysis(count)
+            params = []
+        elif params == ["resume"]:
+            result = self.api.resume_reanalysis()
+            if isinstance(result, APIError):
+                print "Error:", result.description
+            else:
+                print result, "shards queued again."
+            return
+        elif params:
+            print "Bad syntax. See 'help reanalyse'."
+            return
+        result = self.api.get_reanalysis_status()
+        if isinstance(result, APIError):
+            print "Error:", result.description
+            return
+        if result is None:
+            print "No reanalysis has been started."
+            return
+        print "Run %d, started %s" % (result.runid, result.started)
+        print "Shards: %d queued, %d running, %d done, %d failed" %  \
+            (result.queued, result.running, result.done, result.failed)
+        print "Games: %d of %d" % (result.games_done, result.games_total)
+        if result.eta_seconds is not None:
+            print "ETA: %s" % (datetime.timedelta(
+                seconds=int(result.eta_seconds)),)
+
     def do_timeout(self, _details):
         """
         timeout
@@ -2,7 +2,7 @@
 """
 Core API for Range vs. Range backend.
 """
-from rvr.db.creation import BASE, ENGINE, create_session, session_scope
+from rvr.db.creation import BASE, ENGINE, create_session
 from rvr.db import tables
 from rvr.core import dtos
 from functools import wraps
@@ -17,20 +17,23 @@ from rvr.poker.action import range_action_fits, calculate_current_options,  \
     act_passive, act_fold, act_aggressive, WhatCouldBe,\
     generate_excluded_cards, act_terminate
 from rvr.core.dtos import MAP_TABLE_DTO, GamePayment, ActionResult
-from rvr.infrastructure.util import concatenate, on_a_different_thread
+from rvr.infrastructure.util import concatenate
 from rvr.poker.cards import deal_cards, Card, RANKS_HIGH_TO_LOW,  \
     SUITS_HIGH_TO_LOW, TURN, FINISHED
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.orm import joinedload
 from rvr.mail.notifications import notify_current_player, notify_started
 from rvr.analysis.analyse import AnalysisReplayer
 from rvr.db.tables import AnalysisFoldEquity, RangeItem, MAX_CHAT,\
-    PaymentToPlayer, GAME_HISTORY_TABLES
+    PaymentToPlayer
 import datetime
 from rvr.local_settings import SUPPRESSED_SITUATIONS, SUPPRESSED_GAME_MAX
 import re
 from rvr.analysis import statistics, analyse
 from rvr.analysis.statistics import recalculate_global_statistics
-from sqlalchemy.orm.session import sessionmaker
+from rvr.analysis.jobs import enqueue_analysis, queue_status
+from rvr.analysis import reanalysis, profiling, leaderboards
+import cProfile
 from rvr.core.gametree import GameTreeNode, GameTree
 
 def exception_mapper(fun):
@@ -112,6 +115,8 @@ class API(object):
     ERR_DUPLICATE_SITUATION = APIError("Duplicate situation")
     ERR_CANNOT_MERGE = APIError("Can't merge these games")
     ERR_CHAT_TOO_LONG = APIError("Chat too long, max %d chars" % (MAX_CHAT,))
+    ERR_REANALYSIS_RUNNING = APIError("A reanalysis is already in progress")
+    ERR_GAME_NOT_FINISHED = APIError("Game is not finished")
 
     def __init__(self):
         self.session = None  # required for @create_session
@@ -262,11 +267,12 @@ class API(object):
         if matches:
             return self.ERR_DUPLICATE_SCREENNAME
         try:
-            self.session.query(tables.User)  \
-                .filter(tables.User.userid == request.userid)  \
-                .one().screenname = request.screenname
+            user = self.session.query(tables.User)  \
+                .filter(tables.User.userid == request.userid).one()
         except NoResultFound:
             return self.ERR_NO_SUCH_USER
+        user.screenname = request.screenname
+        leaderboards.rename_user(self.session, user.userid, user.screenname)
 
     @api
     def get_user(self, userid):
@@ -784,26 +790,22 @@ class API(object):
         This includes:
          - RunningGame
          - RunningGameParticipant
-         - GAME_HISTORY_TABLES
 
-        Basically copies every table that holds info on a running game, and
-        changes the gameid.
+        Game history is not copied. The new game references its parent and the
+        order it was spawned at, and shares history before that (see
+        RunningGame.history_sources).
         """
         ng = game.copy()
         ng.spawn_group = game.spawn_group  \
             if game.spawn_group is not None else game.gameid
+        ng.parent_gameid = game.gameid
+        ng.fork_order = game.next_hh
         self.session.add(ng)
         self.session.flush()  # get gameid
         for rgp in game.rgps:
             np = rgp.copy()
             np.gameid = ng.gameid
             self.session.add(np)
-        for table in GAME_HISTORY_TABLES:
-            for row in self.session.query(table)  \
-                    .filter(table.gameid == game.gameid).all():
-                nr = row.copy()
-                nr.gameid = ng.gameid
-                self.session.add(nr)
         return ng
 
     def _deal_to_board(self, game):
@@ -1092,11 +1094,14 @@ class API(object):
         if not results:
             logging.debug("gameid %d, determined to terminate", game.gameid)
             act_terminate(game, rgp)
+            enqueue_analysis(self.session, game.gameid)
             return ActionResult.terminate(), []
 
         games = [game] + [self._spawn_game(game) for _ in results[1:]]
         for g, details in zip(games, results):
             self._apply_action_result(g, *details)
+            # analyse as we go, so there's less to do when the game finishes
+            enqueue_analysis(self.session, g.gameid)
         return results[0][1], [g.gameid for g in games[1:]]
 
     def _perform_action(self, game, rgp, range_action, current_options):
@@ -1194,7 +1199,7 @@ class API(object):
 
         # check that it's not a duplicate (ignore if so)
         last = self.session.query(tables.GameHistoryChat)  \
-            .filter(tables.GameHistoryChat.gameid == gameid)  \
+            .filter(game.history_filter(tables.GameHistoryChat))  \
             .filter(tables.GameHistoryChat.order == game.next_hh - 1).all()
         if last and last[0].message == message and last[0].userid == userid:
             # very last item in hand history is a chat
@@ -1204,13 +1209,13 @@ class API(object):
 
         self._record_chat(rgp, message)
 
-    def _get_payments(self, child):
+    def _get_payments(self, game, child):
         """
         Return list of payment DTOs
         """
         results = []
         payments = self.session.query(PaymentToPlayer)  \
-            .filter(PaymentToPlayer.gameid == child.gameid)  \
+            .filter(PaymentToPlayer.gameid == game.gameid)  \
             .filter(PaymentToPlayer.order == child.order).all()
         for payment in payments:
             results.append(GamePayment(payment))
@@ -1221,9 +1226,13 @@ class API(object):
         Returns a list of game history items (tables.GameHistoryBase with
         additional details from child tables), with private data only for
         <userid>, if specified.
+
+        Payments come from analysis, which is private data, so there are none
+        until the game is finished (and not hidden).
         """
+        is_finished = game.game_finished and not hide
         child_items = [self.session.query(table)
-                       .filter(table.gameid == game.gameid).all()
+                       .filter(game.history_filter(table)).all()
                        for table in MAP_TABLE_DTO.keys()]
         all_child_items = sorted(concatenate(child_items),
                                  key=lambda c: c.order)
@@ -1231,12 +1240,14 @@ class API(object):
                       for child in all_child_items]
         all_userids = [rgp.userid for rgp in game.rgps]
         history = [dto for dto in child_dtos if
-            dto.should_include_for(userid, all_userids,
-                game.game_finished and not hide, public_ranges)]
+            dto.should_include_for(userid, all_userids, is_finished,
+                                   public_ranges)]
         payments = {} # map order to map reason to list payments
         for child in all_child_items:
             payments[child.order] = {}
-            for payment in self._get_payments(child):
+            if not is_finished:
+                continue
+            for payment in self._get_payments(game, child):
                 if not payments[child.order].has_key(payment.reason):
                     payments[child.order][payment.reason] = []
                 payments[child.order][payment.reason].append(payment)
@@ -1246,11 +1257,43 @@ class API(object):
         """
         Returns an ordered list of analysis items form the game.
         """
+        # items are loaded in the same query
         afes = self.session.query(AnalysisFoldEquity)  \
+            .options(joinedload(AnalysisFoldEquity.items))  \
             .filter(AnalysisFoldEquity.gameid == game.gameid).all()
-        return {afe.order: dtos.AnalysisItemFoldEquity.from_afe(afe)
+        bettors = {ar.order: ar.user for ar in self.session  \
+            .query(tables.GameHistoryActionResult)  \
+            .filter(game.history_filter(tables.GameHistoryActionResult))}
+        return {afe.order:
+                dtos.AnalysisItemFoldEquity.from_afe(afe, bettors[afe.order])
                 for afe in afes}
 
+    def _is_hack(self, game):
+        """
+        Is this one of the games that are played as a group, with results
+        hidden until the whole group is finished?
+        """
+        # TODO: 0: DODGY HACK!
+        screennames = [rgp.user.screenname for rgp in game.rgps]
+        return set(screennames) == set(['Cwlrs2', 'screenname'])
+
+    def _hide(self, game):
+        """
+        Should private data be hidden even though the game is finished?
+        """
+        if not self._is_hack(game) or not game.game_finished:
+            return False
+        group_games = self.session.query(tables.RunningGame)  \
+            .filter(tables.RunningGame.spawn_group == game.spawn_group).all()
+        return not all(g.game_finished for g in group_games)
+
+    def _analysis_visible(self, game):
+        """
+        Analysis is private data, because it includes both players' ranges, so
+        it's only visible once the game is finished (and not hidden).
+        """
+        return game.game_finished and not self._hide(game)
+
     def _get_game(self, gameid, userid=None):
         """
         Return game <gameid>. If <userid> is not None, return private data for
@@ -1269,21 +1312,16 @@ class API(object):
             return self.ERR_NO_SUCH_GAME
         game = games[0]
         game_details = dtos.RunningGameDetails.from_running_game(game)
-        # TODO: 0: DODGY HACK!
-        screennames = [details.user.screenname
-                       for details in game_details.rgp_details]
-        is_hack = set(screennames) == set(['Cwlrs2', 'screenname'])
-        public_ranges = game_details.public_ranges and not is_hack
-        hide = False
-        if is_hack and game.game_finished:
-            group_games = self.session.query(tables.RunningGame)  \
-                .filter(tables.RunningGame.spawn_group ==
-                        game.spawn_group).all()
-            hide = not all(g.game_finished for g in group_games)
+        public_ranges = game_details.public_ranges and not self._is_hack(game)
+        hide = self._hide(game)
         history_items, payment_items = self._get_history_items(game,
             userid=userid, public_ranges=public_ranges,
             hide=hide)
-        analysis_items = self._get_analysis_items(game)
+        if game.game_finished and not hide:
+            analysis_items = self._get_analysis_items(game)
+        else:
+            # Analysis is done as the game progresses, but is private data.
+            analysis_items = {}
         if game.current_userid is None:
             current_options = None
         else:
@@ -1323,7 +1361,7 @@ class API(object):
             if not game.game_finished:
                 continue
             timeouts = self.session.query(tables.GameHistoryTimeout)  \
-                .filter(tables.GameHistoryTimeout.gameid == game.gameid).all()
+                .filter(game.history_filter(tables.GameHistoryTimeout)).all()
             if timeouts:
                 continue
             for rgp in game.rgps:
@@ -1362,40 +1400,6 @@ class API(object):
                     logging.debug("Created open game %d for situation %d",
                                   new_game.gameid, situation.situationid)
 
-    def _write_statistics(self, userid, is_competition, results):
-        """
-        Write these results to the database, so we can have leaderboards.
-
-        Note the strange approach of write-on-request, not centralised
-        calculations. The justification here is that people who aren't
-        interested in their results won't be shown in the leaderboards, but
-        they're probably irrelevant anyway. But I'll probably change it at some
-        point.
-        """
-        # TODO: REVISIT: Don't wait for user to request it, do it daily.
-        # TODO: REVISIT: Change get_user_statistics to read from DB, not write.
-        for sr in results:
-            for pos in sr.positions:
-                usp = tables.UserSituationPlayer()
-                usp.userid = userid
-                usp.situationid = pos.situationid
-                usp.order = pos.order
-                usp.public_ranges = not is_competition
-                usp.amount_won = pos.total
-                usp.redline = pos.redline
-                usp.blueline = pos.blueline
-                usp.hands_played = pos.played
-                usp.confidence = pos.confidence
-                _merged = self.session.merge(usp)  # insert or update
-                logging.info("Added UserSituationPlayer(userid=%r, "
-                    "situationid=%r, order=%r, public_ranges=%r, "
-                    "amount_won=%r, redline=%r, blueline=%r, hands_played=%r, "
-                    "confidence=%r",
-                    _merged.userid, _merged.situationid, _merged.order,
-                    _merged.public_ranges, _merged.amount_won,
-                    _merged.redline, _merged.blueline,
-                    _merged.hands_played, _merged.confidence)
-
     @api
     def get_user_statistics(self, userid, min_hands=1, is_competition=True):
         """
@@ -1414,10 +1418,8 @@ class API(object):
             .filter(tables.User.userid == userid).all()
         if not matches:
             return self.ERR_NO_SUCH_USER
-        results = statistics.get_user_statistics(self.session, userid,
+        return statistics.get_user_statistics(self.session, userid,
             min_hands, is_competition)
-        self._write_statistics(userid, is_competition, results)
-        return results
 
     @api
     def get_leaderboards(self, situationid, size, min_played=1):
@@ -1433,24 +1435,9 @@ class API(object):
             .filter(tables.Situation.situationid == situationid).one()
         results = []
         for player in situation.players:
-            usps = self.session.query(tables.UserSituationPlayer)  \
-                .filter(tables.UserSituationPlayer.situationid == situationid) \
-                .filter(tables.UserSituationPlayer.order == player.order)  \
-                .filter(tables.UserSituationPlayer.public_ranges == False)  \
-                .filter(tables.UserSituationPlayer.hands_played >= min_played) \
-                .filter(tables.UserSituationPlayer.confidence > 0.5)  \
-                .order_by(tables.UserSituationPlayer.confidence.desc())  \
-                .limit(size).all()
-            leaderboards = []
-            for usp in usps:
-                leaderboards.append(dtos.LeaderboardEntry(
-                    screenname=usp.user.screenname,
-                    average=usp.amount_won / usp.hands_played,
-                    redline=usp.redline / usp.hands_played,
-                    blueline=usp.blueline / usp.hands_played,
-                    confidence=usp.confidence,
-                    played=usp.hands_played))
-            results.append((player.name, leaderboards))
+            results.append((player.name, leaderboards.get_leaderboard(
+                self.session, situationid, player.order, False, size,
+                min_played)))
         return situation.description, results
 
     @api
@@ -1487,7 +1474,15 @@ class API(object):
         data is list of tuples: (combo, ev), sorted low to high
 
         if brief, omit items with EV of 0.0
+
+        returns an empty list if the game's analysis is not yet visible
         """
+        games = self.session.query(tables.RunningGame)  \
+            .filter(tables.RunningGame.gameid == gameid).all()
+        if not games:
+            return self.ERR_NO_SUCH_GAME
+        if not self._analysis_visible(games[0]):
+            return []
         if order is None:
             q = self.session.query(tables.UserComboGameEV)  \
                 .filter(tables.UserComboGameEV.gameid == gameid)
@@ -1510,6 +1505,34 @@ class API(object):
         return [(user, userid_to_data[userid])
                 for userid, user in userid_to_user.iteritems()]
 
+    @api
+    def get_showdown_combo_evs(self, gameid, order):
+        """
+        returns list of tuples: (user, data), ordered by userid
+
+        data is list of tuples: (combo, ev), sorted low to high
+
+        Games analysed before showdown combo EVs were recorded will return an
+        empty list, as will games whose analysis is not yet visible.
+        """
+        games = self.session.query(tables.RunningGame)  \
+            .filter(tables.RunningGame.gameid == gameid).all()
+        if not games:
+            return self.ERR_NO_SUCH_GAME
+        if not self._analysis_visible(games[0]):
+            return []
+        combo_evs = self.session.query(tables.ShowdownComboEV)  \
+            .filter(tables.ShowdownComboEV.gameid == gameid)  \
+            .filter(tables.ShowdownComboEV.order == order)  \
+            .order_by(tables.ShowdownComboEV.userid,
+                      tables.ShowdownComboEV.ev).all()
+        results = []
+        for ev in combo_evs:
+            if not results or results[-1][0].userid != ev.userid:
+                results.append((dtos.UserDetails.from_user(ev.user), []))
+            results[-1][1].append((ev.combo, ev.ev))
+        return results
+
     def _run_pending_analysis(self, gameid=None, debug_combo=""):
         """
         Look through all games for analysis that has not yet been done, and do
@@ -1532,33 +1555,6 @@ class API(object):
                 replayer.finalise()
                 found = True
 
-    def _analyse_immediately(self, gameid):
-        """
-        Analyse game on a different thread.
-        """
-        # TODO: 5: on-going semi-immediate analysis (long-running process)
-        # with analysis etc. triggered by socket
-        # (_analyse_immediately didn't work in production)
-        def do_analyse():
-            """
-            With new session, because I doubt they're thread safe.
-            """
-            with session_scope(sessionmaker(bind=ENGINE)) as session:
-                try:
-                    game = session.query(tables.RunningGame)  \
-                        .filter(tables.RunningGame.gameid == gameid).one()
-                except NoResultFound:
-                    logging.warning("No game for immediate analysis: %d", gameid)
-                    return
-                if game.analysis_performed:
-                    return
-                replayer = AnalysisReplayer(session, game)
-                replayer.analyse()
-                replayer.finalise()
-                session.commit()
-                session.close()
-        on_a_different_thread(do_analyse)
-
     @api
     def run_pending_analysis(self):
         """
@@ -1566,6 +1562,27 @@ class API(object):
         """
         return self._run_pending_analysis()
 
+    @api
+    def enqueue_pending_analysis(self):
+        """
+        Queue analysis jobs for finished games that haven't been analysed (and
+        aren't already queued). Returns the number of games.
+        """
+        games = self.session.query(tables.RunningGame)  \
+            .filter(tables.RunningGame.current_round == FINISHED)  \
+            .filter(tables.RunningGame.gameid > SUPPRESSED_GAME_MAX)  \
+            .filter(tables.RunningGame.analysis_performed == False).all()
+        for game in games:
+            enqueue_analysis(self.session, game.gameid)
+        return len(games)
+
+    @api
+    def get_analysis_queue(self):
+        """
+        Returns AnalysisQueueStatus, describing queue depth and throughput.
+        """
+        return queue_status(self.session)
+
     @api
     def recalculate_global_statistics(self):
         """
@@ -1574,48 +1591,150 @@ class API(object):
         recalculate_global_statistics(self.session)
 
     @api
-    def reanalyse(self, gameid, debug_combo=""):
+    def rebuild_leaderboards(self):
+        """
+        Recalculate every user's confidence in every position, and all
+        leaderboards
+        """
+        statistics.refresh_confidences(self.session)
+
+    @api
+    def rebuild_user_statistics(self):
+        """
+        Recalculate all users' statistics (and leaderboards) from scratch
+        """
+        statistics.rebuild_user_statistics(self.session)
+
+    @api
+    def reanalyse(self, gameid, debug_combo="", force=False):
         """
         Delete analysis for this game, reanalyse this game.
+
+        Unless forced (or debugging a combo), a game whose analysis inputs
+        haven't changed isn't reanalysed.
         """
-        self.session.query(tables.AnalysisFoldEquityItem)  \
-            .filter(tables.AnalysisFoldEquityItem.gameid == gameid).delete()
-        self.session.query(tables.AnalysisFoldEquity)  \
-            .filter(tables.AnalysisFoldEquity.gameid == gameid).delete()
-        self.session.query(tables.UserComboGameEV)  \
-            .filter(tables.UserComboGameEV.gameid == gameid).delete()
-        self.session.query(tables.UserComboOrderEV)  \
-            .filter(tables.UserComboOrderEV.gameid == gameid).delete()
-        self.session.query(tables.GameHistoryShowdownEquity)  \
-            .filter(tables.GameHistoryShowdownEquity.gameid == gameid)  \
-            .update({tables.GameHistoryShowdownEquity.equity: None})
-        self.session.query(tables.RunningGameParticipantResult)  \
-            .filter(tables.RunningGameParticipantResult.gameid == gameid)  \
-            .delete()
-        self.session.query(tables.PaymentToPlayer)  \
-            .filter(tables.PaymentToPlayer.gameid == gameid).delete()
-        self.session.query(tables.RunningGame)  \
-            .filter(tables.RunningGame.gameid == gameid)  \
-            .one().analysis_performed = False
+        game = self.session.query(tables.RunningGame)  \
+            .filter(tables.RunningGame.gameid == gameid).one()
+        if not force and not debug_combo and  \
+                analyse.analysis_is_current(self.session, game):
+            logging.debug("gameid %d, analysis is current, not reanalysing",
+                          gameid)
+            return
+        analyse.delete_analysis(self.session, gameid)
+        game.analysis_performed = False
         self.session.commit()
         return self._run_pending_analysis(gameid, debug_combo)
 
     @api
-    def reanalyse_all(self):
+    def reanalyse_all(self, force=False):
         """
         Delete all analysis, and reanalyse all games.
-        """
-        self.session.query(tables.AnalysisFoldEquityItem).delete()
-        self.session.query(tables.AnalysisFoldEquity).delete()
-        self.session.query(tables.GameHistoryShowdownEquity)  \
-            .update({tables.GameHistoryShowdownEquity.equity: None})
-        self.session.query(tables.RunningGameParticipantResult).delete()
-        self.session.query(tables.PaymentToPlayer).delete()
-        self.session.query(tables.RunningGame)  \
-            .update({tables.RunningGame.analysis_performed: False})
+
+        Unless forced, only finished games whose analysis inputs have changed
+        (or that haven't been analysed) are reanalysed.
+        """
+        if force:
+            self.session.query(tables.AnalysisCheckpoint).delete()
+            self.session.query(tables.AnalysisProfile).delete()
+            self.session.query(tables.AnalysisInputHash).delete()
+            self.session.query(tables.AnalysisFoldEquityItem).delete()
+            self.session.query(tables.AnalysisFoldEquity).delete()
+            self.session.query(tables.ShowdownComboEV).delete()
+            self.session.query(tables.GameHistoryShowdownEquity)  \
+                .update({tables.GameHistoryShowdownEquity.equity: None})
+            statistics.clear_user_statistics(self.session)
+            statistics.clear_global_statistics(self.session)
+            self.session.query(tables.RunningGameParticipantResult).delete()
+            self.session.query(tables.UserComboGameEV).delete()
+            self.session.query(tables.UserComboOrderEV).delete()
+            self.session.query(tables.PaymentToPlayer).delete()
+            self.session.query(tables.RunningGame)  \
+                .update({tables.RunningGame.analysis_performed: False})
+        else:
+            games = self.session.query(tables.RunningGame)  \
+                .filter(tables.RunningGame.current_round == FINISHED)  \
+                .filter(tables.RunningGame.gameid > SUPPRESSED_GAME_MAX).all()
+            stale = [game for game in games
+                     if not analyse.analysis_is_current(self.session, game)]
+            for game in stale:
+                analyse.delete_analysis(self.session, game.gameid)
+                game.analysis_performed = False
+            logging.info("reanalysing %d games, %d are unchanged",
+                         len(stale), len(games) - len(stale))
         self.session.commit()
         return self._run_pending_analysis()
 
+    @api
+    def get_analysis_profile(self, count=10):
+        """
+        Returns (the <count> games that took longest to analyse, as a list of
+        GameAnalysisTime, and a list of AnalysisPhaseProfile totalled over all
+        games)
+        """
+        return (profiling.slowest_games(self.session, count),
+                profiling.slowest_phases(self.session))
+
+    @api
+    def get_game_analysis_profile(self, gameid):
+        """
+        Returns a list of AnalysisPhaseProfile for the game's analysis
+        """
+        return profiling.game_profile(self.session, gameid)
+
+    @api
+    def profile_analysis(self, gameid, filename):
+        """
+        Analyse the game from scratch under cProfile, and dump the stats to
+        filename (for pstats). The analysis is rolled back, so the game's
+        existing analysis isn't touched.
+
+        Returns a list of AnalysisPhaseProfile for this analysis.
+        """
+        game = self.session.query(tables.RunningGame)  \
+            .filter(tables.RunningGame.gameid == gameid).first()
+        if game is None:
+            return self.ERR_NO_SUCH_GAME
+        if not game.game_finished:
+            return self.ERR_GAME_NOT_FINISHED
+        analyse.delete_analysis(self.session, gameid)
+        game.analysis_performed = False
+        replayer = AnalysisReplayer(self.session, game)
+        profile = cProfile.Profile()
+        profile.runcall(replayer.rebuild)
+        phases = profiling.game_profile(self.session, gameid)
+        self.session.rollback()
+        profile.dump_stats(filename)
+        return phases
+
+    @api
+    def start_reanalysis(self, shard_size=reanalysis.SHARD_SIZE, force=False):
+        """
+        Start a sharded reanalysis of all finished games, to be run by
+        reanalysis workers. Existing analysis is replaced game by game, as the
+        workers get to it (unless its inputs haven't changed, and the
+        reanalysis isn't forced). Returns the run id.
+        """
+        runid = reanalysis.start_reanalysis(self.session, shard_size,
+                                            force=force)
+        if runid is None:
+            return self.ERR_REANALYSIS_RUNNING
+        return runid
+
+    @api
+    def resume_reanalysis(self):
+        """
+        Queue failed shards of the latest reanalysis again. Returns the number
+        of shards.
+        """
+        return reanalysis.resume_reanalysis(self.session)
+
+    @api
+    def get_reanalysis_status(self):
+        """
+        Returns ReanalysisStatus for the latest reanalysis, or None.
+        """
+        return reanalysis.reanalysis_status(self.session)
+
     def _timeout_running(self, rgp):
         """
         Timeout user from running game - make them fold their entire range
@@ -1835,4 +1954,4 @@ def _create_cap():
         pot_pre=0,
         increment=2,
         bet_count=1)
-    return cap_situation
+    return cap_situation
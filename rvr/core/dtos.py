@@ -241,9 +241,9 @@ def calculate_betting_line(game):
     """
     session = object_session(game)
     actions = session.query(tables.GameHistoryActionResult).filter(
-        tables.GameHistoryActionResult.gameid == game.gameid).all()
+        game.history_filter(tables.GameHistoryActionResult)).all()
     boards = session.query(tables.GameHistoryBoard).filter(
-        tables.GameHistoryBoard.gameid == game.gameid).all()
+        game.history_filter(tables.GameHistoryBoard)).all()
     combined = sorted(actions + boards, key=lambda a: a.order)
     current_round = game.situation.current_round
     results = {}
@@ -463,6 +463,92 @@ class LeaderboardEntry(object):
             (self.screenname, self.average, self.redline, self.blueline,
              self.confidence, self.played)
 
+class AnalysisQueueStatus(object):
+    """
+    Depth and throughput of the analysis job queue.
+
+    queued includes jobs waiting to retry; due is those that can run now.
+    mean_duration is in seconds, for jobs done in the last day.
+    """
+    def __init__(self, queued, due, running, failed, done_last_hour,
+                 done_last_day, mean_duration, oldest_due):
+        self.queued = queued
+        self.due = due
+        self.running = running
+        self.failed = failed
+        self.done_last_hour = done_last_hour
+        self.done_last_day = done_last_day
+        self.mean_duration = mean_duration
+        self.oldest_due = oldest_due
+
+    def __repr__(self):
+        return "AnalysisQueueStatus(queued=%r, due=%r, running=%r, "  \
+            "failed=%r, done_last_hour=%r, done_last_day=%r, "  \
+            "mean_duration=%r, oldest_due=%r)" %  \
+            (self.queued, self.due, self.running, self.failed,
+             self.done_last_hour, self.done_last_day, self.mean_duration,
+             self.oldest_due)
+
+class AnalysisPhaseProfile(object):
+    """
+    Time and counters for one phase of analysis, for a game or totalled over
+    games. seconds includes phases nested in this one.
+    """
+    def __init__(self, phase, calls, seconds, equity_calls, iterations, combos,
+                 rows):
+        self.phase = phase
+        self.calls = calls
+        self.seconds = seconds
+        self.equity_calls = equity_calls
+        self.iterations = iterations
+        self.combos = combos
+        self.rows = rows
+
+    def __repr__(self):
+        return "AnalysisPhaseProfile(phase=%r, calls=%r, seconds=%r, "  \
+            "equity_calls=%r, iterations=%r, combos=%r, rows=%r)" %  \
+            (self.phase, self.calls, self.seconds, self.equity_calls,
+             self.iterations, self.combos, self.rows)
+
+class GameAnalysisTime(object):
+    """
+    How long a game took to analyse, in total
+    """
+    def __init__(self, gameid, seconds):
+        self.gameid = gameid
+        self.seconds = seconds
+
+    def __repr__(self):
+        return "GameAnalysisTime(gameid=%r, seconds=%r)" %  \
+            (self.gameid, self.seconds)
+
+class ReanalysisStatus(object):
+    """
+    Progress of the latest bulk reanalysis run.
+
+    queued, running, done and failed are counts of shards. eta_seconds is
+    estimated from the rate so far, and is None until a game has been done.
+    """
+    def __init__(self, runid, queued, running, done, failed, games_total,
+                 games_done, started, eta_seconds):
+        self.runid = runid
+        self.queued = queued
+        self.running = running
+        self.done = done
+        self.failed = failed
+        self.games_total = games_total
+        self.games_done = games_done
+        self.started = started
+        self.eta_seconds = eta_seconds
+
+    def __repr__(self):
+        return "ReanalysisStatus(runid=%r, queued=%r, running=%r, done=%r, "  \
+            "failed=%r, games_total=%r, games_done=%r, started=%r, "  \
+            "eta_seconds=%r)" %  \
+            (self.runid, self.queued, self.running, self.done, self.failed,
+             self.games_total, self.games_done, self.started,
+             self.eta_seconds)
+
 class UsersGameDetails(object):
     """
     lists of open game details, running game details, for a specific user
@@ -886,11 +972,11 @@ class AnalysisItemFoldEquity(object):
              self.items)
 
     @classmethod
-    def from_afe(cls, afe):
+    def from_afe(cls, afe, user):
         """
-        Create from AnalysisFoldEquity
+        Create from AnalysisFoldEquity, and the User who bet
         """
-        bettor = UserDetails.from_user(afe.action_result.user)
+        bettor = UserDetails.from_user(user)
         items = [AnalysisItemFoldEquityItem.from_afei(item)
                  for item in afe.items]
         items.sort(key=lambda item: (-item.immediate_result, item.cards),
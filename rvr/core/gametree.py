@@ -1,12 +1,16 @@
+import unittest
+import numpy
 from rvr.poker.cards import Card, RIVER
-from rvr.poker.handrange import HandRange, unweighted_options_to_description,\
-    remove_board_from_range, NOTHING
-from rvr.poker.showdown import showdown_equity
+from rvr.poker.handrange import HandRange, remove_board_from_range, NOTHING,\
+    options_to_indices, options_to_lookup, combo_index, ALL_COMBOS,\
+    COMBO_MASKS
+from rvr.poker.showdown import range_equities
 from sqlalchemy.orm.session import object_session
 from rvr.core.dtos import line_description, ActionResult, UserDetails
-from rvr.poker.action import range_contains_hand
 from rvr.db import tables
-from rvr.infrastructure.util import concatenate
+
+# iterations for showdown equity of each combo of a range
+SHOWDOWN_ITERATIONS = 10000
 
 class InvalidComboForTree(Exception):
     """
@@ -34,7 +38,8 @@ class GameTreeNode(object):
         self.total_contrib = dict(total_contrib)
         self.winners = set(winners) if winners else None  # set of userid
         self.final_pot = final_pot
-        self.combo_evs = {}
+        self.range_evs_by_userid = {}  # map of userid to range_evs() result
+        self.showdown_equities = None  # range_equities() result, at showdown
 
     def __repr__(self):
         child_actions = [child.action.to_action() for child in self.children]
@@ -57,6 +62,13 @@ class GameTreeNode(object):
         return partial
     betting_line = property(get_betting_line)
 
+    def options(self, userid):
+        """
+        The user's options at this point in the game tree
+        """
+        return self.ranges_by_userid[userid].generate_options(
+            Card.many_from_text(self.board))
+
     def all_combos_ev(self, userid, local=False):
         """
         Return a mapping of combo to EV at this point in the game tree, for each
@@ -64,106 +76,114 @@ class GameTreeNode(object):
 
         Recall that a combo is a frozenset of two cards.
         """
-        user_range = self.ranges_by_userid[userid]
-        combos = user_range.generate_options(Card.many_from_text(self.board))
-        results = {}
-        for combo in combos:
-            try:
-                results[combo] = self.combo_ev(combo, userid, local)
-            except InvalidComboForTree as ex:
-                pass  # TODO: 0.0: happening way too often!
-        return results
+        evs, valid = self.range_evs(userid)
+        if local:
+            # To their true EV for the whole game at this point, add back their
+            # total contributions so far. This yields their EV compared to
+            # folding at this point. Basically, you don't want this ever to
+            # be negative.
+            evs = evs + self.total_contrib[userid]
+        # TODO: 0.0: combos are invalid way too often!
+        return {ALL_COMBOS[index]: float(evs[index])
+                for index in numpy.flatnonzero(valid)}
 
-    def calculate_combo_ev(self, combo, userid):
+    def combo_ev(self, combo, userid, local=False):
         """
-        Calculate EV for a combo at this point in the game tree.
+        EV for a combo at this point in the game tree.
         """
-        if self.children:
-            # intermediate node, EV is combination of children's
-            # oh, each child needs a weight / probability
-            # oh, it's combo specific... "it depends" ;)
+        evs, valid = self.range_evs(userid)
+        index = combo_index(combo)
+        if not valid[index]:
+            raise InvalidComboForTree('Combo not valid for userid %d at '
+                'betting line %s.' %
+                (userid, line_description(self.betting_line)))
+        if local:
+            return float(evs[index]) + self.total_contrib[userid]
+        else:
+            return float(evs[index])
 
-            # EV of combo is:
-            # weighted sum of EV of children, but only for children where the
-            # combo is present (where combo isn't present, probability is zero)
+    def range_evs(self, userid):
+        """
+        EV at this point in the game tree for every combo for this user,
+        potentially pre-calculated.
 
-            # to assess probability:
-            # - if this node's children are performed by this user:
-            #   - EV is the EV of the action that contains this combo
-            # - otherwise:
-            #   - remove combo from the children's actor's current range
-            #   - consider how many combo's of children's actor's current range
-            #     proceed to each child
-            #   - voila
-            # This conveniently works even in a multi-way pot. It's a very good
-            # approximation of the true probabilities. And note that truly
-            # calculating the true probabilities is not possible.
+        returns a tuple of numpy arrays indexed by combo index: the EV of each
+        combo, and whether that EV is valid (it isn't for combos outside the
+        user's range, or for which some branches of the sub-tree are not
+        possible)
+        """
+        if userid not in self.range_evs_by_userid:
+            evs, valid = self.calculate_range_evs(userid)
+            valid &= options_to_lookup(self.options(userid))
+            self.range_evs_by_userid[userid] = (evs, valid)
+        return self.range_evs_by_userid[userid]
+
+    def calculate_range_evs(self, userid):
+        """
+        Calculate EV for every combo at this point in the game tree, bottom-up
+        from the children's EVs.
+        """
+        evs = numpy.zeros(len(ALL_COMBOS))
+        valid = numpy.ones(len(ALL_COMBOS), dtype=bool)
+        if self.children:
+            # intermediate node, EV is combination of children's, but only for
+            # children where the combo is present (where combo isn't present,
+            # probability is zero)
             actor = self.children[0].actor
             if actor == userid:
                 # EV is the EV of the action that contains this combo
-                for node in self.children:
-                    if range_contains_hand(node.ranges_by_userid[userid],
-                                           combo):
-                        return node.combo_ev(combo, userid)
-                raise InvalidComboForTree('Combo not in child ranges for userid'
-                    ' %d at betting line %s.' %
-                    (userid, line_description(self.betting_line)))
+                found = numpy.zeros(len(ALL_COMBOS), dtype=bool)
+                for child in self.children:
+                    child_evs, child_valid = child.range_evs(userid)
+                    contains = options_to_lookup(child.options(userid)) & ~found
+                    evs[contains] = child_evs[contains]
+                    valid &= child_valid | ~contains
+                    found |= contains
+                valid &= found
             else:
                 # probabilistic weighting of child EVs
-                # size of bucket is probability of this child
-                valid_children = [child for child in self.children
-                    if range_contains_hand(child.ranges_by_userid[userid],
-                                           combo)]
-                buckets = {child: child.ranges_by_userid[actor]  \
-                    .generate_options(Card.many_from_text(child.board) +
-                                      list(combo))
-                    for child in valid_children}
-                total = len(concatenate(buckets.values()))
-                if total == 0:
-                    raise InvalidComboForTree('Combo not in child ranges for'
-                        ' userid %d at betting line %s. ' % (userid,
-                        line_description(self.betting_line)))
-                probabilities = {child: 1.0 * len(buckets[child]) / total
-                                 for child in valid_children}
-                ev = sum(probabilities[child] * child.combo_ev(combo, userid)
-                    for child in valid_children)
-                return ev
+                # size of bucket is probability of this child: the number of
+                # the actor's combos that proceed to this child, once the combo
+                # is removed from them
+                # This conveniently works even in a multi-way pot. It's a very
+                # good approximation of the true probabilities. And note that
+                # truly calculating the true probabilities is not possible.
+                total = numpy.zeros(len(ALL_COMBOS))
+                for child in self.children:
+                    child_evs, child_valid = child.range_evs(userid)
+                    contains = options_to_lookup(child.options(userid))
+                    valid &= child_valid | ~contains
+                    bucket = options_to_indices(child.options(actor))
+                    if not len(bucket):
+                        continue
+                    sizes = ((COMBO_MASKS[bucket][:, numpy.newaxis] &
+                              COMBO_MASKS[numpy.newaxis, :]) == 0).sum(axis=0)
+                    sizes[~contains] = 0
+                    total += sizes
+                    evs += sizes * numpy.where(contains, child_evs, 0.0)
+                valid &= total > 0
+                evs[valid] /= total[valid]
                 # Invalid combos are ignored / not calculated or aggregated.
         elif userid not in self.winners:
             # they folded
-            return 0.0 - self.total_contrib[userid]
+            evs[:] = 0.0 - self.total_contrib[userid]
         elif len(self.winners) == 1:
             # uncontested pot
-            return 0.0 + self.final_pot - self.total_contrib[userid]
+            evs[:] = 0.0 + self.final_pot - self.total_contrib[userid]
         else:
-            # showdown
-            ranges = {userid: range_
-                      for userid, range_ in self.ranges_by_userid.items()}
-            combos = set([combo])
-            description = unweighted_options_to_description(combos)
-            ranges[userid] = HandRange(description)
-            equities, _iteration =  \
-                showdown_equity(ranges, Card.many_from_text(self.board),
-                    hard_limit=10000)
-            equity = equities[userid]
-            return equity * self.final_pot - self.total_contrib[userid]
-
-    def combo_ev(self, combo, userid, local=False):
-        """
-        EV for a combo at this point in the game tree, potentially
-        pre-calculated.
-        """
-        key = (combo, userid)
-        if not self.combo_evs.has_key(key):
-            self.combo_evs[key] = self.calculate_combo_ev(combo, userid)
-        if local:
-            # To their true EV for the whole game at this point, add back their
-            # total contributions so far. This yields their EV compared to
-            # folding at this point. Basically, you don't want this ever to
-            # be negative.
-            return self.combo_evs[key] + self.total_contrib[userid]
-        else:
-            return self.combo_evs[key]
+            # showdown, for the whole range at once
+            valid[:] = False
+            if self.showdown_equities is None:
+                # one calculation for every player in the showdown
+                self.showdown_equities = range_equities(
+                    Card.many_from_text(self.board), self.ranges_by_userid,
+                    SHOWDOWN_ITERATIONS)
+            for combo, equity in self.showdown_equities[userid]:
+                index = combo_index(combo)
+                evs[index] = equity * self.final_pot -  \
+                    self.total_contrib[userid]
+                valid[index] = True
+        return evs, valid
 
     @classmethod
     def _merge(cls, node, partial):
@@ -225,7 +245,7 @@ class GameTreeNode(object):
                       tables.GameHistoryShowdown,
                       tables.GameHistoryBoard]:
             history.extend(session.query(table)  \
-                .filter(table.gameid == game.gameid).all())
+                .filter(game.history_filter(table)).all())
         history.sort(key=lambda row: row.order)
         current_round = game.situation.current_round
         stacks = {rgp.userid: player.stack
@@ -377,3 +397,51 @@ class GameTree(object):
         groupid = games[0].spawn_group
         users = [UserDetails.from_user(rgp.user) for rgp in games[0].rgps]
         return cls(groupid, users, root)
+
+class Test(unittest.TestCase):
+    """ Tests for combo EVs in the game tree """
+    # pylint:disable=C0103,R0904
+    def _tree(self, range1):
+        """
+        On the river, user 2 calls with KK and folds 33 against user 1
+        """
+        contrib = {1: 10, 2: 10}
+        root = GameTreeNode(RIVER, "AhKd2c7s9h", None, None, None,
+                            {1: range1, 2: "KK,33"}, contrib)
+        root.children.append(GameTreeNode(
+            RIVER, "AhKd2c7s9h", 2, ActionResult.fold(), root,
+            {1: range1, 2: "33"}, contrib, winners=[1], final_pot=20))
+        root.children.append(GameTreeNode(
+            RIVER, "AhKd2c7s9h", 2, ActionResult.call(0), root,
+            {1: range1, 2: "KK"}, contrib, winners=[1, 2], final_pot=20))
+        return root
+
+    def _ev(self, root, userid, combo, local=False):
+        """ EV of a combo given as text """
+        return root.combo_ev(frozenset(Card.many_from_text(combo)), userid,
+                             local)
+
+    def test_opponent_actions(self):
+        root = self._tree("QQ,Qh3h")
+        evs = root.all_combos_ev(1)
+        self.assertEqual(len(evs), 7)
+        # 6 combos of 33 fold, 3 combos of KK win at showdown
+        self.assertAlmostEqual(self._ev(root, 1, "QsQc"), 10.0 / 3)
+        self.assertAlmostEqual(self._ev(root, 1, "QsQc", local=True),
+                               10.0 / 3 + 10)
+        # but Qh3h blocks half of 33
+        self.assertAlmostEqual(self._ev(root, 1, "Qh3h"), 0.0)
+        self.assertRaises(InvalidComboForTree, self._ev, root, 1, "JsJc")
+
+    def test_own_actions(self):
+        root = self._tree("QQ")
+        evs = root.all_combos_ev(2)
+        self.assertEqual(len(evs), 9)
+        self.assertAlmostEqual(self._ev(root, 2, "KsKc"), 10.0)
+        self.assertAlmostEqual(self._ev(root, 2, "3s3c"), -10.0)
+        # the showdown and the fold are possible for every combo
+        self.assertEqual(set(evs), set(root.children[0].all_combos_ev(2)) |
+                         set(root.children[1].all_combos_ev(2)))
+
+if __name__ == '__main__':
+    unittest.main()
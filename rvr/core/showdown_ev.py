@@ -0,0 +1,240 @@
+"""
+Computes showdown combo EVs off the web thread, for the showdown page.
+
+Calculations are run on a small, bounded process pool. Requests for the same
+(gameid, order) are deduplicated, and completed results are cached in memory so
+that later views (and polls) are instant. Failures are only remembered briefly,
+after which the calculation is retried.
+"""
+from multiprocessing import Pool
+from collections import OrderedDict
+import threading
+import time
+import logging
+import unittest
+from rvr.poker.cards import Card
+from rvr.poker.handrange import HandRange
+from rvr.poker.showdown import all_combos_ev
+
+POOL_SIZE = 2
+JOB_TIMEOUT = 120  # seconds, not counting time queued
+CACHE_SIZE = 500
+FAILURE_EXPIRY = 30  # seconds before a failed calculation is retried
+
+STATUS_PENDING = "pending"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+def _compute(board_raw, userids, pot, ranges_raw):
+    """
+    Runs in a worker process. Everything passed in and out is plain data.
+    """
+    return all_combos_ev(board=Card.many_from_text(board_raw),
+                         userids=userids,
+                         pot=pot,
+                         all_ranges={userid: HandRange(range_raw)
+                                     for userid, range_raw
+                                     in ranges_raw.iteritems()})
+
+class ShowdownEVService(object):
+    """
+    Bounded pool of workers calculating all_combos_ev, keyed by (gameid, order)
+    """
+    def __init__(self, pool_size=POOL_SIZE, timeout=JOB_TIMEOUT,
+                 cache_size=CACHE_SIZE, function=_compute,
+                 failure_expiry=FAILURE_EXPIRY):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.function = function
+        self.failure_expiry = failure_expiry
+        self._pool = None  # created on first use, not at import
+        self._lock = threading.Lock()
+        # Only as many jobs as there are workers are submitted to the pool, so
+        # that a job's time running is measured from when it was submitted.
+        self._waiting = OrderedDict()  # key -> args, not yet submitted
+        self._jobs = {}  # key -> (AsyncResult, time submitted, args)
+        self._cache = OrderedDict()  # key -> (status, result)
+        self._failures = {}  # key -> time failed
+
+    def _get_pool(self):
+        """
+        Lazily create the process pool. Caller must hold the lock.
+        """
+        if self._pool is None:
+            self._pool = Pool(self.pool_size)
+        return self._pool
+
+    def _restart_pool(self):
+        """
+        Replace the pool, to free workers still busy with timed out jobs, and
+        queue the jobs that were running on it again. Caller must hold the
+        lock.
+        """
+        self._pool.terminate()
+        self._pool = None
+        requeued = [(key, args) for key, (_, _, args) in self._jobs.items()]
+        self._waiting = OrderedDict(requeued + self._waiting.items())
+        self._jobs = {}
+
+    def _fail(self, key):
+        """
+        Remember, for a short time, that a job failed. Caller must hold the
+        lock.
+        """
+        now = time.time()
+        for other, failed in self._failures.items():
+            if now - failed >= self.failure_expiry:
+                del self._failures[other]
+        self._failures[key] = now
+
+    def _store(self, key, status, result):
+        """
+        Cache a finished job, evicting the oldest. Caller must hold the lock.
+        """
+        self._cache.pop(key, None)
+        self._cache[key] = (status, result)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _check(self, key):
+        """
+        Move a job to the cache if it has finished or timed out. Caller must
+        hold the lock.
+        """
+        async_result, submitted, _args = self._jobs[key]
+        if async_result.ready():
+            del self._jobs[key]
+            if async_result.successful():
+                self._store(key, STATUS_DONE, async_result.get())
+            else:
+                try:
+                    async_result.get()
+                except Exception:  # pylint:disable=broad-except
+                    logging.exception("showdown EV for %r failed", key)
+                self._fail(key)
+        elif time.time() - submitted > self.timeout:
+            # We can't kill a single pool worker, so we replace the pool.
+            logging.warning("showdown EV for %r timed out after %d seconds",
+                            key, self.timeout)
+            del self._jobs[key]
+            self._fail(key)
+            self._restart_pool()
+
+    def _update(self):
+        """
+        Check running jobs, and submit waiting jobs to any free workers. Caller
+        must hold the lock.
+        """
+        for key in self._jobs.keys():
+            if key in self._jobs:  # not requeued by a restart
+                self._check(key)
+        while self._waiting and len(self._jobs) < self.pool_size:
+            key, args = self._waiting.popitem(last=False)
+            async_result = self._get_pool().apply_async(self.function, args)
+            self._jobs[key] = (async_result, time.time(), args)
+
+    def _failed(self, key):
+        """
+        Did the job for key fail recently? Caller must hold the lock.
+        """
+        return key in self._failures and  \
+            time.time() - self._failures[key] < self.failure_expiry
+
+    def status(self, key):
+        """
+        Returns (status, result) for key, or (None, None) if unknown.
+        """
+        with self._lock:
+            self._update()
+            if key in self._jobs or key in self._waiting:
+                return STATUS_PENDING, None
+            if self._failed(key):
+                return STATUS_FAILED, None
+            return self._cache.get(key, (None, None))
+
+    def request(self, key, *args):
+        """
+        Returns (status, result) for key, submitting a job (with args) to the
+        pool if there is no cached result, no recent failure, and none already
+        in progress.
+        """
+        with self._lock:
+            self._update()
+            if key in self._jobs or key in self._waiting:
+                return STATUS_PENDING, None
+            if key in self._cache:
+                return self._cache[key]
+            if self._failed(key):
+                return STATUS_FAILED, None
+            self._failures.pop(key, None)
+            self._waiting[key] = args
+            self._update()
+            return STATUS_PENDING, None
+
+SHOWDOWN_EV = ShowdownEVService()
+
+def _double(value):
+    """ For testing """
+    return value * 2
+
+def _fail(value):
+    """ For testing """
+    raise ValueError(value)
+
+def _sleep(seconds):
+    """ For testing """
+    time.sleep(seconds)
+    return seconds
+
+class Test(unittest.TestCase):
+    """ Tests for ShowdownEVService """
+    def _wait(self, service, key):
+        for _ in range(200):
+            status, result = service.status(key)
+            if status != STATUS_PENDING:
+                return status, result
+            time.sleep(0.05)
+        self.fail("job did not finish")
+
+    def test_request_and_cache(self):
+        service = ShowdownEVService(pool_size=1, function=_double)
+        self.assertEqual(service.status((1, 2)), (None, None))
+        self.assertEqual(service.request((1, 2), 21), (STATUS_PENDING, None))
+        # duplicate request doesn't submit another job
+        self.assertEqual(service.request((1, 2), 21), (STATUS_PENDING, None))
+        self.assertEqual(len(service._jobs), 1)  # pylint:disable=W0212
+        self.assertEqual(self._wait(service, (1, 2)), (STATUS_DONE, 42))
+        self.assertEqual(service.request((1, 2), 21), (STATUS_DONE, 42))
+
+    def test_failure(self):
+        service = ShowdownEVService(pool_size=1, function=_fail,
+                                    failure_expiry=1)
+        service.request((1, 2), 21)
+        self.assertEqual(self._wait(service, (1, 2)), (STATUS_FAILED, None))
+        self.assertEqual(service.request((1, 2), 21), (STATUS_FAILED, None))
+        # once the failure has expired, the job is retried
+        time.sleep(1)
+        self.assertEqual(service.request((1, 2), 21), (STATUS_PENDING, None))
+        self.assertEqual(self._wait(service, (1, 2)), (STATUS_FAILED, None))
+
+    def test_timeout(self):
+        service = ShowdownEVService(pool_size=1, timeout=1, function=_sleep)
+        service.request((1, 1), 60)
+        # queued behind the slow job, which doesn't count against its timeout
+        service.request((1, 2), 0.5)
+        self.assertEqual(self._wait(service, (1, 1)), (STATUS_FAILED, None))
+        self.assertEqual(self._wait(service, (1, 2)), (STATUS_DONE, 0.5))
+
+    def test_cache_size(self):
+        service = ShowdownEVService(pool_size=1, cache_size=1,
+                                    function=_double)
+        service.request((1, 1), 1)
+        self._wait(service, (1, 1))
+        service.request((1, 2), 2)
+        self._wait(service, (1, 2))
+        self.assertEqual(service.status((1, 1)), (None, None))
+        self.assertEqual(service.status((1, 2)), (STATUS_DONE, 4))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -40,7 +40,8 @@ from rvr.db.tables import User, SituationPlayer, Situation, OpenGame, \
     GameHistoryUserRange, GameHistoryBase, GameHistoryTimeout,\
     AnalysisFoldEquity, AnalysisFoldEquityItem, GameHistoryChat,\
     GameHistoryShowdown, GameHistoryShowdownEquity, PaymentToPlayer,\
-    RunningGameParticipantResult, UserComboOrderEV, UserComboGameEV
+    RunningGameParticipantResult, UserComboOrderEV, UserComboGameEV,\
+    ShowdownComboEV
 from rvr.db.creation import SESSION
 import logging
 from rvr.poker.cards import FINISHED
@@ -69,7 +70,8 @@ dumpable_tables = [
     AnalysisFoldEquity,
     AnalysisFoldEquityItem,
     UserComboGameEV,
-    UserComboOrderEV]
+    UserComboOrderEV,
+    ShowdownComboEV]
 
 def read_users(session):
     """ Read User table from DB into memory """
@@ -220,15 +222,22 @@ def read_running_games(session):
              rg.analysis_performed,
              rg.spawn_factor,
              rg.spawn_group,
-             rg.spawn_finished)
+             rg.spawn_finished,
+             rg.parent_gameid,
+             rg.fork_order)
             for rg in rgs]
 
 def write_running_games(session, rgs):
     """ Write RunningGame from memory into DB """
-    for gameid, situationid, public_ranges, current_userid, next_hh,  \
+    for row in rgs:
+        if len(row) == 17:
+            # older dumps, where spawned games have a full copy of history
+            row = row + (None, None)
+        gameid, situationid, public_ranges, current_userid, next_hh,  \
             board_raw, total_board_raw, current_round, pot_pre, increment,  \
             bet_count, current_factor, last_action_time, analysis_performed,  \
-            spawn_factor, spawn_group, spawn_finished in rgs:
+            spawn_factor, spawn_group, spawn_finished, parent_gameid,  \
+            fork_order = row
         rg = RunningGame()
         session.add(rg)
         rg.gameid = gameid
@@ -248,6 +257,8 @@ def write_running_games(session, rgs):
         rg.spawn_factor = spawn_factor
         rg.spawn_group = spawn_group
         rg.spawn_finished = spawn_finished
+        rg.parent_gameid = parent_gameid
+        rg.fork_order = fork_order
         session.commit()
 
 def read_running_game_participants(session):
@@ -647,6 +658,28 @@ def write_user_combo_order_ev(session, ucoes):
         ucoe.ev = ev
         session.commit()
 
+def read_showdown_combo_ev(session):
+    """ Read ShowdownComboEV table from DB into memory """
+    sces = session.query(ShowdownComboEV).all()
+    return [(sce.gameid,
+             sce.order,
+             sce.userid,
+             sce.combo,
+             sce.ev)
+            for sce in sces]
+
+def write_showdown_combo_ev(session, sces):
+    """ Write ShowdownComboEV table from memory into DB """
+    for gameid, order, userid, combo, ev in sces:
+        sce = ShowdownComboEV()
+        session.add(sce)
+        sce.gameid = gameid
+        sce.order = order
+        sce.userid = userid
+        sce.combo = combo
+        sce.ev = ev
+        session.commit()
+
 TABLE_READERS = {User: read_users,
                  Situation: read_situations,
                  SituationPlayer: read_situation_players,
@@ -668,7 +701,8 @@ TABLE_READERS = {User: read_users,
                  AnalysisFoldEquity: read_analysis_fold_equities,
                  AnalysisFoldEquityItem: read_analysis_fold_equity_items,
                  UserComboGameEV: read_user_combo_game_ev,
-                 UserComboOrderEV: read_user_combo_order_ev}
+                 UserComboOrderEV: read_user_combo_order_ev,
+                 ShowdownComboEV: read_showdown_combo_ev}
 
 TABLE_WRITERS = {User: write_users,
                  Situation: write_situations,
@@ -691,7 +725,8 @@ TABLE_WRITERS = {User: write_users,
                  AnalysisFoldEquity: write_analysis_fold_equities,
                  AnalysisFoldEquityItem: write_analysis_fold_equity_items,
                  UserComboGameEV: write_user_combo_game_ev,
-                 UserComboOrderEV: write_user_combo_order_ev}
+                 UserComboOrderEV: write_user_combo_order_ev,
+                 ShowdownComboEV: write_showdown_combo_ev}
 
 def read_db():
     """ Read all tables from DB into memory """
@@ -2,9 +2,10 @@
 Declares database tables
 """
 from sqlalchemy import Column, Integer, String, Boolean, Sequence, ForeignKey
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import relationship, backref
 from rvr.db.creation import BASE
-from sqlalchemy.types import Float, DateTime
+from sqlalchemy.types import Float, DateTime, LargeBinary
 from rvr.poker.cards import Card, FINISHED, RIVER
 from rvr.poker.handrange import HandRange, unweighted_options_to_description
 from sqlalchemy.orm.session import object_session
@@ -18,6 +19,7 @@ from sqlalchemy.orm.exc import NoResultFound
 
 MAX_CHAT = 10000
 MAX_RANGE_LENGTH = 6629
+MAX_CHECKPOINT = 2 ** 24 - 1  # bytes; a MEDIUMBLOB on MySQL
 
 class User(BASE, object):
     """
@@ -113,6 +115,10 @@ class SituationPlayer(BASE, object):
     left_to_act = Column(Boolean, nullable=False)
     average_result = Column(Float, nullable=True)
     stddev = Column(Float, nullable=True)
+    # for updating average_result and stddev online (Welford's algorithm):
+    # number of results, and sum of squared differences from the mean
+    result_count = Column(Integer, nullable=True)
+    result_m2 = Column(Float, nullable=True)
 
     situation = relationship("Situation", primaryjoin=  \
         "Situation.situationid==SituationPlayer.situationid",
@@ -175,6 +181,69 @@ class UserSituationPlayer(BASE, object):
             return 1.0 * self.amount_won / self.hands_played
     ev = property(get_ev)
 
+class UserPositionResult(BASE, object):
+    """
+    Rollup of the same user's results in the same seat, under one result scheme,
+    over every spawn group they've completed: how many groups, the total result
+    and the total of the squared results. Maintained as spawn groups' analysis
+    completes (see rvr.analysis.statistics).
+    """
+    __tablename__ = 'user_position_result'
+    userid = Column(Integer, ForeignKey("user.userid"), primary_key=True)
+    situationid = Column(Integer, primary_key=True)
+    order = Column(Integer, primary_key=True)
+    public_ranges = Column(Boolean, primary_key=True)
+    scheme = Column(String(6), primary_key=True)
+    __table_args__ = (
+        ForeignKeyConstraint([situationid, order],
+            [SituationPlayer.situationid, SituationPlayer.order]),
+        {})
+
+    groups = Column(Integer, nullable=False)
+    total = Column(Float, nullable=False)
+    total_squares = Column(Float, nullable=False)
+
+class SpawnGroupRollup(BASE):
+    """
+    A spawn group whose results are included in UserPositionResult.
+    """
+    __tablename__ = 'spawn_group_rollup'
+    spawn_group = Column(Integer, ForeignKey("running_game.gameid"),
+                         primary_key=True)
+
+class CachedLeaderboardEntry(BASE):
+    """
+    An entry in the top of the leaderboard for a seat in a situation, in one
+    mode: a copy of the user's UserSituationPlayer, and their screenname, kept
+    up to date by rvr.analysis.leaderboards.
+    """
+    __tablename__ = 'cached_leaderboard_entry'
+    situationid = Column(Integer, primary_key=True)
+    order = Column(Integer, primary_key=True)
+    public_ranges = Column(Boolean, primary_key=True)
+    rank = Column(Integer, primary_key=True, autoincrement=False)
+    __table_args__ = (
+        ForeignKeyConstraint([situationid, order],
+            [SituationPlayer.situationid, SituationPlayer.order]),
+        {})
+    userid = Column(Integer, ForeignKey("user.userid"), nullable=False,
+                    index=True)
+    screenname = Column(String(20), nullable=False)
+    amount_won = Column(Float, nullable=True)
+    redline = Column(Float, nullable=True)
+    blueline = Column(Float, nullable=True)
+    hands_played = Column(Integer, nullable=False)
+    confidence = Column(Float, nullable=False)
+
+class GlobalStatisticsGame(BASE):
+    """
+    A game whose results are included in SituationPlayer.average_result and
+    stddev.
+    """
+    __tablename__ = 'global_statistics_game'
+    gameid = Column(Integer, ForeignKey("running_game.gameid"),
+                    primary_key=True)
+
 class OpenGame(BASE):
     """
     Details of an open game, not yet full of registered participants.
@@ -247,8 +316,15 @@ class RunningGame(BASE, object):
     # starts at 1.0, reduces when spawned
     # across all games with this spawn_group, this will sum to 1.0
     spawn_factor = Column(Float, nullable=False)
+    # game this was spawned from (directly), and its next_hh at the time
+    # history before fork_order is shared with the parent, not copied
+    parent_gameid = Column(Integer, ForeignKey("running_game.gameid"),
+                           nullable=True)
+    fork_order = Column(Integer, nullable=True)
 
-    spawn_root = relationship("RunningGame")
+    spawn_root = relationship("RunningGame", foreign_keys=[spawn_group])
+    parent = relationship("RunningGame", foreign_keys=[parent_gameid],
+                          remote_side=[gameid])
 
     def copy(self):
         """
@@ -273,6 +349,28 @@ class RunningGame(BASE, object):
         game.spawn_factor = self.spawn_factor
         return game
 
+    def history_sources(self):
+        """
+        Returns list of (gameid, end_order) making up this game's history, i.e.
+        this game's own rows, then its parent's rows before the fork, and so on
+        up the chain. end_order is None for this game's own rows.
+        """
+        sources = [(self.gameid, None)]
+        game = self
+        while game.parent_gameid is not None:
+            sources.append((game.parent_gameid, game.fork_order))
+            game = game.parent
+        return sources
+
+    def history_filter(self, table):
+        """
+        Filter clause selecting this game's rows from a game history table
+        (including rows shared with ancestors).
+        """
+        return or_(*[table.gameid == gameid if end_order is None else
+                     and_(table.gameid == gameid, table.order < end_order)
+                     for gameid, end_order in self.history_sources()])
+
     # Attributes
 
     def get_is_auto_spawn(self):
@@ -740,15 +838,15 @@ class PaymentToPlayer(BASE):
     A single player's part of a payment for something.
     """
     __tablename__ = 'payment_to_player'
-    gameid = Column(Integer,
+    # Not a foreign key to GameHistoryBase, because for spawned games, order
+    # may refer to history shared with (and stored against) an ancestor game.
+    gameid = Column(Integer, ForeignKey("running_game.gameid"),
                     primary_key=True)
     order = Column(Integer, primary_key=True)
     userid = Column(Integer, ForeignKey("user.userid"),
                     primary_key=True)
     reason = Column(String(20), primary_key=True)
     amount = Column(Float, nullable=False)
-    history_base = relationship("GameHistoryBase",
-        backref=backref("payments_to_players", cascade="all"))
     user = relationship("User")
     # Putting chips in the pot
     REASON_POT = 'pot'
@@ -767,11 +865,6 @@ class PaymentToPlayer(BASE):
     REASON_BLUELINE = 'blueline'  # negative, contribution to showdown
     REASON_REDLINE = 'redline'  # positive, contribution to showdown
 
-    __table_args__ = (
-        ForeignKeyConstraint([gameid, order],
-                             [GameHistoryBase.gameid, GameHistoryBase.order]),
-        {})
-
 class RunningGameParticipantResult(BASE):
     """
     Result for a user in a game, under a result scheme
@@ -855,12 +948,6 @@ class UserComboOrderEV(BASE):
     ev = Column(Float, nullable=False)
     user = relationship("User")
 
-    __table_args__ = (
-        # has to be a valid gameid + order
-        ForeignKeyConstraint([gameid, order],
-                             [GameHistoryBase.gameid, GameHistoryBase.order]),
-        {})
-
 class UserComboGameEV(BASE):
     __tablename__ = "user_combo_game_ev"
     userid = Column(Integer, ForeignKey("user.userid"), primary_key=True)
@@ -870,16 +957,31 @@ class UserComboGameEV(BASE):
     ev = Column(Float, nullable=False)
     user = relationship("User")
 
+class ShowdownComboEV(BASE):
+    """
+    EV of each combo a player could have had at a showdown. Written by the
+    analysis, so that the showdown page doesn't have to calculate it.
+    """
+    __tablename__ = "showdown_combo_ev"
+    gameid = Column(Integer, ForeignKey("running_game.gameid"),
+                    primary_key=True)
+    order = Column(Integer, primary_key=True)
+    userid = Column(Integer, ForeignKey("user.userid"), primary_key=True)
+    combo = Column(String(4), primary_key=True)
+    ev = Column(Float, nullable=False)
+    user = relationship("User")
+
 class AnalysisFoldEquity(BASE):
     """
     Profitability, or required semibluff EV, of a bet, on any street.
     """
     __tablename__ = "analysis_fold_equity"
     # Keys
-    gameid = Column(Integer, primary_key=True)
+    # The action result is found via the game's history, because for spawned
+    # games it may be stored against an ancestor game.
+    gameid = Column(Integer, ForeignKey("running_game.gameid"),
+                    primary_key=True)
     order = Column(Integer, primary_key=True)
-    # Relationships
-    action_result = relationship("GameHistoryActionResult")
     # Relevant columns
     street = Column(String(7), nullable=False)
     pot_before_bet = Column(Integer, nullable=False)
@@ -889,11 +991,6 @@ class AnalysisFoldEquity(BASE):
     raise_total = Column(Integer, nullable=False)
     pot_if_called = Column(Integer, nullable=False)
 
-    __table_args__ = (
-        ForeignKeyConstraint([gameid, order],
-            [GameHistoryActionResult.gameid, GameHistoryActionResult.order]),
-        {})
-
 class AnalysisFoldEquityItem(BASE):
     """
     Individual combo in the analysis of fold equity in a spot.
@@ -927,6 +1024,127 @@ class AnalysisFoldEquityItem(BASE):
             [RangeItem.higher_card, RangeItem.lower_card]),
         {})
 
+class AnalysisJob(BASE):
+    """
+    A queued request to analyse a game, worked by the analysis workers.
+
+    A worker claims a job by taking a lease on it, and extends the lease while
+    it works (heartbeat). A job whose lease expires is available to be claimed
+    again, because its worker has presumably died.
+    """
+    __tablename__ = "analysis_job"
+    jobid = Column(Integer, Sequence('jobid_seq'), primary_key=True)
+    gameid = Column(Integer, ForeignKey("running_game.gameid"),
+                    nullable=False, index=True)
+    status = Column(String(8), nullable=False, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    # not to be claimed before this time (retry backoff)
+    available_time = Column(DateTime, nullable=False, index=True)
+    # lease details
+    worker = Column(String(60), nullable=True)
+    lease_expires = Column(DateTime, nullable=True)
+    heartbeat_time = Column(DateTime, nullable=True)
+    # timing
+    created_time = Column(DateTime, nullable=False)
+    started_time = Column(DateTime, nullable=True)
+    finished_time = Column(DateTime, nullable=True)
+    duration = Column(Float, nullable=True)  # seconds, of the last attempt
+    error = Column(String(200), nullable=True)
+    game = relationship("RunningGame")
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+class AnalysisProfile(BASE):
+    """
+    Where the time went, analysing a game: for each phase of the analysis, time
+    and counters, added up over every time the game's analysis advanced.
+
+    A phase's time includes phases nested in it. Counters belong to the
+    innermost phase.
+    """
+    __tablename__ = "analysis_profile"
+    gameid = Column(Integer, ForeignKey("running_game.gameid"),
+                    primary_key=True)
+    phase = Column(String(30), primary_key=True)
+    calls = Column(Integer, nullable=False)
+    seconds = Column(Float, nullable=False)
+    equity_calls = Column(Integer, nullable=False)
+    iterations = Column(Integer, nullable=False)
+    combos = Column(Integer, nullable=False)
+    rows = Column(Integer, nullable=False)
+    game = relationship("RunningGame")
+
+class ReanalysisShard(BASE):
+    """
+    A range of game ids to be reanalysed, as part of a bulk reanalysis run.
+
+    A worker claims a shard by taking a lease on it, the same as an AnalysisJob,
+    and reanalyses its games in order. Each game's new analysis is swapped in,
+    in one transaction, along with the shard's progress (last_gameid), so a
+    shard whose worker dies continues from there when it is claimed again.
+    """
+    __tablename__ = "reanalysis_shard"
+    shardid = Column(Integer, Sequence('shardid_seq'), primary_key=True)
+    runid = Column(Integer, nullable=False, index=True)
+    min_gameid = Column(Integer, nullable=False)  # inclusive
+    max_gameid = Column(Integer, nullable=False)  # inclusive
+    status = Column(String(8), nullable=False, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    # reanalyse games even if their analysis inputs haven't changed
+    force = Column(Boolean, nullable=False, default=False)
+    # progress
+    last_gameid = Column(Integer, nullable=True)  # last game swapped in
+    games_total = Column(Integer, nullable=False)
+    games_done = Column(Integer, nullable=False, default=0)
+    # lease details
+    worker = Column(String(60), nullable=True)
+    lease_expires = Column(DateTime, nullable=True)
+    # timing
+    created_time = Column(DateTime, nullable=False)
+    started_time = Column(DateTime, nullable=True)  # first claimed
+    updated_time = Column(DateTime, nullable=True)
+    finished_time = Column(DateTime, nullable=True)
+    error = Column(String(200), nullable=True)
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+class AnalysisCheckpoint(BASE):
+    """
+    The state of the analysis of a game, as of the last history item processed,
+    so that analysis continues from here as the game is played, rather than
+    replaying the whole game when it finishes.
+
+    The state is a compressed pickle of the AnalysisReplayer's accumulators.
+    Payments and showdown analysis created up to this point are committed along
+    with it.
+    """
+    __tablename__ = "analysis_checkpoint"
+    gameid = Column(Integer, ForeignKey("running_game.gameid"),
+                    primary_key=True)
+    order = Column(Integer, nullable=False)  # of the last item processed
+    state = Column(LargeBinary(MAX_CHECKPOINT), nullable=False)
+    updated_time = Column(DateTime, nullable=False)
+    game = relationship("RunningGame")
+
+class AnalysisInputHash(BASE):
+    """
+    Hash of everything a game's analysis was calculated from: its situation,
+    its history, the versions of the parts of the analysis engine it used, and
+    the random seed. If the hash is still the same, reanalysing the game would
+    give the same results, so reanalysis skips it.
+    """
+    __tablename__ = "analysis_input_hash"
+    gameid = Column(Integer, ForeignKey("running_game.gameid"),
+                    primary_key=True)
+    input_hash = Column(String(40), nullable=False)  # SHA-1, hex
+    game = relationship("RunningGame")
+
 # class AnalysisFloat(BASE):
 #     """
 #     Profitability of a call with the intention of betting later, on any street
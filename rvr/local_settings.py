@@ -0,0 +1,7 @@
+SQLALCHEMY_DATABASE_URI = 'sqlite://'
+SUPPRESSED_GAME_MAX = 0
+SUPPRESSED_SITUATIONS = []
+ALLOW_BACKDOOR = False
+SUPPRESS_EMAIL = True
+SERVER_NAME_ = 'localhost'
+OIDC_CLIENT_SECRETS = '/tmp/client_secrets.json'
@@ -4,7 +4,8 @@ action functionality, imported from the previous versions
 from rvr.poker.cards import Card, FLOP, PREFLOP, RIVER, TURN
 import unittest
 from rvr.poker.handrange import HandRange, _cmp_options, deal_from_ranges,\
-    NOTHING
+    NOTHING, options_to_bitset, bitset_to_options,  \
+    unweighted_options_to_description, _card_index
 from rvr.infrastructure.util import concatenate
 from rvr.core.dtos import ActionOptions, ActionDetails, ActionResult
 from collections import namedtuple
@@ -22,55 +23,54 @@ def _option_to_text(option):
     """
     return "".join([o.to_mnemonic() for o in sorted(option, reverse=True)])
 
+def range_partition_errors(fold_range, passive_range, aggressive_range,
+                           original_range):
+    """
+    Compare the action ranges to the original range, as bitsets of combos.
+
+    Returns three lists of options: hands in more than one action range, hands
+    in the original range but not in any action range, and hands in action
+    ranges but not in the original range.
+    """
+    fol, pas, agg = [options_to_bitset(r.generate_options())
+                     for r in [fold_range, passive_range, aggressive_range]]
+    ori = options_to_bitset(original_range.generate_options())
+    union = fol | pas | agg
+    multiple = (fol & pas) | (fol & agg) | (pas & agg)
+    return (bitset_to_options(multiple),
+            bitset_to_options(ori & ~union),
+            bitset_to_options(union & ~ori))
+
+def _options_to_text(options):
+    """
+    options is a non-empty list of options
+    return something like "AdAc" for one hand, or "AA,KK" for several
+    """
+    if len(options) == 1:
+        return _option_to_text(options[0])
+    return unweighted_options_to_description(options)
+
 def range_sum_equal(fold_range, passive_range, aggressive_range,
                     original_range):
     """
     Returns validity (boolean), and reason (string, or None if valid)
+
+    The reason describes every problem hand, not just the first.
     """
-    # pylint:disable=R0914
-    all_ranges = [fold_range, passive_range, aggressive_range]
-    original_hand_options = original_range.generate_options()
-    all_ranges_hand_options = concatenate([r.generate_options()
-                                           for r in all_ranges])
-    original_hand_options.sort(cmp=_cmp_options)
-    all_ranges_hand_options.sort(cmp=_cmp_options)
-    prev = None
-    # pylint:disable=W0141
-    for ori, new in map(None, original_hand_options, all_ranges_hand_options):
-        # we compare two hands, each of which is a set of two Card
-        if ori != new:
-            # actually three scenarios:
-            # hand is in multiple action ranges
-            # (new is the same as the previous new)
-            # hand is in action ranges but not original range
-            # (new < ori means new is not in original range)
-            # hand is in original range but not action ranges
-            # (new > ori means ori is not in action ranges)
-            if new is None:
-                message =  \
-                    "hand in original range but not in action ranges: %s" %  \
-                    _option_to_text(ori)
-            elif ori is None:
-                message =  \
-                    "hand in action ranges but not in original range: %s" %  \
-                    _option_to_text(new)
-            else:
-                if new == prev:
-                    message = "hand in multiple ranges: %s" %  \
-                        _option_to_text(new)
-                elif _cmp_options(new, ori) > 0:
-                    message = "hand in original range but not in " +  \
-                        "action ranges: %s" % _option_to_text(ori)
-                elif _cmp_options(new, ori) < 0:
-                    message = "hand in action ranges but not in " +  \
-                        "original range: %s" % _option_to_text(new)
-                else:
-                    raise RuntimeError("hands not equal, but can't " +  \
-                                       "figure out why: %s, %s" % \
-                                       (_option_to_text(ori),
-                                        _option_to_text(new)))
-            return False, message
-        prev = new
+    multiple, missing, extra = range_partition_errors(
+        fold_range, passive_range, aggressive_range, original_range)
+    messages = []
+    for options, text in [(multiple, "in multiple ranges"),
+                          (missing,
+                           "in original range but not in action ranges"),
+                          (extra,
+                           "in action ranges but not in original range")]:
+        if options:
+            messages.append("%s %s: %s" % (
+                "hand" if len(options) == 1 else "hands", text,
+                _options_to_text(options)))
+    if messages:
+        return False, "; ".join(messages)
     return True, None
 
 def range_action_fits(range_action, options, original_range):
@@ -91,13 +91,10 @@ def range_action_fits(range_action, options, original_range):
     passive_range = range_action.passive_range
     aggressive_range = range_action.aggressive_range
     raise_total = range_action.raise_total
-    try:
-        valid, reason = range_sum_equal(fold_range,
-                                        passive_range,
-                                        aggressive_range,
-                                        original_range)
-    except RuntimeError as err:
-        return False, err.message
+    valid, reason = range_sum_equal(fold_range,
+                                    passive_range,
+                                    aggressive_range,
+                                    original_range)
     if not valid:
         return False, reason
     # we require that if there is a raise range, there is a raise size
@@ -152,6 +149,71 @@ def generate_excluded_cards(game, exclude=None):
     excluded_cards.extend(board)
     return excluded_cards
 
+def _range_matrix(range_, board):
+    """
+    52x52 symmetric matrix, where element [c, d] counts the options in range_
+    (excluding board) made of the cards with mask indices c and d
+    """
+    matrix = numpy.zeros((52, 52))
+    for option in range_.generate_options(board):
+        first, second = [_card_index(card) for card in option]
+        matrix[first, second] += 1
+        matrix[second, first] += 1
+    return matrix
+
+def _compatible_pairs(hero, villain):
+    """
+    number of pairs of options, one from each range matrix, sharing no cards
+    """
+    # All pairs, less those sharing a card. Identical options share two cards,
+    # and so are subtracted twice, and need to be added back once.
+    return hero.sum() * villain.sum() / 4.0  \
+        - hero.sum(axis=1).dot(villain.sum(axis=1))  \
+        + (hero * villain).sum() / 2.0
+
+def _compatible_pairs_without(hero, villain):
+    """
+    52x52 matrix, where element [a, b] is the number of pairs of options, one
+    from each range matrix, sharing no cards, and not containing card a or b
+
+    That is, _compatible_pairs() for every possible third option {a, b}, all at
+    once.
+    """
+    # pylint:disable=E1101
+    hrs = hero.sum(axis=1)  # hero's options containing each card
+    vrs = villain.sum(axis=1)
+    # range sizes once cards a and b are removed
+    hero_size = hero.sum() / 2.0 - hrs[:, None] - hrs[None, :] + hero
+    villain_size = villain.sum() / 2.0 - vrs[:, None] - vrs[None, :]  \
+        + villain
+    # identical options once cards a and b are removed
+    common = hero * villain
+    crs = common.sum(axis=1)
+    identical = common.sum() / 2.0 - crs[:, None] - crs[None, :] + common
+    # sum over cards c of hero's options containing c times villain's options
+    # containing c, once cards a and b are removed
+    h_v = villain.dot(hrs)
+    v_h = hero.dot(vrs)
+    gram = hero.T.dot(villain)
+    diag = numpy.diag(gram)
+    shared = hrs.dot(vrs)  \
+        - h_v[:, None] - h_v[None, :] - v_h[:, None] - v_h[None, :]  \
+        + diag[:, None] + diag[None, :] + gram + gram.T
+    # ... but c can't be a or b
+    shared -= (hrs[:, None] - hero) * (vrs[:, None] - villain)  \
+        + (hrs[None, :] - hero) * (vrs[None, :] - villain)
+    return hero_size * villain_size - shared + identical
+
+def _compatible_triples(hero, villain1, villain2):
+    """
+    number of triples of options, one from each range matrix, sharing no cards
+
+    For each possible option {a, b} of villain1, this counts the compatible
+    pairs of hero and villain2 per _compatible_pairs_without().
+    """
+    compatible = _compatible_pairs_without(hero, villain2)
+    return (villain1 * compatible).sum() / 2.0
+
 def calculate_current_options(game, rgp):
     """
     Determines what options the current player has in a running game.
@@ -332,6 +394,35 @@ class WhatCouldBe(object):
             1.0 * passive / total,  \
             1.0 * aggressive / total
 
+    def exact_weights(self):
+        """
+        Calculate weights exactly, by considering all combos of each player
+        multiplied by each other, and counting the possibilities that fall in
+        each of Hero's fold, passive and aggressive ranges.
+
+        This is only implemented for up to two other players. Returns None if
+        there are more, or if no deal is possible.
+        """
+        others = [rgp for rgp in self.game.rgps if rgp is not self.rgp]
+        if not 1 <= len(others) <= 2:
+            return None
+        board = self.game.total_board or self.game.board
+        villains = [_range_matrix(rgp.range, board) for rgp in others]
+        counts = []
+        for range_ in [self.range_action.fold_range,
+                       self.range_action.passive_range,
+                       self.range_action.aggressive_range]:
+            hero = _range_matrix(range_, board)
+            if len(villains) == 1:
+                counts.append(_compatible_pairs(hero, villains[0]))
+            else:
+                counts.append(_compatible_triples(hero, villains[0],
+                                                  villains[1]))
+        total = sum(counts)
+        if total <= 0.0:
+            return None
+        return counts[0] / total, counts[1] / total, counts[2] / total
+
     def calculate_weights(self):
         """
         Answers the question "Given player X continues with subrange A of
@@ -344,7 +435,17 @@ class WhatCouldBe(object):
         each player multiplied by each other, then count the possibilities that
         fall in each of Hero's fold, passive and aggressive ranges.
 
-        This estimates it through random sampling a few times instead.
+        For up to three players, exact_weights() does that, quickly.
+        """
+        weights = self.exact_weights()
+        if weights is not None:
+            return weights
+        return self.estimate_weights()
+
+    def estimate_weights(self):
+        """
+        Estimate weights through random sampling a few times, per
+        sample_weights().
         """
         # after much consideration, this is the best, most practical way:
         # - deal a hand (all players)
@@ -561,20 +662,37 @@ class Test(unittest.TestCase):
         val, rsn = range_action_fits(range_action, options, range_original)
         self.assertFalse(val)
         self.assertEqual(rsn,
-            "hand in original range but not in action ranges: AdAc")
+            "hands in original range but not in action ranges: AA")
 
         # invalid, KK in action but not original
         range_action = ActionDetails(range_72o, range_aa_22, range_kk, 2)
         val, rsn = range_action_fits(range_action, options, range_original)
         self.assertFalse(val)
         self.assertEqual(rsn,
-            "hand in action ranges but not in original range: KdKc")
+            "hands in action ranges but not in original range: KK")
 
         # invalid, AA in multiple ranges
         range_action = ActionDetails(range_72o, range_aa_22, range_aa, 2)
         val, rsn = range_action_fits(range_action, options, range_original)
         self.assertFalse(val)
-        self.assertEqual(rsn, "hand in multiple ranges: AdAc")
+        self.assertEqual(rsn, "hands in multiple ranges: AA")
+
+        # invalid, every problem is reported
+        range_action = ActionDetails(range_aa_22, HandRange("22,KK"),
+                                     range_empty, 2)
+        val, rsn = range_action_fits(range_action, options, range_original)
+        self.assertFalse(val)
+        self.assertEqual(rsn, "hands in multiple ranges: 22; "
+            "hands in original range but not in action ranges: 72o; "
+            "hands in action ranges but not in original range: KK")
+
+        # invalid, one hand in action but not original
+        range_action = ActionDetails(range_72o, range_22,
+                                     HandRange("AA,KsKh"), 2)
+        val, rsn = range_action_fits(range_action, options, range_original)
+        self.assertFalse(val)
+        self.assertEqual(rsn,
+            "hand in action ranges but not in original range: KsKh")
 
         #options = [FoldOption(), CallOption(10), RaiseOption(20, 194)]
         options = ActionOptions(10, True, 20, 194)
@@ -627,7 +745,31 @@ class Test(unittest.TestCase):
         val, rsn = range_action_fits(range_action, options, range_original)
         self.assertFalse(val)
         self.assertEqual(rsn,
-            "hand in original range but not in action ranges: 2d2c")
+            "hands in original range but not in action ranges: 22,72o")
+
+    def test_compatible_triples(self):
+        """
+        Test _compatible_pairs and _compatible_triples against brute force
+        """
+        board = Card.many_from_text("AhKd2c")
+        ranges = [HandRange("AA,KK,AKs,QJ"),
+                  HandRange("AKo,QQ,AQs,JJ"),
+                  HandRange("KQ,AA,QJs")]
+        options = [r.generate_options(board) for r in ranges]
+        matrices = [_range_matrix(r, board) for r in ranges]
+        pairs = len([1 for a in options[0] for b in options[1]
+                     if not a.intersection(b)])
+        self.assertAlmostEqual(_compatible_pairs(matrices[0], matrices[1]),
+                               pairs)
+        triples = len([1 for a in options[0] for b in options[1]
+                       for c in options[2]
+                       if len(a.union(b).union(c)) == 6])
+        self.assertAlmostEqual(
+            _compatible_triples(matrices[0], matrices[1], matrices[2]),
+            triples)
+        self.assertAlmostEqual(
+            _compatible_triples(matrices[2], matrices[0], matrices[1]),
+            triples)
 
     def test_range_contains_hand(self):
         """
@@ -768,7 +910,7 @@ class Test(unittest.TestCase):
         # call is about 0.0559
         # (733 total combos of combos)
         # (equals 41 calls, 692 folds)
-        self.assertAlmostEqual(p, 41.0 / 733, 2)
+        self.assertAlmostEqual(p, 41.0 / 733)
         # also updates current_factor
         weighted_actions = wcb.calculate_what_will_be(False)
         self.assertFalse(weighted_actions)
@@ -779,4 +921,4 @@ class Test(unittest.TestCase):
 if __name__ == '__main__':
     # 9.7s 20130205 (client-server)
     # 9.0s 20140102 (web)
-    unittest.main()
+    unittest.main()
@@ -216,6 +216,16 @@ class Card(object):
     def __hash__(self):
         return hash(self.rank) ^ hash(self.suit)
 
+    def __reduce__(self):
+        # Ranks and suits compare by identity, so unpickle from the mnemonic
+        return (_unpickle_card, (self.to_mnemonic(),))
+
+def _unpickle_card(text):
+    """
+    Card from mnemonic, for pickle
+    """
+    return Card.from_text(text)
+
 def deal_card(excluded):
     """
     Warning! Dealt cards will be appended to excluded list!
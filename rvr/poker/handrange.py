@@ -4,8 +4,10 @@ range-specific functionality
 import re
 import random
 import logging
+import numpy
 from rvr.poker.cards import Card, RANK_MAP, SUIT_MAP, Rank,  \
-    RANK_INVERT, Suit, SPADES, ACE, RANKS_HIGH_TO_LOW, RANKS_LOW_TO_HIGH
+    RANK_INVERT, Suit, SPADES, ACE, RANKS_HIGH_TO_LOW, RANKS_LOW_TO_HIGH,  \
+    RANK_FOR_MASK, SUIT_FOR_MASK
 import unittest
 
 # pylint:disable=C0103
@@ -385,6 +387,39 @@ def _cmp_options(a, b):
     """
     return cmp(sorted(a), sorted(b))
 
+def _card_index(card):
+    """
+    position of card in a card mask (0 to 51), per Card.to_mask()
+    """
+    return 13 * SUIT_FOR_MASK[card.suit] + RANK_FOR_MASK[card.rank]
+
+def combo_index(option):
+    """
+    index of an unweighted option (set of two Card), from 0 to 1325
+    """
+    low, high = sorted([_card_index(card) for card in option])
+    return high * (high - 1) / 2 + low
+
+def options_to_bitset(options):
+    """
+    convert options to an integer with bit combo_index(option) set for each
+    """
+    bits = 0
+    for option in options:
+        bits |= 1 << combo_index(option)
+    return bits
+
+def bitset_to_options(bits):
+    """
+    convert a bitset from options_to_bitset() back into a list of options
+    """
+    options = []
+    while bits:
+        lowest = bits & -bits
+        options.append(ALL_COMBOS[lowest.bit_length() - 1])
+        bits ^= lowest
+    return options
+
 class HandRange(object):
     """
     Represents a hand range! (Texas Hold'em only.)
@@ -498,29 +533,86 @@ class IncompatibleRangesError(RuntimeError):
     """
     pass
 
+DEAL_BATCH = 100
+
 def deal_from_ranges(range_map, board):
     """
     takes a dict mapping arbitrary key to range
     return a dict mapping same keys to dealt hands from those ranges
     """
+    keys = range_map.keys()
+    indices = []
+    for key in keys:
+        options = range_map[key].generate_options(board)
+        if not options:
+            raise ValueError("No valid options to generate hand from")
+        indices.append(options_to_indices(options))
     count = 0
     while True:
-        result = {k: r.generate_hand(board) for k, r in range_map.iteritems()}
-        all_cards = [card for hand in result.values() for card in hand]
-        all_cards.extend(board)
-        if len(all_cards) == len(set(all_cards)):
+        dealt = deal_indices(indices, DEAL_BATCH, board)
+        if len(dealt):
+            result = {}
+            for key, index in zip(keys, dealt[0]):
+                hand = list(ALL_COMBOS[index])
+                random.shuffle(hand)
+                result[key] = hand
             return result
-        count += 1
+        count += DEAL_BATCH
         if count == 1000:
             logging.warning(
                 "deal apparently incompatible set of ranges: %r (board is %r)",
                 range_map, board)
-        if count > 10000:
+        if count >= 10000:
             raise IncompatibleRangesError(
                 "deal evidently incompatible set of ranges: %r (board is %r)" %
                 (range_map, board))
 
+def options_to_indices(options):
+    """
+    convert options to a numpy array of their combo indices
+    """
+    return numpy.array([combo_index(option) for option in options], dtype=int)
+
+def options_to_lookup(options):
+    """
+    convert options to a boolean numpy array, indexed by combo index
+    """
+    lookup = numpy.zeros(1326, dtype=bool)
+    if options:
+        lookup[options_to_indices(options)] = True
+    return lookup
+
+def deal_indices(indices_list, count, excluded=()):
+    """
+    Deal count joint deals at once, one combo from each numpy array of combo
+    indices in indices_list, and reject deals in which any cards collide (with
+    each other, or with excluded cards).
+
+    returns a 2D numpy array of combo indices, with one row per compatible
+    deal and one column per item in indices_list (so there may be fewer than
+    count rows)
+    """
+    # pylint:disable=E1101
+    used = numpy.zeros(count, dtype=numpy.uint64)
+    used |= numpy.uint64(sum(card.to_mask() for card in set(excluded)))
+    compatible = numpy.ones(count, dtype=bool)
+    columns = []
+    for indices in indices_list:
+        column = indices[numpy.random.randint(0, len(indices), count)]
+        masks = COMBO_MASKS[column]
+        compatible &= (masks & used) == 0
+        used |= masks
+        columns.append(column)
+    if not columns:
+        return numpy.zeros((count, 0), dtype=int)
+    return numpy.column_stack(columns)[compatible]
+
 SET_ANYTHING_OPTIONS = set(HandRange(ANYTHING).generate_options())
+# all options, indexed by combo_index()
+ALL_COMBOS = sorted(SET_ANYTHING_OPTIONS, key=combo_index)
+# card masks (per Card.to_mask()) of all options, indexed by combo_index()
+COMBO_MASKS = numpy.array([sum(card.to_mask() for card in option)
+                           for option in ALL_COMBOS], dtype=numpy.uint64)
 
 class Test(unittest.TestCase):
     """
@@ -578,6 +670,33 @@ class Test(unittest.TestCase):
             result = HandRange(minuend).subtract(HandRange(subtrahend))
             self.assertEqual(result.description, difference)
 
+    def test_bitset(self):
+        """ Test combo_index, options_to_bitset, bitset_to_options """
+        self.assertEqual(sorted(combo_index(o) for o in ALL_COMBOS),
+                         range(1326))
+        options = HandRange("AA,KQs,72o").generate_options()
+        bits = options_to_bitset(options)
+        self.assertEqual(bin(bits).count("1"), 22)
+        self.assertEqual(set(bitset_to_options(bits)), set(options))
+        self.assertEqual(bitset_to_options(0), [])
+
+    def test_deal_indices(self):
+        """ Test deal_indices """
+        board = Card.many_from_text("AhKd2c")
+        first = options_to_indices(HandRange("AA").generate_options(board))
+        second = options_to_indices(HandRange("AsKs").generate_options(board))
+        dealt = deal_indices([first, second], 1000, board)
+        self.assertTrue(0 < len(dealt) < 1000)  # AsKs blocks half of AA
+        for row in dealt:
+            cards = ALL_COMBOS[row[0]].union(ALL_COMBOS[row[1]])
+            self.assertEqual(len(cards), 4)
+            self.assertFalse(cards.intersection(board))
+        self.assertEqual(
+            len(deal_indices([first], 1000, Card.many_from_text("AsAc"))), 0)
+        lookup = options_to_lookup(HandRange("AA").generate_options(board))
+        self.assertTrue(lookup[dealt[:, 0]].all())
+        self.assertFalse(lookup[dealt[:, 1]].any())
+
 if __name__ == '__main__':
     # 0.035s in 20130205 (Eclipse 3.6.1)
     # 0.035s on 20131230 (Eclipse 4.2.2)
@@ -188,8 +188,134 @@ def showdown(board, players_cards, memo=None):
     winners = [player for player, hand in shown_down if hand == best]
     return shown_down, winners
 
+def _hand_value(all_cards, memo):
+    """
+    BestHandEval7 of a frozenset of seven cards, memoised
+    """
+    if memo.has_key(all_cards):
+        return memo[all_cards]
+    hand = BestHandEval7(all_cards)
+    memo[all_cards] = hand
+    return hand
+
+def _deal_villains(villain_options, board):
+    """
+    Deal one option for each villain, such that no cards collide with each
+    other or with the board.
+
+    returns a list of hands, or None if the options appear to be incompatible
+    """
+    for _ in xrange(10000):
+        hands = [random.choice(options) for options in villain_options]
+        if not _impossible_deal(hands + [board]):
+            return hands
+    return None
+
+def _score_deal(hero_options, villains, board, wins, counts, memo):
+    """
+    Deal the rest of the board, and score every hero option that is compatible
+    with this deal of the villains against it, accumulating into wins and
+    counts (dicts keyed by hero option)
+    """
+    excluded = concatenate(villains) + list(board)
+    full_board = list(board) + cards.deal_cards(excluded, 5 - len(board))
+    dead = frozenset(excluded)
+    best = None
+    ties = 0
+    for hand in villains:
+        value = _hand_value(frozenset(full_board + list(hand)), memo)
+        if best is None or value > best:
+            best = value
+            ties = 1
+        elif value == best:
+            ties += 1
+    for option in hero_options:
+        if option.intersection(dead):
+            continue
+        value = _hand_value(frozenset(full_board + list(option)), memo)
+        if value > best:
+            wins[option] += 1.0
+        elif value == best:
+            wins[option] += 1.0 / (ties + 1)
+        counts[option] += 1
+
+def _all_combos_equity(options_by_userid, board, iterations):
+    """
+    options_by_userid: map of userid to list of options, for every player in
+    the showdown
+    board: community cards (may be fewer than five)
+
+    For each player, each iteration deals the other players (and the rest of
+    the board) once, and scores every one of the player's options that is
+    compatible with that deal against it. The options and the memo of hand
+    values are shared by all players.
+
+    returns a map of userid to a dict mapping option to (pots won, showdowns
+    sampled)
+    """
+    villain_options = {userid: [options for key, options
+                                in options_by_userid.iteritems()
+                                if key != userid]
+                       for userid in options_by_userid}
+    wins = {userid: {option: 0.0 for option in options}
+            for userid, options in options_by_userid.iteritems()}
+    counts = {userid: {option: 0 for option in options}
+              for userid, options in options_by_userid.iteritems()}
+    remaining = set(options_by_userid)
+    memo = {}
+    for _ in xrange(iterations):
+        for userid in list(remaining):
+            villains = _deal_villains(villain_options[userid], board)
+            if villains is None:
+                logging.warning(
+                    "all combos: evidently incompatible set of options: %r "
+                    "(board is %r)", villain_options[userid], board)
+                remaining.discard(userid)
+                continue
+            _score_deal(options_by_userid[userid], villains, board,
+                        wins[userid], counts[userid], memo)
+    return {userid: {option: (wins[userid][option], counts[userid][option])
+                     for option in options}
+            for userid, options in options_by_userid.iteritems()}
+
+def range_equities(board, all_ranges, iterations=1000):
+    """
+    board is a list of cards
+    all_ranges maps userid to raw range.
+
+    returns a map of userid to a list of tuples of (option, equity) for each
+    option in the user's range that can show down against the other ranges
+    """
+    if len(all_ranges) == 2:
+        (key1, range1), (key2, range2) = all_ranges.items()
+        # 990: heads up on the river will always be exact
+        # for reasons that probably aren't obvious
+        # (that's the number of combos in "anything" once you remove 2 Hero
+        # combos and 5 board cards)
+        # screw it let's make it an even 1,000 for those other spots
+        return {key1: py_all_hands_vs_range(range1, range2, board,
+                                            iterations).items(),
+                key2: py_all_hands_vs_range(range2, range1, board,
+                                            iterations).items()}
+    options_by_userid = {key: range_.generate_options(board)
+                         for key, range_ in all_ranges.iteritems()}
+    equities = _all_combos_equity(options_by_userid, board, iterations)
+    results = {}
+    for userid, options in options_by_userid.iteritems():
+        results[userid] = []
+        for combo in options:
+            wins, count = equities[userid][combo]
+            if count:
+                results[userid].append((combo, wins / count))
+            # else:
+            # It happens that sometime a hand in a range is up against such a
+            # narrow range that card removal effects mean that this hand will
+            # never show down. The showdown EV is therefore undefined, and the
+            # option is left out.
+    return results
+
 # TODO: 1: This is a hack. Combine into AnalysisReplayer, store in database.
-def all_combos_ev(board, userids, pot, all_ranges):
+def all_combos_ev(board, userids, pot, all_ranges, iterations=1000):
     """
     board is a list of cards
     userids is a list that gives us order of players
@@ -199,52 +325,11 @@ def all_combos_ev(board, userids, pot, all_ranges):
     returns a list of tuples of (user, list of tuples of (raw combo, EV))
     users ordered according to showdown.equities, EV ordered low to high
     """
+    equities = range_equities(board, all_ranges, iterations)
     results = []
-    for userid in userids:  # for each player, generate all combos
-        all_combos_ev = []
-        if len(all_ranges) == 2:
-            (key1, range1), (_key2, range2) = all_ranges.items()
-            if key1 == userid:
-                hero = range1
-                villain = range2
-            else:
-                hero = range2
-                villain = range1
-            # 990: heads up on the river will always be exact
-            # for reasons that probably aren't obvious
-            # (that's the number of combos in "anything" once you remove 2 Hero
-            # combos and 5 board cards)
-            # screw it let's make it an even 1,000 for those other spots
-            equities = py_all_hands_vs_range(hero, villain, board, 1000)
-            for combo, eq in equities.iteritems():
-                desc = unweighted_options_to_description([combo])
-                all_combos_ev.append((desc, eq * pot))
-        else:
-            range_ = all_ranges[userid]
-            combos = range_.generate_options(board)
-            ranges = {}
-            for combo in combos:  # for each combo, calculate EV
-                desc = unweighted_options_to_description([combo])
-                ranges = {}
-                for u in userids:  # generate ranges
-                    if u == userid:
-                        ranges[u] = HandRange(desc)
-                    else:
-                        ranges[u] = all_ranges[u]
-                equities, iterations = showdown_equity(ranges, board, 1000)
-                if iterations:
-                    eq = equities[userid]
-                    all_combos_ev.append((desc, eq * pot))
-                else:
-                    # It happens that sometime a hand in a range is up against
-                    # such a narrow range that card removal effects mean that
-                    # this hand will never show down. The showdown EV is
-                    # therefore undefined. Later, we will also need to recognise
-                    # that this means that for this combo, the showdown was not
-                    # possible, and needs to be given zero weight in earlier
-                    # actions' EV.
-                    # TODO: 1: recognise impossibilities in combo EV calcs.
-                    pass
+    for userid in userids:  # for each player, all combos
+        all_combos_ev = [(unweighted_options_to_description([combo]), eq * pot)
+                         for combo, eq in equities[userid]]
         results.append((userid, all_combos_ev))
     return results
 
@@ -286,6 +371,52 @@ class Test(unittest.TestCase):
         results = all_combos_ev(board_raw, showdown, all_ranges)
         self.assertTrue(results)
 
+    def test_all_combos_equity(self):
+        """
+        Every option is scored against each deal of the other players.
+        """
+        board = Card.many_from_text("2d3d4s7s9c")
+        aces = frozenset(Card.many_from_text("AhAc"))
+        kings = frozenset(Card.many_from_text("KhKc"))
+        jacks = frozenset(Card.many_from_text("JhJc"))
+        queens1 = frozenset(Card.many_from_text("QhQc"))
+        queens2 = frozenset(Card.many_from_text("QsQd"))
+        results = _all_combos_equity({1: [aces, kings, jacks], 2: [queens1],
+                                      3: [queens2]}, board, 10)
+        self.assertEqual(results[1][aces], (10.0, 10))
+        self.assertEqual(results[1][kings], (10.0, 10))
+        self.assertEqual(results[1][jacks], (0.0, 10))
+        # the other players' equities come from the same call
+        self.assertEqual(results[2][queens1][1], 10)
+        self.assertEqual(results[3][queens2][1], 10)
+        self.assertTrue(results[2][queens1][0] < 10.0)
+        # an option that collides with another player is never sampled
+        queens = frozenset(Card.many_from_text("QhQs"))
+        results = _all_combos_equity({1: [queens], 2: [queens1],
+                                      3: [queens2]}, board, 10)
+        self.assertEqual(results[1][queens], (0.0, 0))
+        # split pot
+        results = _all_combos_equity({1: [queens2], 2: [queens1]}, board, 10)
+        self.assertAlmostEqual(results[1][queens2][0], 5.0)
+        self.assertAlmostEqual(results[2][queens1][0], 5.0)
+
+    def test_range_equities(self):
+        """
+        One call gives the equities of every player, heads-up or multiway.
+        """
+        board = Card.many_from_text("2d3d4s7s9c")
+        ranges = {1: HandRange("AA"), 2: HandRange("KK")}
+        results = range_equities(board, ranges, 100)
+        self.assertEqual(set(results), set([1, 2]))
+        self.assertTrue(all(equity == 1.0 for _, equity in results[1]))
+        self.assertTrue(all(equity == 0.0 for _, equity in results[2]))
+        ranges[3] = HandRange("QQ")
+        results = range_equities(board, ranges, 100)
+        self.assertEqual(set(results), set([1, 2, 3]))
+        self.assertEqual(len(results[1]), 6)
+        self.assertTrue(all(equity == 1.0 for _, equity in results[1]))
+        self.assertTrue(all(equity == 0.0 for _, equity in results[3]))
+
     def assert_equity_almost_equal(self, first, second):
         self.assertEqual(first.keys(), second.keys())
         for key in first.keys():
@@ -463,4 +594,4 @@ class Test(unittest.TestCase):
 if __name__ == "__main__":
     # 262 seconds at 2013-02-10 (old version)
     # 175 seconds at 2014-12-19 (fewer tests though, because no weighted ranges)
-    unittest.main()
+    unittest.main()
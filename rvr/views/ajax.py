@@ -4,10 +4,12 @@ Helpful functions to be called by JavaScript
 
 from rvr.app import APP
 from flask import jsonify
+from flask.globals import request
 from rvr.poker.handrange import NOTHING, ANYTHING
 import json
 import urllib2
 from rvr.views.range_editor import safe_hand_range, safe_board
+from rvr.views.main import request_showdown_ev
 import logging
 
 @APP.route('/ajax/range_subtract')
@@ -66,4 +68,30 @@ def total_donated():
         # Also, see if this call now honours cors=true
         logging.info("Failed to retrieve donation total.")
         return jsonify(total_received=250000)
-    return jsonify(total_received=response['total_received'])
\ No newline at end of file
+    return jsonify(total_received=response['total_received'])
+
+@APP.route('/ajax/showdown')
+def showdown_ev():
+    """
+    usage:
+    ?gameid=g&order=o
+
+    Polled by the showdown page while it waits for combo EVs to be calculated.
+
+    Returns status ('pending', 'done' or 'failed'), and when done, results, a
+    list of objects with screenname and combos, a list of [combo, EV] sorted by
+    EV low to high. If the request is invalid, returns error.
+    """
+    gameid = request.args.get('gameid', None, int)
+    order = request.args.get('order', None, int)
+    if gameid is None or order is None:
+        return jsonify(error="Invalid game id or order.")
+    msg, status, combo_and_ev_by_user = request_showdown_ev(gameid, order)
+    if msg is not None:
+        return jsonify(error=msg)
+    if combo_and_ev_by_user is None:
+        return jsonify(status=status)
+    results = [{'screenname': user.screenname,
+                'combos': combos_and_ev}
+               for user, combos_and_ev in combo_and_ev_by_user]
+    return jsonify(status=status, results=results)
@@ -24,7 +24,7 @@ from rvr.forms.backdoor import BackdoorForm
 from rvr.db.tables import PaymentToPlayer, RunningGameParticipantResult
 from functools import wraps
 from rvr.poker.cards import Card
-from rvr.poker.showdown import all_combos_ev
+from rvr.core.showdown_ev import SHOWDOWN_EV, STATUS_DONE
 
 # pylint:disable=R0911,R0912,R0914
 
@@ -1106,26 +1106,22 @@ def situation_page():
         description=description,
         leaderboards=leaderboards)
 
-@APP.route('/showdown', methods=['GET'])
-def showdown_page():
+def request_showdown_ev(gameid, order):
     """
-    All combos EV at showdown. Maybe even combos that weren't played!
+    Find the showdown at order in game gameid, and request the EV of all combos
+    for each player in it. The calculation happens on SHOWDOWN_EV's pool.
 
-    E.g. if I just folded a hand, I'd like to know if it would have been worth
-    playing. Either as a bluff, or as a call.
+    Returns (error message, status, results). results is a list of (user, list
+    of (raw combo, EV) sorted by EV low to high), or None if not yet available.
 
-    And then of course I guess I'm also curious about all those other hands I
-    folded along the way.
+    Analysis records these EVs, so this is only calculated for games analysed
+    before that was the case (and for games not yet analysed).
     """
-    gameid = request.args.get('gameid', None)
-    if gameid is None:
-        return error("Invalid game id.")
-    try:
-        gameid = int(gameid)
-    except ValueError:
-        return error("Invalid game id (not a number).")
-
     api = API()
+    response = api.get_showdown_combo_evs(gameid, order)
+    if not isinstance(response, APIError) and response:
+        return None, STATUS_DONE, response
+
     response = api.get_public_game(gameid)
     if isinstance(response, APIError):
         if response is api.ERR_NO_SUCH_GAME:
@@ -1133,24 +1129,16 @@ def showdown_page():
         else:
             msg = "An unknown error occurred retrieving game %d, sorry." %  \
                 (gameid,)
-        return error(msg)
+        return msg, None, None
     game = response
 
-    order = request.args.get('order', None)
-    if order is None:
-        return error("Invalid order.")
-    try:
-        order = int(order)
-    except ValueError:
-        return error("Invalid order (not a number).")
-
     item = None
     all_ranges = {}
     board_raw = game.game_details.situation.board_raw
     last_range_action = None
     for item in game.history:
         if isinstance(item, dtos.GameItemUserRange):
-            all_ranges[item.user.userid] = HandRange(item.range_raw)
+            all_ranges[item.user.userid] = item.range_raw
         if isinstance(item, dtos.GameItemBoard):
             board_raw = item.cards
         if isinstance(item, dtos.GameItemRangeAction):
@@ -1158,10 +1146,10 @@ def showdown_page():
         if item.order == order:
             break
     else:
-        return error("Invalid order (not in game).")
+        return "Invalid order (not in game).", None, None
 
     if not isinstance(item, dtos.GameItemShowdown):
-        return error("Invalid order (not a showdown).")
+        return "Invalid order (not a showdown).", None, None
 
     showdown = item
 
@@ -1169,28 +1157,67 @@ def showdown_page():
     # and then update their range to it. It was this call or check that created
     # this showdown, and so we use that range
     all_ranges[last_range_action.user.userid] =  \
-        last_range_action.range_action.passive_range
+        last_range_action.range_action.passive_range.description
 
     # all_ranges maps userid to raw range (text).
     # showdown.equities is a list with UserDetails members.
     # This tells us who was in the showdown, i.e. which ranges to use.
     # Now let's make some data.
-    combo_and_ev_by_userid = all_combos_ev(
-        board=Card.many_from_text(board_raw),
-        userids=[e.user.userid for e in showdown.equities],
-        pot=showdown.pot,
-        all_ranges=all_ranges)
+    status, combo_and_ev_by_userid = SHOWDOWN_EV.request(
+        (gameid, order),
+        board_raw,
+        [e.user.userid for e in showdown.equities],
+        showdown.pot,
+        all_ranges)
+    if status != STATUS_DONE:
+        return None, status, None
     map_userid_to_user = {e.user.userid: e.user for e in showdown.equities}
     combo_and_ev_by_user = [(map_userid_to_user[userid],
                              sorted(data, key=lambda a: a[1]))
                             for userid, data in combo_and_ev_by_userid]
     # list of (user, list of (raw combo, EV)) sorted by EV low to high
+    return None, status, combo_and_ev_by_user
+
+@APP.route('/showdown', methods=['GET'])
+def showdown_page():
+    """
+    All combos EV at showdown. Maybe even combos that weren't played!
+
+    E.g. if I just folded a hand, I'd like to know if it would have been worth
+    playing. Either as a bluff, or as a call.
+
+    And then of course I guess I'm also curious about all those other hands I
+    folded along the way.
+
+    If the EVs haven't been calculated yet, the page polls /ajax/showdown until
+    they have.
+    """
+    gameid = request.args.get('gameid', None)
+    if gameid is None:
+        return error("Invalid game id.")
+    try:
+        gameid = int(gameid)
+    except ValueError:
+        return error("Invalid game id (not a number).")
+
+    order = request.args.get('order', None)
+    if order is None:
+        return error("Invalid order.")
+    try:
+        order = int(order)
+    except ValueError:
+        return error("Invalid order (not a number).")
+
+    msg, status, combo_and_ev_by_user = request_showdown_ev(gameid, order)
+    if msg is not None:
+        return error(msg)
 
     navbar_items = default_navbar_items()
     return render_template('web/showdown.html',
         navbar_items=navbar_items, is_logged_in=is_logged_in(),
         my_screenname=get_my_screenname(),
-        combo_and_ev_by_user=combo_and_ev_by_user)
+        gameid=gameid, order=order, status=status,
+        combo_and_ev_by_user=combo_and_ev_by_user or [])
 
 
 @APP.route('/ev', methods=['GET'])